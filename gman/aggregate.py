@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Department wide statistics over many encrypted group databases.
+
+Every file is decrypted read-only (no lock file, nothing written back) in
+a worker process and reduced to sums and counts per course title, which
+are then merged. Per file results are cached keyed by path, mtime and
+size, so unchanged files are not decrypted again.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy as sa
+
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from . import crypto, db, grades, utils
+
+
+CACHE_NAME = 'aggregates.json'
+FIELDS = ('total', 'practice', 'theory')
+
+
+def _connect(plaintext):
+    """Open the decrypted database image, in memory where possible."""
+    if hasattr(sqlite3.Connection, 'deserialize'):
+        connection = sqlite3.connect(':memory:', check_same_thread=False)
+        connection.deserialize(plaintext)
+        return connection, None
+    tmp = tempfile.NamedTemporaryFile(suffix='-gman.sqlite', delete=False)
+    with tmp:
+        tmp.write(plaintext)
+    return sqlite3.connect(tmp.name, check_same_thread=False), tmp.name
+
+
+def file_aggregates(path, keyfile=None, password=None):
+    """Sums and counts of the course results of one database file."""
+    plaintext = crypto.decrypt_file(path, keyfile, password)
+    connection, tmp_name = _connect(plaintext)
+    engine = sa.create_engine('sqlite://', creator=lambda: connection,
+                              poolclass=StaticPool)
+    session = Session(bind=engine)
+    try:
+        # Only the tables and columns the queries need, the copy is thrown
+        # away afterwards.
+        connection = session.connection()
+        db.Base.metadata.create_all(connection)
+        db.add_columns(connection)
+        base = session.query(db.BaseData).first()
+        courses = {}
+        for course in session.query(db.Course):
+            values = courses.setdefault(
+                course.title, {f: [0.0, 0] for f in FIELDS}
+            )
+            for standing in grades.course_standings(session,
+                                                    course).values():
+                for field in FIELDS:
+                    value = getattr(standing, field)
+                    if value is not None:
+                        values[field][0] += value
+                        values[field][1] += 1
+        return dict(group=base.group_name, job=base.job, courses=courses)
+    finally:
+        session.close()
+        engine.dispose()
+        connection.close()
+        if tmp_name is not None:
+            os.unlink(tmp_name)
+
+
+def merge(results, job=None):
+    """Merge per file results to averages per (job, course title)."""
+    merged = {}
+    for result in results:
+        if job is not None and result['job'] != job.upper():
+            continue
+        for title, values in result['courses'].items():
+            entry = merged.setdefault(
+                (result['job'], title),
+                dict(groups=set(), **{f: [0.0, 0] for f in FIELDS})
+            )
+            entry['groups'].add(result['group'])
+            for field in FIELDS:
+                entry[field][0] += values[field][0]
+                entry[field][1] += values[field][1]
+    rows = []
+    for (job_, title), entry in sorted(merged.items()):
+        row = dict(job=job_, course=title, groups=len(entry['groups']),
+                   students=entry['total'][1])
+        for field in FIELDS:
+            total, count = entry[field]
+            row[field] = total / count if count else None
+        rows.append(row)
+    return rows
+
+
+class Cache:
+
+    def __init__(self, path=None):
+        if path is None:
+            directory = utils.cache_dir()
+            path = os.path.join(directory, CACHE_NAME) if directory else None
+        self.path = path
+        self.entries = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path, encoding='utf-8') as fp:
+                    self.entries = json.load(fp)
+            except ValueError:
+                self.entries = {}
+
+    @staticmethod
+    def key(path):
+        """Path, mtime and size, taken once before a file is processed.
+
+        A file changed while it is processed is then stored with its old
+        key and computed again next time.
+        """
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, key):
+        name, mtime, size = key
+        entry = self.entries.get(name)
+        if entry and entry['mtime'] == mtime and entry['size'] == size:
+            return entry['result']
+
+    def set(self, key, result):
+        name, mtime, size = key
+        self.entries[name] = dict(mtime=mtime, size=size, result=result)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp, self.path)
+
+
+def aggregate(paths, keyfile=None, password=None, workers=None, cache=None):
+    """Aggregate all `paths`, returns (results, errors).
+
+    Files not found in `cache` are processed in parallel by `workers`
+    processes (default: number of CPUs).
+    """
+    results = []
+    errors = []
+    todo = []
+    for path in paths:
+        if cache is None:
+            todo.append((path, None))
+            continue
+        try:
+            key = cache.key(path)
+        except OSError as error:
+            errors.append((path, error))
+            continue
+        result = cache.get(key)
+        if result is None:
+            todo.append((path, key))
+        else:
+            results.append(result)
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                (path, key,
+                 pool.submit(file_aggregates, path, keyfile, password))
+                for path, key in todo
+            ]
+            for path, key, future in futures:
+                try:
+                    result = future.result()
+                except Exception as error:
+                    errors.append((path, error))
+                    continue
+                results.append(result)
+                if cache is not None:
+                    cache.set(key, result)
+        if cache is not None:
+            cache.save()
+    return results, errors
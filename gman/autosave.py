@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Periodic checkpoints of the open database to the encrypted file.
+
+The interval in minutes is read from the setting autosave/interval
+(default 5), 0 disables autosave. Snapshot and encryption run in a pool
+thread, so editing is not blocked. The setting autosave/generations
+(default 0) is the number of older encrypted files to keep.
+"""
+
+from PyQt5 import QtCore
+
+
+INTERVAL = 5
+GENERATIONS = 0
+
+
+def _settings():
+    return QtCore.QSettings('bbz', 'Notenmanager')
+
+
+def interval():
+    return _settings().value('autosave/interval', INTERVAL, type=int)
+
+
+def generations():
+    return _settings().value('autosave/generations', GENERATIONS, type=int)
+
+
+class _JobSignals(QtCore.QObject):
+
+    done = QtCore.pyqtSignal(bool)
+    failed = QtCore.pyqtSignal(str)
+
+
+class CheckpointJob(QtCore.QRunnable):
+
+    def __init__(self, handler, signals):
+        QtCore.QRunnable.__init__(self)
+        self.handler = handler
+        self.signals = signals
+
+    def run(self):
+        try:
+            written = self.handler.checkpoint()
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+        else:
+            self.signals.done.emit(written)
+
+
+class Autosave(QtCore.QObject):
+
+    saved = QtCore.pyqtSignal(bool)
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.handler = None
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.checkpoint)
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self._signals = _JobSignals(self)
+        self._signals.done.connect(self.saved)
+        self._signals.failed.connect(self.failed)
+
+    def start(self, handler, minutes=None):
+        self.stop()
+        if minutes is None:
+            minutes = interval()
+        if handler.read_only or minutes <= 0:
+            return
+        self.handler = handler
+        self.timer.start(minutes * 60000)
+
+    def stop(self):
+        self.timer.stop()
+        self.pool.waitForDone()
+        self.handler = None
+
+    def checkpoint(self):
+        if self.handler is None or self.pool.activeThreadCount():
+            return
+        self.pool.start(CheckpointJob(self.handler, self._signals))
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the crypto and database core.
+
+Databases are generated at several scales (number of groups, every group
+has GROUP_SIZE students with photos and COURSES courses) and the core
+operations are timed. Results are written as JSON and can be compared
+against a stored baseline. Usage: python -m gman benchmark --help
+"""
+
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from time import perf_counter
+
+import sqlalchemy as sa
+
+from sqlalchemy.orm import Session
+
+from . import blobs, crypto, db, grades
+
+
+SCALES = (1, 10, 100)
+GROUP_SIZE = 12
+COURSES = 8
+EXPERIMENTS = 4
+TESTS = 3
+PHOTO_SIZE = 6000
+THRESHOLD = 0.25
+
+
+class Timer:
+
+    def __init__(self):
+        self.seconds = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = perf_counter() - self.start
+
+
+def generate(session, groups, seed=0, photo=None):
+    """Fill an empty database, returns the time spent on bulk inserts.
+
+    Every student gets `photo` or, by default, random bytes of PHOTO_SIZE.
+    """
+    rnd = random.Random(seed)
+    db.create_tables(session)
+    session.add(db.BaseData(group_name='Benchmark {}'.format(groups),
+                            start=date(2020, 1, 1), internal_code='BM'))
+    session.add_all(db.Ratings(key='IHK', points=p, school_grade=g)
+                    for p, g in ((100, 1), (50, 4), (0, 6)))
+    company = db.Company(name='Benchmark GmbH', short_name='BM')
+    session.add(company)
+    session.commit()
+    # random bytes do not compress, like real PNG photos
+    photos = [photo or
+              rnd.getrandbits(PHOTO_SIZE * 8).to_bytes(PHOTO_SIZE, 'little')
+              for _ in range(groups * GROUP_SIZE)]
+    hashes = [blobs.digest(photo) for photo in photos]
+    with Timer() as timer:
+        session.bulk_insert_mappings(db.Blob, [
+            dict(hash=hash_, data=photo)
+            for hash_, photo in dict(zip(hashes, photos)).items()
+        ])
+        session.bulk_insert_mappings(db.Student, [
+            dict(last_name='Name{:05d}'.format(i),
+                 first_name='Vorname{}'.format(i), company_id=company.pk,
+                 photo_hash=hash_, show=True)
+            for i, hash_ in enumerate(hashes)
+        ])
+        start = date(2020, 1, 6)
+        session.bulk_insert_mappings(db.Course, [
+            dict(title='Kurs {}'.format(i), trainer='Trainer',
+                 start=start + timedelta(weeks=4 * i),
+                 end=start + timedelta(weeks=4 * i + 3))
+            for i in range(COURSES)
+        ])
+        courses = session.query(db.Course.pk, db.Course.start).all()
+        session.bulk_insert_mappings(db.Experiment, [
+            dict(title='Versuch {}'.format(i), course_id=pk,
+                 done_on=begin + timedelta(days=i))
+            for pk, begin in courses for i in range(EXPERIMENTS)
+        ])
+        session.bulk_insert_mappings(db.Test, [
+            dict(subject='Test {}'.format(i), course_id=pk, max_points=50,
+                 done_on=begin + timedelta(days=i))
+            for pk, begin in courses for i in range(TESTS)
+        ])
+        students = [pk for pk, in session.query(db.Student.pk)]
+        experiments = [pk for pk, in session.query(db.Experiment.pk)]
+        tests = [pk for pk, in session.query(db.Test.pk)]
+        session.bulk_insert_mappings(db.PracticeGrade, [
+            dict(experiment_id=e, student_id=s, method=rnd.randint(50, 100),
+                 result=rnd.randint(50, 100), docs=rnd.randint(50, 100))
+            for e in experiments for s in students
+        ])
+        session.bulk_insert_mappings(db.TheoryGrade, [
+            dict(test_id=t, student_id=s,
+                 points=Decimal(rnd.randint(0, 100)) / 2)
+            for t in tests for s in students
+        ])
+        session.commit()
+    return timer.seconds
+
+
+def load_tree(session):
+    """The queries of GradeManagerMain.load_db."""
+    session.query(db.BaseData).first()
+    session.query(db.Student).order_by(db.Student.last_name).all()
+    for course in session.query(db.Course).order_by(db.Course.start):
+        list(course.tests)
+        list(course.experiments)
+
+
+def all_standings(session):
+    for course in session.query(db.Course):
+        grades.course_standings(session, course)
+
+
+def _stats(runs):
+    return dict(runs=runs, min=min(runs), median=statistics.median(runs))
+
+
+def create_database(path, keyfile, groups, photo=None):
+    """Create an encrypted database, returns the bulk insert time."""
+    handler = crypto.CryptedDBHandler(path, keyfile=keyfile)
+    handler.decrypt()
+    engine = db.get_engine(handler.connection_string)
+    session = Session(bind=engine)
+    insert = generate(session, groups, photo=photo)
+    session.close()
+    engine.dispose()
+    handler.encrypt(force=True)
+    return insert
+
+
+def run_scale(groups, repeat=3, directory=None):
+    """Time all benchmarks for one scale, returns {name: stats}."""
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        keyfile = os.path.join(tmp, 'bench.key')
+        path = os.path.join(tmp, 'bench.gmandb')
+        insert = create_database(path, keyfile, groups)
+        runs = dict(decrypt=[], encrypt=[], load_tree=[], standings=[])
+        for _ in range(repeat):
+            handler = crypto.CryptedDBHandler(path, keyfile=keyfile)
+            with Timer() as timer:
+                handler.decrypt()
+            runs['decrypt'].append(timer.seconds)
+            engine = db.get_engine(handler.connection_string)
+            for name, func in (('load_tree', load_tree),
+                               ('standings', all_standings)):
+                session = Session(bind=engine)
+                with Timer() as timer:
+                    func(session)
+                runs[name].append(timer.seconds)
+                session.close()
+            engine.dispose()
+            with Timer() as timer:
+                handler.encrypt(force=True)
+            runs['encrypt'].append(timer.seconds)
+        results = {name: _stats(values) for name, values in runs.items()}
+        results['bulk_insert'] = _stats([insert])
+        results['file_size'] = os.path.getsize(path)
+    return results
+
+
+def run(scales=SCALES, repeat=3, directory=None, progress=None):
+    results = dict(
+        meta=dict(
+            created=datetime.now().isoformat(timespec='seconds'),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            sqlalchemy=sa.__version__,
+            repeat=repeat,
+        ),
+        results={},
+    )
+    for groups in scales:
+        if progress is not None:
+            progress(groups)
+        results['results'][str(groups)] = run_scale(groups, repeat,
+                                                    directory)
+    return results
+
+
+def compare(results, baseline):
+    """Compare median times, returns rows (scale, name, base, now, ratio).
+
+    Only benchmarks present in both files are compared.
+    """
+    rows = []
+    for scale, benchmarks in sorted(results['results'].items(),
+                                    key=lambda i: int(i[0])):
+        base = baseline.get('results', {}).get(scale, {})
+        for name, stats in sorted(benchmarks.items()):
+            if not isinstance(stats, dict) or name not in base:
+                continue
+            before = base[name]['median']
+            now = stats['median']
+            ratio = now / before if before else None
+            rows.append((scale, name, before, now, ratio))
+    return rows
+
+
+def regressions(rows, threshold=THRESHOLD):
+    return [r for r in rows if r[4] is not None and r[4] > 1 + threshold]
+
+
+def save(results, path):
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(results, fp, indent=2)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp)
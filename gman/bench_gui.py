@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Latency of opening and refreshing windows, runs headless.
+
+The main window and the editing widgets are opened against databases
+generated by gman.bench. Per action the wall time, the number of SQL
+statements and the memory allocated by Python (tracemalloc) are measured
+and compared with a latency budget. Without a display the Qt platform
+"offscreen" is used. Usage: python -m gman gui-benchmark --help
+"""
+
+import os
+import statistics
+import tempfile
+import tracemalloc
+
+from time import perf_counter
+
+import sqlalchemy as sa
+
+from . import bench
+
+
+# latency budgets in milliseconds
+BUDGETS = {
+    'main_window': 500,
+    'load_db': 300,
+    'reload': 300,
+    'students': 500,
+    'course': 150,
+    'experiment': 150,
+    'companies': 150,
+    'conference': 500,
+}
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        sa.event.remove(sa.engine.Engine, 'before_cursor_execute',
+                        self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def measure(app, func):
+    """Run `func` and process pending events, returns (result, stats)."""
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    with QueryCounter() as counter:
+        start = perf_counter()
+        result = func()
+        app.processEvents()
+        seconds = perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    return result, dict(seconds=seconds, queries=counter.count,
+                        allocated=peak - before, retained=current - before)
+
+
+def _photo():
+    from PyQt5 import QtCore, QtGui
+    image = QtGui.QImage(150, 200, QtGui.QImage.Format_RGB32)
+    image.fill(QtGui.QColor('steelblue'))
+    data = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(data)
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    image.save(buffer, 'PNG')
+    return bytes(data)
+
+
+def _open(widget):
+    widget.show()
+    return widget
+
+
+def run_once(app, path, keyfile):
+    """Open all windows once, returns {action: stats}."""
+    from . import crypto, db, main_window, widgets
+    ui_path = main_window.UI_PATH
+    results = {}
+    gmm, results['main_window'] = measure(app, main_window.GradeManagerMain)
+    handler = crypto.CryptedDBHandler(path, keyfile=keyfile)
+    _, results['load_db'] = measure(app, lambda: gmm.load_db(handler))
+    _, results['reload'] = measure(app, lambda: gmm.load_db(handler))
+    course = gmm.session.query(db.Course).first()
+    actions = (
+        ('students', lambda: widgets.StudentsWidget(
+            ui_path, gmm.status, gmm.new_session())),
+        ('course', lambda: widgets.CourseWidget(
+            ui_path, gmm.status, gmm.new_session())),
+        ('experiment', lambda: widgets.ExperimentWidget(
+            ui_path, gmm.new_session(), course)),
+        ('companies', lambda: widgets.CompaniesWidget(
+            ui_path, gmm.status, gmm.new_session())),
+        ('conference', lambda: widgets.ConferenceWidget(
+            ui_path, gmm.status, gmm.new_session())),
+    )
+    for name, factory in actions:
+        widget, results[name] = measure(app, lambda: _open(factory()))
+        widget.close()
+        widget.deleteLater()
+    gmm.close()
+    gmm.deleteLater()
+    app.processEvents()
+    return results
+
+
+def run(scales=(1, 10), repeat=3, progress=None):
+    """Returns {scale: {action: stats}} with the median of `repeat` runs."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    tracemalloc.start()
+    results = {}
+    try:
+        for groups in scales:
+            if progress is not None:
+                progress(groups)
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'bench.gmandb')
+                keyfile = os.path.join(tmp, 'bench.key')
+                bench.create_database(path, keyfile, groups, _photo())
+                runs = [run_once(app, path, keyfile) for _ in range(repeat)]
+            results[str(groups)] = {
+                name: {key: statistics.median(r[name][key] for r in runs)
+                       for key in runs[0][name]}
+                for name in runs[0]
+            }
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def over_budget(results, budgets=BUDGETS):
+    """Return (scale, action, milliseconds, budget) of slow actions."""
+    slow = []
+    for scale, actions in results.items():
+        for name, stats in actions.items():
+            ms = stats['seconds'] * 1000
+            if name in budgets and ms > budgets[name]:
+                slow.append((scale, name, ms, budgets[name]))
+    return slow
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Content addressed storage of photos and logos.
+
+The bytes live once in the table blobs, keyed by their SHA-256, students
+and base data only reference the hash (db.Blob, Student.photo,
+BaseData.logo). Triggers keep the reference count, unreferenced blobs
+are removed by collect().
+
+Databases created before store the bytes in the columns students.photo
+and base_data.logo, migrate() moves them to the blob table.
+"""
+
+import hashlib
+
+
+# table: (hash column, legacy data column)
+REFERENCES = {
+    'students': ('photo_hash', 'photo'),
+    'base_data': ('logo_hash', 'logo'),
+}
+
+_TRIGGERS = (
+    ('insert', 'INSERT', 'new.{0} IS NOT NULL',
+     'UPDATE blobs SET refcount = refcount + 1 WHERE hash = new.{0};'),
+    ('update', 'UPDATE OF {0}', 'old.{0} IS NOT new.{0}',
+     'UPDATE blobs SET refcount = refcount - 1 WHERE hash = old.{0}; '
+     'UPDATE blobs SET refcount = refcount + 1 WHERE hash = new.{0};'),
+    ('delete', 'DELETE', 'old.{0} IS NOT NULL',
+     'UPDATE blobs SET refcount = refcount - 1 WHERE hash = old.{0};'),
+)
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _columns(connection, table):
+    return {row[1] for row in connection.execute(
+        'PRAGMA table_info({})'.format(table)
+    )}
+
+
+def install(connection):
+    """Add missing hash columns and reference count triggers."""
+    for table, (column, _) in REFERENCES.items():
+        if column not in _columns(connection, table):
+            connection.execute(
+                'ALTER TABLE {} ADD COLUMN {} VARCHAR(64) '
+                'REFERENCES blobs (hash)'.format(table, column)
+            )
+        for name, event, when, body in _TRIGGERS:
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS blobs_{table}_{name} AFTER '
+                '{event} ON {table} WHEN {when} BEGIN {body} END'.format(
+                    table=table, name=name, event=event.format(column),
+                    when=when.format(column), body=body.format(column)
+                )
+            )
+
+
+def migrate(connection):
+    """Move bytes from the legacy columns to blobs, returns the count.
+
+    The legacy columns are cleared (SQLite before 3.35 cannot drop
+    columns), the file only shrinks after a VACUUM.
+    """
+    moved = 0
+    for table, (column, legacy) in REFERENCES.items():
+        if legacy not in _columns(connection, table):
+            continue
+        rows = connection.execute(
+            'SELECT pk, {0} FROM {1} WHERE {0} IS NOT NULL'.format(
+                legacy, table
+            )
+        ).fetchall()
+        for pk, data in rows:
+            data = bytes(data)
+            hash_ = digest(data)
+            connection.execute(
+                'INSERT OR IGNORE INTO blobs (hash, data, refcount) '
+                'VALUES (?, ?, 0)', (hash_, data)
+            )
+            connection.execute(
+                'UPDATE {} SET {} = ?, {} = NULL WHERE pk = ?'.format(
+                    table, column, legacy
+                ), (hash_, pk)
+            )
+        moved += len(rows)
+    return moved
+
+
+def collect(connection):
+    """Delete unreferenced blobs, returns the number removed."""
+    return connection.execute(
+        'DELETE FROM blobs WHERE refcount <= 0'
+    ).rowcount
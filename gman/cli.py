@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""Command line interface for bulk operations without a display.
+
+Nothing in here imports PyQt5, so the commands run on headless servers
+and start fast. Usage: python -m gman --help
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+from contextlib import contextmanager
+from getpass import getpass
+
+from . import container, crypto, db, sqlprofile, tracing
+
+
+def find_databases(paths):
+    """Expand directories to the *.gmandb files they contain."""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.gmandb'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def credentials(args):
+    if args.keyfile:
+        return dict(keyfile=args.keyfile)
+    password = args.password or os.environ.get('GMAN_PASSWORD')
+    if not password:
+        if not sys.stdin.isatty():
+            raise crypto.SetupError('Kein Passwort oder Keyfile angegeben.')
+        password = getpass('Passwort: ')
+        args.password = password
+    return dict(password=password)
+
+
+@contextmanager
+def open_db(path, args, write=False):
+    """Decrypt `path` and yield a session.
+
+    Unless `write` is set the database is opened read-only: it is not
+    locked, so files currently edited by somebody else can be processed,
+    and nothing is written back.
+    """
+    if not os.path.isfile(path):
+        raise crypto.SetupError('Datei {} existiert nicht.'.format(path))
+    handler = crypto.CryptedDBHandler(path, read_only=not write,
+                                      generations=args.generations,
+                                      compression=args.compression,
+                                      takeover=args.takeover,
+                                      **credentials(args))
+    try:
+        handler.decrypt()
+        if not write:
+            # only the plaintext copy is changed, it is never written back
+            db.upgrade_file(handler.db_path)
+        Session = db.get_session(handler.connection_string,
+                                 profile=handler.profile)
+        session = Session()
+        try:
+            if write:
+                db.upgrade_schema(session)
+            yield session
+        finally:
+            session.close()
+            Session.kw['bind'].dispose()
+    except BaseException:
+        handler.release()
+        raise
+    handler.close()
+
+
+def cmd_check(args, path):
+    with open_db(path, args) as s:
+        result = s.execute('PRAGMA integrity_check').scalar()
+        if result != 'ok':
+            raise crypto.CryptoKeyError(
+                'Integritätsprüfung fehlgeschlagen: {}'.format(result)
+            )
+        base = s.query(db.BaseData).first()
+        students = s.query(db.Student).count()
+        courses = s.query(db.Course).count()
+    return '{}: {} Teilnehmer, {} Kurse'.format(
+        base.group_name if base else '-', students, courses
+    )
+
+
+def cmd_recompute(args, path):
+    from . import conference
+    count = 0
+    with open_db(path, args, write=True) as s:
+        for conf in s.query(db.Conference).all():
+            conference.refresh(s, conf)
+            count += 1
+    return '{} Konferenzen neu berechnet'.format(count)
+
+
+def cmd_render(args, path):
+    from . import reports
+    with open_db(path, args) as s:
+        data = reports.ReportData(s)
+        target = os.path.join(args.output,
+                              reports.safe_name(data.base.group_name))
+        os.makedirs(target, exist_ok=True)
+        files = []
+        for student, html in reports.render_student_sheets(data):
+            files.append((reports.safe_filename(student.fullname, 'html'),
+                          html))
+        for course in data.courses:
+            name = 'Kurs_{}'.format(course.title)
+            files.append((reports.safe_filename(name, 'html'),
+                          reports.render_course_sheet(data, course)))
+        files.append(('Zusammenfassung.html', reports.render_summary(data)))
+    for name, html in files:
+        with open(os.path.join(target, name), 'w', encoding='utf-8') as fp:
+            fp.write(html)
+    return '{} Dateien nach {} geschrieben'.format(len(files), target)
+
+
+def cmd_import(args, path):
+    from . import importer
+    report = importer.ImportReport()
+    with open_db(path, args, write=True) as s:
+        if args.students:
+            importer.import_students(s, args.students, report)
+        if args.grades:
+            importer.import_grades(s, args.grades, report)
+    if args.report and report.errors:
+        report.write(args.report)
+    for line, message in report.errors:
+        print('  Zeile {}: {}'.format(line, message), file=sys.stderr)
+    return str(report)
+
+
+def cmd_export(args, path):
+    from . import export
+    if args.writer is None:
+        args.writer = export.get_writer(args.output)
+    with open_db(path, args) as s:
+        count = export.export(s, args.writer, args.batch_size)
+    return '{} Noten exportiert'.format(count)
+
+
+def finish_export(args):
+    if args.writer is not None:
+        args.writer.close()
+
+
+def run_aggregate(args):
+    from . import aggregate
+    paths = list(find_databases(args.databases))
+    cache = None if args.no_cache else aggregate.Cache()
+    results, errors = aggregate.aggregate(
+        paths, workers=args.workers, cache=cache, **credentials(args)
+    )
+    for path, error in errors:
+        print('{}: FEHLER {}'.format(path, error), file=sys.stderr)
+    rows = aggregate.merge(results, args.job)
+    fields = ['job', 'course', 'groups', 'students', 'total', 'practice',
+              'theory']
+    if args.output:
+        fp = open(args.output, 'w', newline='', encoding='utf-8')
+    else:
+        fp = sys.stdout
+    try:
+        writer = csv.DictWriter(fp, fields, delimiter=';')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({
+                k: round(v, 2) if isinstance(v, float) else v
+                for k, v in row.items()
+            })
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+    return 1 if errors else 0
+
+
+def run_benchmark(args):
+    from . import bench
+    results = bench.run(
+        args.scales, args.repeat,
+        progress=lambda g: print('{} Gruppen ...'.format(g), file=sys.stderr)
+    )
+    for scale, benchmarks in results['results'].items():
+        for name, stats in sorted(benchmarks.items()):
+            if isinstance(stats, dict):
+                print('{:>4} {:12} {:9.1f} ms'.format(
+                    scale, name, stats['median'] * 1000
+                ))
+    if args.output:
+        bench.save(results, args.output)
+    if not args.baseline:
+        return 0
+    rows = bench.compare(results, bench.load(args.baseline))
+    for scale, name, before, now, ratio in rows:
+        print('{:>4} {:12} {:9.1f} ms -> {:9.1f} ms ({:+.0%})'.format(
+            scale, name, before * 1000, now * 1000, ratio - 1
+        ))
+    slower = bench.regressions(rows, args.threshold)
+    for scale, name, *_ in slower:
+        print('LANGSAMER: {} bei {} Gruppen'.format(name, scale),
+              file=sys.stderr)
+    return 1 if slower else 0
+
+
+def run_gui_benchmark(args):
+    from . import bench_gui
+    results = bench_gui.run(
+        args.scales, args.repeat,
+        progress=lambda g: print('{} Gruppen ...'.format(g), file=sys.stderr)
+    )
+    print('{:>4} {:12} {:>9} {:>7} {:>10} {:>7}'.format(
+        'Gr.', 'Fenster', 'Zeit', 'SQL', 'Speicher', 'Budget'
+    ))
+    for scale, actions in results.items():
+        for name, stats in actions.items():
+            print('{:>4} {:12} {:6.1f} ms {:7.0f} {:7.0f} KB {:4} ms'.format(
+                scale, name, stats['seconds'] * 1000, stats['queries'],
+                stats['allocated'] / 1024,
+                bench_gui.BUDGETS.get(name, '-')
+            ))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+    slow = bench_gui.over_budget(results)
+    for scale, name, ms, budget in slow:
+        print('ZU LANGSAM: {} bei {} Gruppen ({:.0f} > {} ms)'.format(
+            name, scale, ms, budget
+        ), file=sys.stderr)
+    return 1 if slow else 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='gman', description='bbz Notenmanager ohne Oberfläche'
+    )
+    auth = parser.add_mutually_exclusive_group()
+    auth.add_argument('-k', '--keyfile', help='Schlüsseldatei')
+    auth.add_argument('-p', '--password',
+                      help='Passwort (oder Umgebungsvariable GMAN_PASSWORD)')
+    parser.add_argument('--generations', type=int, default=0, metavar='N',
+                        help='beim Schreiben N ältere Versionen behalten')
+    parser.add_argument('--compression', default='zlib',
+                        choices=sorted(container.COMPRESSIONS),
+                        help='Kompression beim Schreiben (Standard: zlib)')
+    parser.add_argument('--takeover', action='store_true',
+                        help='verwaiste Sperren übernehmen')
+    parser.add_argument('--sql-profile', action='store_true',
+                        help='SQL-Anweisungen messen und auf stderr ausgeben')
+    parser.add_argument('--trace', metavar='JSON',
+                        help='Zeitabschnitte als Chrome Trace speichern')
+    commands = parser.add_subparsers(dest='command', metavar='BEFEHL')
+    commands.required = True
+
+    def add(name, func, help_):
+        sub = commands.add_parser(name, help=help_)
+        sub.add_argument('databases', nargs='+', metavar='DATEI',
+                         help='.gmandb Dateien oder Verzeichnisse')
+        sub.set_defaults(func=func)
+        return sub
+
+    add('check', cmd_check, 'Dateien entschlüsseln und prüfen')
+    add('recompute', cmd_recompute,
+        'Konferenz-Zusammenfassungen neu berechnen')
+    sub = add('render', cmd_render, 'Notenübersichten als HTML erzeugen')
+    sub.add_argument('-o', '--output', default='.',
+                     help='Zielverzeichnis (Standard: .)')
+    sub = add('import', cmd_import,
+              'Teilnehmer und Noten aus CSV/XLSX importieren')
+    sub.add_argument('--students', metavar='TABELLE',
+                     help='Teilnehmerliste (Nachname, Vorname, Firma)')
+    sub.add_argument('--grades', metavar='TABELLE', help='Notenliste')
+    sub.add_argument('--report', metavar='CSV',
+                     help='Fehlerbericht in diese Datei schreiben')
+    sub = add('export', cmd_export,
+              'Alle Noten in eine Datei (.csv, .json, .parquet) exportieren')
+    sub.add_argument('-o', '--output', required=True, metavar='DATEI',
+                     help='Zieldatei, das Format ergibt sich aus der Endung')
+    sub.add_argument('--batch-size', type=int, default=1000,
+                     help='Zeilen pro Block (Standard: 1000)')
+    sub.set_defaults(writer=None, finish=finish_export)
+    sub = add('aggregate', None,
+              'Durchschnitte je Kurs über viele Gruppen berechnen')
+    sub.add_argument('-o', '--output', metavar='CSV',
+                     help='Ergebnis in Datei statt auf die Konsole')
+    sub.add_argument('--job', help='nur Gruppen dieses Berufs (z. B. CL)')
+    sub.add_argument('--workers', type=int,
+                     help='Anzahl Prozesse (Standard: Anzahl CPUs)')
+    sub.add_argument('--no-cache', action='store_true',
+                     help='Zwischenspeicher nicht verwenden')
+    sub.set_defaults(run=run_aggregate)
+    sub = commands.add_parser('benchmark',
+                              help='Verschlüsselung und Datenbank messen')
+    sub.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                     metavar='GRUPPEN', help='Größen (Standard: 1 10 100)')
+    sub.add_argument('--repeat', type=int, default=3,
+                     help='Wiederholungen (Standard: 3)')
+    sub.add_argument('-o', '--output', metavar='JSON',
+                     help='Ergebnisse in diese Datei schreiben')
+    sub.add_argument('--baseline', metavar='JSON',
+                     help='mit früheren Ergebnissen vergleichen')
+    sub.add_argument('--threshold', type=float, default=0.25,
+                     help='erlaubte Verlangsamung (Standard: 0.25)')
+    sub.set_defaults(run=run_benchmark)
+    sub = commands.add_parser('gui-benchmark',
+                              help='Öffnen der Fenster messen (ohne Display)')
+    sub.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                     metavar='GRUPPEN', help='Größen (Standard: 1 10)')
+    sub.add_argument('--repeat', type=int, default=3,
+                     help='Wiederholungen (Standard: 3)')
+    sub.add_argument('-o', '--output', metavar='JSON',
+                     help='Ergebnisse in diese Datei schreiben')
+    sub.set_defaults(run=run_gui_benchmark)
+    return parser
+
+
+def run_commands(args):
+    run = getattr(args, 'run', None)
+    if run is not None:
+        with tracing.action(args.command), sqlprofile.action(args.command):
+            return run(args)
+    failed = 0
+    for path in find_databases(args.databases):
+        try:
+            name = '{} {}'.format(args.command, path)
+            with tracing.action(name), sqlprofile.action(name):
+                message = args.func(args, path)
+        except Exception as error:
+            failed += 1
+            print('{}: FEHLER {}'.format(path, error), file=sys.stderr)
+        else:
+            print('{}: {}'.format(path, message))
+    finish = getattr(args, 'finish', None)
+    if finish is not None:
+        finish(args)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if args.trace:
+        tracing.enable()
+    if args.sql_profile:
+        sqlprofile.enable()
+    try:
+        return run_commands(args)
+    finally:
+        if args.trace:
+            tracing.save(args.trace)
+        if args.sql_profile:
+            print(sqlprofile.get_profiler().format_report(), file=sys.stderr)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from sqlalchemy.orm import joinedload
+
+from . import db, grades
+
+
+def grade_count(session, until):
+    """Number of grades belonging to experiments/tests done until `until`."""
+    practice = session.query(sa.func.count(db.PracticeGrade.pk)).join(
+        db.PracticeGrade.experiment
+    ).filter(db.Experiment.done_on <= until).scalar()
+    theory = session.query(sa.func.count(db.TheoryGrade.pk)).join(
+        db.TheoryGrade.test
+    ).filter(db.Test.done_on <= until).scalar()
+    return practice + theory
+
+
+def inputs_signature(session):
+    """SHA-256 over everything besides the grades the standings use.
+
+    Covers weights, max points, dates and course of experiments and tests
+    and the start of courses, edits of these do not touch any grade.
+    """
+    queries = (
+        session.query(db.Experiment.pk, db.Experiment.course_id,
+                      db.Experiment.done_on, db.Experiment.weight,
+                      db.Experiment.weight_method,
+                      db.Experiment.weight_result,
+                      db.Experiment.weight_docs).order_by(db.Experiment.pk),
+        session.query(db.Test.pk, db.Test.course_id, db.Test.done_on,
+                      db.Test.weight, db.Test.max_points).order_by(db.Test.pk),
+        session.query(db.Course.pk, db.Course.start).order_by(db.Course.pk),
+    )
+    digest = hashlib.sha256()
+    for query in queries:
+        for row in query:
+            digest.update(repr(tuple(row)).encode('utf-8'))
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def is_stale(session, conference):
+    """Check if grades relevant for `conference` changed after its snapshot.
+
+    Grades recorded after the snapshot only matter if they belong to an
+    experiment or test done until `grades_til`. Deleted grades are caught
+    by comparing the number of relevant grades, edited experiments, tests
+    and courses by inputs_signature().
+    """
+    snapshot = conference.snapshot
+    if snapshot is None:
+        return True
+    til = conference.grades_til
+    if grade_count(session, til) != snapshot.grade_count:
+        return True
+    if inputs_signature(session) != snapshot.inputs:
+        return True
+    practice = session.query(db.PracticeGrade.pk).join(
+        db.PracticeGrade.experiment
+    ).filter(
+        db.PracticeGrade.recorded > snapshot.computed,
+        db.Experiment.done_on <= til
+    )
+    theory = session.query(db.TheoryGrade.pk).join(
+        db.TheoryGrade.test
+    ).filter(
+        db.TheoryGrade.recorded > snapshot.computed,
+        db.Test.done_on <= til
+    )
+    return session.query(practice.union_all(theory).exists()).scalar()
+
+
+def compute(session, conference):
+    """Standings of all students as of `grades_til` as list of dicts."""
+    til = conference.grades_til
+    rows = []
+    courses = session.query(db.Course).filter(db.Course.start <= til)
+    for course in courses:
+        standings = grades.course_standings(session, course, til)
+        for student_id, standing in standings.items():
+            rows.append(dict(
+                conference_id=conference.pk, student_id=student_id,
+                course_id=course.pk, practice=standing.practice,
+                theory=standing.theory, total=standing.total
+            ))
+    return rows
+
+
+def refresh(session, conference):
+    """Materialize the standings of all students as of `grades_til`."""
+    computed = datetime.now()
+    til = conference.grades_til
+    session.query(db.ConferenceGrade).filter(
+        db.ConferenceGrade.conference_id == conference.pk
+    ).delete(synchronize_session=False)
+    rows = compute(session, conference)
+    if rows:
+        session.bulk_insert_mappings(db.ConferenceGrade, rows)
+    if conference.snapshot is None:
+        conference.snapshot = db.ConferenceSnapshot()
+    conference.snapshot.computed = computed
+    conference.snapshot.grade_count = grade_count(session, til)
+    conference.snapshot.inputs = inputs_signature(session)
+    session.commit()
+
+
+def students(session, conference, persist=True):
+    """(student, ConferenceStudent) of the conference, sorted by name.
+
+    Independent of the snapshot: students added to the group later are
+    included, they get a ConferenceStudent for their note. Without
+    `persist` (read-only databases) these rows are not stored.
+    """
+    rows = session.query(db.ConferenceStudent).options(
+        joinedload(db.ConferenceStudent.student)
+    ).filter(db.ConferenceStudent.conference_id == conference.pk).all()
+    result = [(cs.student, cs) for cs in rows]
+    known = {cs.student_id for cs in rows}
+    added = False
+    for student in session.query(db.Student).filter(
+            db.Student.show.is_(True)):
+        if student.pk not in known:
+            cs = db.ConferenceStudent(conference_id=conference.pk,
+                                      student_id=student.pk)
+            if persist:
+                session.add(cs)
+                added = True
+            result.append((student, cs))
+    if added:
+        session.commit()
+    result.sort(key=lambda pair: pair[0].fullname)
+    return result
+
+
+def snapshot(session, conference, force=False, persist=True):
+    """Return the materialized grades as dict (student pk, course pk) -> row.
+
+    The snapshot is only recomputed if it is missing, outdated or `force`
+    is set. Reopening a conference then costs the checks of is_stale()
+    (grade count, inputs signature, newer grades) and one query for the
+    stored rows instead of computing all standings. Without
+    `persist` (read-only databases) a recomputed snapshot is returned as
+    transient rows and not stored.
+    """
+    if force or is_stale(session, conference):
+        if not persist:
+            return {
+                (row['student_id'], row['course_id']): db.ConferenceGrade(
+                    **row
+                ) for row in compute(session, conference)
+            }
+        refresh(session, conference)
+    q = session.query(db.ConferenceGrade).filter(
+        db.ConferenceGrade.conference_id == conference.pk
+    )
+    return {(g.student_id, g.course_id): g for g in q}
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Compressed, chunked container format (version 2) of .gmandb files.
+
+Layout after the 25 byte salt, which stays in front for the password
+key derivation of both versions:
+
+    b'GMAN' | version (1 byte) | compression (1 byte) | nonce prefix (8)
+    chunks: length (4 bytes, big endian) | AES-GCM ciphertext and tag
+
+The database image is compressed (zlib, or zstd if installed and
+chosen) and the compressed stream is encrypted in chunks of CHUNK_SIZE.
+The AES key is derived with HKDF from the Fernet key of the handler, so
+keyfiles and passwords stay valid. The nonce of a chunk is the prefix
+plus the chunk number; the authenticated data is the header, the chunk
+number and a flag marking the last chunk, so chunks can neither be
+reordered nor cut off. Version 1 files are a single Fernet token.
+"""
+
+import base64
+import os
+import struct
+import zlib
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'GMAN'
+VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+NONE, ZLIB, ZSTD = 0, 1, 2
+COMPRESSIONS = {'none': NONE, 'zlib': ZLIB, 'zstd': ZSTD}
+
+_HEADER = struct.Struct('>4sBB8s')
+_LENGTH = struct.Struct('>I')
+_AAD = struct.Struct('>IB')
+
+
+class ContainerError(Exception):
+    pass
+
+
+def is_container(data):
+    """True if `data` (the file content after the salt) is version 2."""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def derive_key(fernet_key):
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None,
+        info=b'gman container v2', backend=default_backend()
+    ).derive(base64.urlsafe_b64decode(fernet_key))
+
+
+def _compressor(compression):
+    if compression == ZLIB:
+        return zlib.compressobj(ZLIB_LEVEL)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ContainerError('zstd benötigt das Paket zstandard.')
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return None
+
+
+def _decompressor(compression):
+    if compression == ZLIB:
+        return zlib.decompressobj()
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ContainerError('Die Datei ist mit zstd komprimiert, '
+                                 'dafür wird das Paket zstandard benötigt.')
+        return zstandard.ZstdDecompressor().decompressobj()
+    if compression == NONE:
+        return None
+    raise ContainerError('Unbekannte Kompression {}'.format(compression))
+
+
+def _compressed(data, compression):
+    compressor = _compressor(compression)
+    if compressor is None:
+        yield data
+        return
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        out = compressor.compress(view[start:start + CHUNK_SIZE])
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def _chunks(pieces):
+    """Regroup a stream of byte strings to CHUNK_SIZE chunks."""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer[:CHUNK_SIZE])
+            del buffer[:CHUNK_SIZE]
+    yield bytes(buffer)
+
+
+def encode(data, fernet_key, compression='zlib'):
+    """Yield the container for `data` piece by piece (without salt)."""
+    compression = COMPRESSIONS[compression]
+    header = _HEADER.pack(MAGIC, VERSION, compression, os.urandom(8))
+    yield header
+    aes = AESGCM(derive_key(fernet_key))
+    prefix = header[-8:]
+    chunks = _chunks(_compressed(data, compression))
+    chunk = next(chunks)
+    number = 0
+    for following in chunks:
+        yield _seal(aes, header, prefix, number, chunk, False)
+        chunk = following
+        number += 1
+    yield _seal(aes, header, prefix, number, chunk, True)
+
+
+def _seal(aes, header, prefix, number, chunk, final):
+    nonce = prefix + struct.pack('>I', number)
+    sealed = aes.encrypt(nonce, chunk, header + _AAD.pack(number, final))
+    return _LENGTH.pack(len(sealed)) + sealed
+
+
+def decode(data, fernet_key):
+    """Yield the plaintext of a container piece by piece.
+
+    Raises ContainerError for damaged or truncated files and for a wrong
+    key (cryptography's InvalidTag).
+    """
+    view = memoryview(data)
+    if len(view) < _HEADER.size:
+        raise ContainerError('Datei ist zu kurz.')
+    magic, version, compression, prefix = _HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise ContainerError('Unbekanntes Dateiformat.')
+    header = bytes(view[:_HEADER.size])
+    decompressor = _decompressor(compression)
+    aes = AESGCM(derive_key(fernet_key))
+    offset = _HEADER.size
+    number = 0
+    while True:
+        if offset + _LENGTH.size > len(view):
+            raise ContainerError('Datei ist unvollständig.')
+        length, = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        sealed = view[offset:offset + length]
+        offset += length
+        final = offset == len(view)
+        nonce = prefix + struct.pack('>I', number)
+        try:
+            chunk = aes.decrypt(nonce, bytes(sealed),
+                                header + _AAD.pack(number, final))
+        except Exception:
+            raise ContainerError('Passwort oder Keyfile stimmt nicht oder '
+                                 'die Datei ist beschädigt.')
+        if decompressor is None:
+            yield chunk
+        else:
+            yield decompressor.decompress(chunk)
+        if final:
+            break
+        number += 1
+    if decompressor is not None and hasattr(decompressor, 'flush'):
+        yield decompressor.flush()
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import base64
+import hashlib
+import json
 import os
 import pathlib
+import shutil
+import socket
+import sqlite3
+import threading
+import time
 
 from getpass import getuser
 from tempfile import TemporaryDirectory
@@ -12,14 +19,182 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from . import container, tracing
+
 
 def create_keyfile(path):
     with open(path, 'wb') as fp:
         fp.write(Fernet.generate_key())
 
 
+def derive_key(password, salt):
+    if not isinstance(password, bytes):
+        password = bytes(password, 'utf-8')
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256,
+        length=32,
+        salt=salt,
+        iterations=150000,
+        backend=default_backend()
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+
+def fsync_dir(path):
+    """Persist a rename in `path`, not possible (and needed) on Windows."""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def rotate(path, generations):
+    """Keep the current `path` as path.1, path.1 as path.2 and so on."""
+    path = pathlib.Path(path)
+    if generations <= 0 or not path.exists():
+        return
+    for n in range(generations - 1, 0, -1):
+        older = path.with_name(f'{path.name}.{n}')
+        if older.exists():
+            os.replace(older, path.with_name(f'{path.name}.{n + 1}'))
+    newest = path.with_name(f'{path.name}.1')
+    try:
+        os.link(path, newest)
+    except FileExistsError:
+        os.unlink(newest)
+        os.link(path, newest)
+    except OSError:
+        # file systems without hard links (some network shares)
+        shutil.copy2(path, newest)
+
+
+def _plaintext(data, key):
+    """Yield the plaintext of the file content after the salt.
+
+    Handles both formats, the chunked container (version 2) and the
+    single Fernet token of older files.
+    """
+    if container.is_container(data):
+        yield from container.decode(data, key)
+    else:
+        yield Fernet(key).decrypt(bytes(data))
+
+
+def decrypt_file(crypted_filename, keyfile=None, password=None):
+    """Return the plaintext of an encrypted database.
+
+    The file is neither locked nor written, use this only for reading.
+    """
+    with open(crypted_filename, 'rb') as fp:
+        salt = fp.read(25)
+        data = fp.read()
+    if keyfile is not None:
+        with open(keyfile, 'rb') as fp:
+            key = fp.read()
+    elif password is not None:
+        key = derive_key(password, salt)
+    else:
+        raise SetupError('You must provide keyfile or password.')
+    if not data:
+        return b''
+    try:
+        return b''.join(_plaintext(data, key))
+    except Exception:
+        raise CryptoKeyError('Passwort oder Keyfile stimmt nicht. '
+                             'Datei kann nicht entschlüsselt werden.')
+
+
+# lock files are refreshed every HEARTBEAT seconds, a lock without
+# refresh for STALE_AFTER seconds is considered abandoned
+HEARTBEAT = 30
+STALE_AFTER = 120
+
+
 class SetupError(Exception):
     user = ''
+    stale = False
+    lock_info = None
+
+
+class LockLostError(SetupError):
+    """The lock was taken over by somebody else, nothing is written."""
+
+
+def read_lock(lockfile):
+    """Return the lock owner as dict (user, host, pid, heartbeat).
+
+    Old lock files contain only the user name, host, pid and heartbeat
+    are None then.
+    """
+    with open(lockfile, encoding='utf-8') as fp:
+        text = fp.read()
+    try:
+        info = json.loads(text)
+    except ValueError:
+        info = None
+    if not isinstance(info, dict):
+        info = dict(user=text.strip())
+    for key in ('user', 'host', 'pid', 'heartbeat'):
+        info.setdefault(key, None)
+    return info
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def is_stale(info, now=None):
+    """Check if the owner of a lock is gone.
+
+    A lock is stale if its process is dead (only checkable on the same
+    host, not on Windows) or its heartbeat is older than STALE_AFTER.
+    Old style locks without heartbeat are never considered stale.
+    """
+    if info['heartbeat'] is None:
+        return False
+    if (info['host'] == socket.gethostname() and info['pid'] and
+            os.name != 'nt' and not _pid_alive(info['pid'])):
+        return True
+    now = time.time() if now is None else now
+    return now - info['heartbeat'] > STALE_AFTER
+
+
+class Heartbeat(threading.Thread):
+    """Refreshes the heartbeat of a lock file until stopped."""
+
+    def __init__(self, handler, interval=None):
+        threading.Thread.__init__(self, name='gman-heartbeat', daemon=True)
+        self.handler = handler
+        self.interval = HEARTBEAT if interval is None else interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.handler.owns_lock():
+                    self.handler.lock_failed(LockLostError(
+                        'Sperre wurde übernommen: {}'.format(
+                            self.handler.lockfile
+                        )
+                    ))
+                    return
+                self.handler.write_lock()
+            except OSError as error:
+                self.handler.lock_failed(SetupError(
+                    'Sperre konnte nicht erneuert werden: {}'.format(error)
+                ))
+
+    def stop(self):
+        self.stopped.set()
 
 
 class CryptoKeyError(Exception):
@@ -39,39 +214,174 @@ class KeyStore:
 
 
 class CryptedDBHandler:
+    """Decrypts a database to a temporary file and encrypts it back.
 
-    def __init__(self, crypted_filename, keyfile=None, password=None):
+    With `read_only` the database is not locked, the plaintext copy is
+    opened read-only/immutable by SQLite and close() just discards it.
+    Any number of read-only handlers may open a file while somebody else
+    is editing it. With `generations` > 0 that many previous versions of
+    the encrypted file are kept as <name>.gmandb.1, .2, ...
+
+    Files are written as compressed container (see the module container)
+    with `compression` 'zlib', 'zstd' or 'none'. Files of the older
+    format (one Fernet token) are still read and converted on write.
+
+    The lock file records user, host, pid and a heartbeat refreshed in a
+    background thread. A stale lock (see is_stale) is only replaced if
+    `takeover` is set, otherwise a SetupError with stale=True is raised.
+    Problems of the heartbeat are kept in `lock_error` and passed to the
+    callable `on_lock_error` (called from the heartbeat thread). Once the
+    lock is lost, checkpoint() and encrypt() raise LockLostError instead
+    of overwriting the file of the new owner.
+    """
+
+    @tracing.traced('crypto.open')
+    def __init__(self, crypted_filename, keyfile=None, password=None,
+                 read_only=False, generations=0, takeover=False,
+                 compression='zlib'):
         if keyfile is None and password is None:
             raise SetupError('You must provide keyfile or password.')
         self.user = getuser() or 'unknown'
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.heartbeat = None
+        self.lock_error = None
+        self.on_lock_error = None
         self.crypted = pathlib.Path(crypted_filename)
+        self.read_only = read_only
+        self.generations = generations
+        if compression not in container.COMPRESSIONS:
+            raise SetupError(f'Unbekannte Kompression {compression}.')
+        self.compression = compression
         self._salt = os.urandom(25)
         if not self.crypted.exists():
+            if read_only:
+                raise SetupError(f'Datei {self.crypted} existiert nicht.')
             self._create_crypted_file()
         if keyfile is not None:
-            if not os.path.exists(keyfile):
+            if not os.path.exists(keyfile) and not read_only:
                 create_keyfile(keyfile)
             self.store = self._read_token_from_file(keyfile)
         else:
             self.store = self._make_token(password)
-        self.lockfile = self.lock()
+        self.lockfile = None if read_only else self.lock(takeover)
         self.tmp = TemporaryDirectory(suffix='-gman')
         self.db_path = pathlib.Path(self.tmp.name, f'gman-{self.user}.sqlite')
         self.useable = False
+        self._digest = None
+        self._write_lock = threading.Lock()
+
+    def _lock_data(self):
+        return json.dumps(dict(user=self.user, host=self.host, pid=self.pid,
+                               heartbeat=time.time()))
 
-    def lock(self):
+    def lock(self, takeover=False):
         lockfile = self.crypted.with_suffix('.lock')
         try:
-            with lockfile.open('x') as fp:
-                fp.write(self.user)
-            return lockfile
+            self._create_lock(lockfile)
         except FileExistsError:
-            with lockfile.open() as fp:
-                user = fp.read()
-            error = SetupError(f'Datenbank gesperrt von {user}.')
-            error.user = user
+            info = read_lock(lockfile)
+            stale = is_stale(info)
+            if not (stale and takeover and self._break_lock(lockfile, info)):
+                raise self._locked_error(info, stale)
+            try:
+                self._create_lock(lockfile)
+            except FileExistsError:
+                # another contender was faster
+                raise self._locked_error(read_lock(lockfile), False)
+        self.lockfile = lockfile
+        self.heartbeat = Heartbeat(self)
+        self.heartbeat.start()
+        return lockfile
+
+    @staticmethod
+    def _locked_error(info, stale):
+        owner = info['user']
+        if info['host']:
+            owner = '{}@{}'.format(owner, info['host'])
+        if stale:
+            msg = 'Verwaiste Sperre von {}.'
+        else:
+            msg = 'Datenbank gesperrt von {}.'
+        error = SetupError(msg.format(owner))
+        error.user = info['user']
+        error.stale = stale
+        error.lock_info = info
+        return error
+
+    def _create_lock(self, lockfile):
+        with lockfile.open('x', encoding='utf-8') as fp:
+            fp.write(self._lock_data())
+
+    def _break_lock(self, lockfile, info):
+        """Remove the stale lock `info`, only one contender succeeds.
+
+        If the file renamed away is not `info` any more, a faster
+        contender has replaced it with a fresh lock, which is restored.
+        """
+        grave = lockfile.with_name(f'{lockfile.name}.{self.host}.{self.pid}')
+        try:
+            os.rename(lockfile, grave)
+        except OSError:
+            return False
+        try:
+            renamed = read_lock(grave)
+        except OSError:
+            return False
+        if renamed != info:
+            try:
+                os.link(grave, lockfile)
+            except FileExistsError:
+                pass
+            except OSError:
+                # file systems without hard links
+                if not lockfile.exists():
+                    os.rename(grave, lockfile)
+                    return False
+            os.unlink(grave)
+            return False
+        os.unlink(grave)
+        return True
+
+    def write_lock(self):
+        tmp = self.lockfile.with_name(self.lockfile.name + '.tmp')
+        tmp.write_text(self._lock_data(), encoding='utf-8')
+        os.replace(tmp, self.lockfile)
+
+    def owns_lock(self):
+        try:
+            info = read_lock(self.lockfile)
+        except OSError:
+            return False
+        return info['host'] == self.host and info['pid'] == self.pid
+
+    def lock_failed(self, error):
+        self.lock_error = error
+        if self.on_lock_error is not None:
+            self.on_lock_error(str(error))
+
+    def check_lock(self):
+        """Raise LockLostError if the lock belongs to somebody else."""
+        if isinstance(self.lock_error, LockLostError):
+            raise self.lock_error
+        if not self.owns_lock():
+            error = LockLostError(
+                'Die Sperre von {} wurde übernommen, die Datei wird nicht '
+                'geschrieben.'.format(self.crypted.name)
+            )
+            self.lock_error = error
             raise error
 
+    def unlock(self):
+        if self.lockfile is None:
+            return
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+            self.heartbeat.join()
+            self.heartbeat = None
+        if self.owns_lock():
+            self.lockfile.unlink()
+
     def _create_crypted_file(self):
         with self.crypted.open('wb') as fp:
             fp.write(self._salt)
@@ -83,27 +393,22 @@ class CryptedDBHandler:
     def _make_token(self, password):
         with self.crypted.open('rb') as fp:
             self._salt = fp.read(25)
-        if not isinstance(password, bytes):
-            password = bytes(password, 'utf-8')
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256,
-            length=32,
-            salt=self._salt,
-            iterations=150000,
-            backend=default_backend()
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password))
-        return KeyStore(key)
+        return KeyStore(derive_key(password, self._salt))
 
+    @tracing.traced('crypto.decrypt')
     def decrypt(self):
         with self.crypted.open('rb') as fp:
             fp.seek(25)
             data = fp.read()
+        self._digest = None
         if data:
-            f = Fernet(self.store.key)
+            digest = hashlib.sha256()
             try:
                 with self.db_path.open('wb') as fp:
-                    fp.write(f.decrypt(data))
+                    for piece in _plaintext(data, self.store.key):
+                        fp.write(piece)
+                        digest.update(piece)
+                self._digest = digest.digest()
             except Exception as error:
                 self.useable = False
                 print('Error:', error)
@@ -112,13 +417,130 @@ class CryptedDBHandler:
         self.useable = True
         return self.db_path
 
-    def encrypt(self):
-        with self.db_path.open('rb') as fp:
-            data = fp.read()
+    @property
+    def connection_string(self):
+        if self.read_only:
+            return 'sqlite:///{}?mode=ro&immutable=1&uri=true'.format(
+                self.db_path.as_uri()
+            )
+        return 'sqlite:///{}'.format(self.db_path)
+
+    @property
+    def profile(self):
+        """Engine profile for db.get_session()."""
+        return 'read_only' if self.read_only else 'scratch'
+
+    def _snapshot(self):
+        """Consistent copy of the plaintext database via the backup API."""
+        source = sqlite3.connect(str(self.db_path))
+        try:
+            if hasattr(sqlite3.Connection, 'serialize'):
+                target = sqlite3.connect(':memory:')
+                source.backup(target)
+                data = target.serialize()
+                target.close()
+                return data
+            path = self.db_path.with_suffix('.checkpoint')
+            target = sqlite3.connect(str(path))
+            source.backup(target)
+            target.close()
+            data = path.read_bytes()
+            path.unlink()
+            return data
+        finally:
+            source.close()
+
+    def _write(self, data, target=None, generations=None):
+        """Replace the encrypted file atomically, if the lock is ours.
+
+        The new content goes to a temp file in the same directory, which
+        is synced and renamed over the old file. A crash leaves either the
+        old or the new file, never a truncated one. With `target` another
+        file is written and the lock is not checked.
+        """
+        if target is None:
+            self.check_lock()
+            target = self.crypted
+            generations = self.generations
+        tmp = target.with_name(target.name + '.tmp')
+        try:
+            with tmp.open('wb') as fp:
+                fp.write(self._salt)
+                for piece in container.encode(data, self.store.key,
+                                              self.compression):
+                    fp.write(piece)
+                fp.flush()
+                os.fsync(fp.fileno())
+            rotate(target, generations or 0)
+            os.replace(tmp, target)
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+        fsync_dir(target.parent)
+
+    def save_copy(self, path):
+        """Encrypt the open database to `path` with the same key.
+
+        For a database whose lock was taken over: the edits can be kept
+        in another file, which opens with the same password or keyfile.
+        """
+        target = pathlib.Path(path)
+        if target.resolve() == self.crypted.resolve():
+            raise SetupError('Die Kopie muss eine andere Datei sein.')
+        with self._write_lock:
+            self._write(self._snapshot(), target)
+
+    @tracing.traced('crypto.checkpoint')
+    def checkpoint(self):
+        """Write a snapshot of the open database to the encrypted file.
+
+        Safe to call from a worker thread while the database is in use,
+        the lock is kept. Returns True if the file was written.
+        """
+        if self.read_only or not self.useable:
+            return False
+        self.check_lock()
+        with self._write_lock:
+            # the digest only detects changes, what is written is the
+            # consistent snapshot taken afterwards
+            digest = hashlib.sha256(self.db_path.read_bytes()).digest()
+            if digest == self._digest:
+                return False
+            self._write(self._snapshot())
+            self._digest = digest
+        return True
+
+    @tracing.traced('crypto.encrypt')
+    def encrypt(self, force=False):
+        """Write the database back and unlock it.
+
+        If the plaintext is unchanged since decrypt() the encrypted file is
+        left alone and only the lock is released. Returns True if the file
+        was written.
+        """
+        if self.read_only:
+            raise SetupError('Datenbank ist schreibgeschützt geöffnet.')
+        with self._write_lock:
+            with self.db_path.open('rb') as fp:
+                data = fp.read()
+            changed = force or hashlib.sha256(data).digest() != self._digest
+            if changed:
+                self._write(data)
+            # only now, a failed write keeps the working copy
+            self.tmp.cleanup()
+        self.unlock()
+        self.useable = False
+        return changed
+
+    def release(self):
+        """Discard the plaintext copy and unlock without writing back."""
         self.tmp.cleanup()
-        f = Fernet(self.store.key)
-        with self.crypted.open('wb') as fp:
-            fp.write(self._salt)
-            fp.write(f.encrypt(data))
-        self.lockfile.unlink()
+        self.unlock()
         self.useable = False
+
+    def close(self):
+        if self.read_only:
+            self.release()
+            return False
+        return self.encrypt()
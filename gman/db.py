@@ -5,22 +5,172 @@ import sqlalchemy as sa
 from datetime import datetime
 from getpass import getuser
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import Session, relationship, sessionmaker
+
+from . import blobs, history, search
 
 
 Base = declarative_base()
 
 
-def get_session(connection_string='sqlite:///:memory:', echo=False):
+# PRAGMAs applied to every new SQLite connection. The decrypted database
+# is a scratch copy, durability is provided by the encrypted container,
+# so journaling and syncing are relaxed for it.
+PROFILES = {
+    'scratch': dict(
+        journal_mode='MEMORY', synchronous='OFF', cache_size=-32000,
+        mmap_size=268435456, temp_store='MEMORY', foreign_keys='ON',
+    ),
+    'durable': dict(
+        journal_mode='DELETE', synchronous='FULL', temp_store='MEMORY',
+        foreign_keys='ON',
+    ),
+    'read_only': dict(
+        cache_size=-32000, mmap_size=268435456, temp_store='MEMORY',
+        foreign_keys='ON',
+    ),
+}
+
+
+def get_engine(connection_string='sqlite:///:memory:', echo=False,
+               profile='scratch'):
+    """Create an engine, `profile` is a name from PROFILES or a dict."""
     engine = sa.create_engine(connection_string, echo=echo)
-    return sessionmaker(bind=engine)
+    pragmas = PROFILES[profile] if isinstance(profile, str) else profile
+    if engine.dialect.name == 'sqlite' and pragmas:
+
+        @sa.event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+            cursor.close()
+
+    return engine
+
+
+def get_session(connection_string='sqlite:///:memory:', echo=False,
+                profile='scratch', **kw):
+    """Return a sessionmaker bound to a new engine.
+
+    Further keyword arguments (e.g. expire_on_commit) are passed to the
+    sessionmaker.
+    """
+    return sessionmaker(bind=get_engine(connection_string, echo, profile),
+                        **kw)
 
 
 def create_tables(session):
-    Base.metadata.create_all(session.connection())
+    connection = session.connection()
+    Base.metadata.create_all(connection)
+    blobs.install(connection)
+    history.install(connection)
+    search.install(connection)
+
+
+def add_columns(connection):
+    """Add nullable columns missing in tables of older databases."""
+    inspector = sa.inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name,
+                    column.type.compile(connection.dialect)
+                ))
+
+
+def upgrade_schema(session):
+    """Add tables, columns and indexes introduced after a database was
+    created.
+
+    Photos and logos of old databases are moved to the blob table, the
+    database is vacuumed afterwards to release their space.
+    """
+    connection = session.connection()
+    Base.metadata.create_all(connection)
+    blobs.install(connection)
+    add_columns(connection)
+    inspector = sa.inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+    moved = blobs.migrate(connection)
+    blobs.collect(connection)
+    history.install(connection)
+    history.checkpoint(connection)
+    search.install(connection)
+    session.commit()
+    if moved:
+        session.connection().execute('VACUUM')
+        session.commit()
+
+
+def upgrade_file(path):
+    """upgrade_schema() for a plaintext copy opened read-only later on."""
+    engine = get_engine('sqlite:///{}'.format(path))
+    session = Session(bind=engine)
+    try:
+        upgrade_schema(session)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def _blob_property(relation):
+    def get(self):
+        blob = getattr(self, relation)
+        return None if blob is None else blob.data
+
+    def set_(self, data):
+        setattr(self, relation, Blob.from_data(data) if data else None)
+
+    return property(get, set_)
 
 
 # ORM classes
+class Blob(Base):
+    """Bytes stored once per content, see blobs."""
+    __tablename__ = 'blobs'
+
+    hash = sa.Column(sa.String(64), primary_key=True)
+    data = sa.Column(sa.LargeBinary, nullable=False)
+    refcount = sa.Column(sa.Integer, nullable=False, default=0)
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(hash=blobs.digest(data), data=data)
+
+
+@sa.event.listens_for(Session, 'before_flush')
+def _dedupe_blobs(session, flush_context, instances):
+    """Reuse stored blobs instead of inserting the same content again."""
+    new = [o for o in session.new if isinstance(o, Blob)]
+    if not new:
+        return
+    with session.no_autoflush:
+        known = {b.hash: b for b in session.query(Blob).filter(
+            Blob.hash.in_({b.hash for b in new})
+        )}
+    replace = {}
+    for blob in new:
+        keep = known.setdefault(blob.hash, blob)
+        if keep is not blob:
+            replace[blob] = keep
+    if not replace:
+        return
+    for obj in list(session.new) + list(session.dirty):
+        for relation in ('photo_blob', 'logo_blob'):
+            blob = obj.__dict__.get(relation)
+            if blob in replace:
+                setattr(obj, relation, replace[blob])
+    for blob in replace:
+        session.expunge(blob)
+
+
 class BaseData(Base):
     __tablename__ = 'base_data'
 
@@ -29,13 +179,24 @@ class BaseData(Base):
     start = sa.Column(sa.Date)
     internal_code = sa.Column(sa.Unicode(30))
     institution = sa.Column(sa.UnicodeText)
-    logo = sa.Column(sa.LargeBinary)
+    logo_hash = sa.Column(sa.String(64), sa.ForeignKey('blobs.hash'))
+
+    logo_blob = relationship('Blob')
+
+    logo = _blob_property('logo_blob')
 
     def __str__(self):
         return '{} ({})'.format(
             self.group_name, self.start.strftime('%d.%m.%Y')
         )
 
+    @property
+    def job(self):
+        """Job code (e.g. CL) derived from the group name."""
+        if self.group_name.upper().startswith('BW'):
+            return self.group_name[2:4].upper()
+        return self.group_name[:2].upper()
+
 
 class Course(Base):
     __tablename__ = 'courses'
@@ -89,14 +250,17 @@ class Student(Base):
     last_name = sa.Column(sa.Unicode(75))
     first_name = sa.Column(sa.Unicode(75))
     company_id = sa.Column(sa.Integer, sa.ForeignKey('companies.pk'))
-    photo = sa.Column(sa.LargeBinary)
+    photo_hash = sa.Column(sa.String(64), sa.ForeignKey('blobs.hash'))
     show = sa.Column(sa.Boolean, default=True)
 
     company = relationship('Company', back_populates='students')
+    photo_blob = relationship('Blob')
     practice_grades = relationship('PracticeGrade', back_populates='student')
     theory_grades = relationship('TheoryGrade', back_populates='student')
     conferences = relationship('ConferenceStudent', back_populates='student')
 
+    photo = _blob_property('photo_blob')
+
     def __str__(self):
         return '{}, {}'.format(self.last_name, self.first_name)
 
@@ -124,6 +288,10 @@ class Experiment(Base):
     course = relationship('Course', back_populates='experiments')
     grades = relationship('PracticeGrade', back_populates='experiment')
 
+    __table_args__ = (
+        sa.Index('ix_experiments_course_done', 'course_id', 'done_on'),
+    )
+
     def __str__(self):
         return self.title
 
@@ -145,6 +313,10 @@ class Test(Base):
     course = relationship('Course', back_populates='tests')
     grades = relationship('TheoryGrade', back_populates='test')
 
+    __table_args__ = (
+        sa.Index('ix_tests_course_done', 'course_id', 'done_on'),
+    )
+
     def __str__(self):
         return '{}, {}'.format(
             self.subject, self.done_on.strftime('%d.%m.%Y')
@@ -187,8 +359,10 @@ class PracticeGrade(Base):
     docs = sa.Column(sa.Integer, default=None)
     experiment_id = sa.Column(sa.Integer, sa.ForeignKey('experiments.pk'))
     student_id = sa.Column(sa.Integer, sa.ForeignKey('students.pk'))
-    recorded = sa.Column(sa.DateTime, default=datetime.now)
-    recorded_by = sa.Column(sa.Unicode(50), default=getuser)
+    recorded = sa.Column(sa.DateTime, default=datetime.now,
+                         onupdate=datetime.now)
+    recorded_by = sa.Column(sa.Unicode(50), default=getuser,
+                            onupdate=getuser)
 
     experiment = relationship('Experiment', back_populates='grades',
                               cascade='save-update, merge, delete')
@@ -219,8 +393,10 @@ class TheoryGrade(Base):
     points = sa.Column(sa.Numeric(precision=1))
     test_id = sa.Column(sa.Integer, sa.ForeignKey('tests.pk'))
     student_id = sa.Column(sa.Integer, sa.ForeignKey('students.pk'))
-    recorded = sa.Column(sa.DateTime, default=datetime.now)
-    recorded_by = sa.Column(sa.Unicode(50), default=getuser)
+    recorded = sa.Column(sa.DateTime, default=datetime.now,
+                         onupdate=datetime.now)
+    recorded_by = sa.Column(sa.Unicode(50), default=getuser,
+                            onupdate=getuser)
 
     test = relationship('Test', back_populates='grades',
                         cascade='save-update, merge, delete')
@@ -241,6 +417,11 @@ class Conference(Base):
     title = sa.Column(sa.Unicode(60))
 
     students = relationship('ConferenceStudent', back_populates='conference')
+    snapshot = relationship('ConferenceSnapshot', uselist=False,
+                            back_populates='conference')
+
+    def __str__(self):
+        return '{} ({})'.format(self.title, self.date.strftime('%d.%m.%Y'))
 
 
 class ConferenceStudent(Base):
@@ -254,3 +435,78 @@ class ConferenceStudent(Base):
 
     conference = relationship('Conference', back_populates='students')
     student = relationship('Student', back_populates='conferences')
+
+
+class ConferenceSnapshot(Base):
+    """Marks when the grades of a conference were materialized."""
+    __tablename__ = 'conference_snapshots'
+
+    conference_id = sa.Column(sa.Integer, sa.ForeignKey('conferences.pk'),
+                              primary_key=True)
+    computed = sa.Column(sa.DateTime, default=datetime.now)
+    grade_count = sa.Column(sa.Integer, default=0)
+    # conference.inputs_signature() of the experiments, tests and courses
+    inputs = sa.Column(sa.String(64))
+
+    conference = relationship('Conference', back_populates='snapshot')
+
+
+class ConferenceGrade(Base):
+    """Standing of a student in a course as of `Conference.grades_til`."""
+    __tablename__ = 'conference_grades'
+
+    conference_id = sa.Column(sa.Integer, sa.ForeignKey('conferences.pk'),
+                              primary_key=True)
+    student_id = sa.Column(sa.Integer, sa.ForeignKey('students.pk'),
+                           primary_key=True)
+    course_id = sa.Column(sa.Integer, sa.ForeignKey('courses.pk'),
+                          primary_key=True)
+    practice = sa.Column(sa.Float)
+    theory = sa.Column(sa.Float)
+    total = sa.Column(sa.Float)
+
+
+class GradeHistory(Base):
+    """Append-only log of grade changes, written by triggers (history).
+
+    Only the components flagged in `changed` are stored in value_1..3
+    (method/result/docs or points).
+    """
+    __tablename__ = 'grade_history'
+
+    pk = sa.Column(sa.Integer, primary_key=True)
+    kind = sa.Column(sa.SmallInteger, nullable=False)
+    grade_id = sa.Column(sa.Integer, nullable=False)
+    student_id = sa.Column(sa.Integer)
+    item_id = sa.Column(sa.Integer)
+    course_id = sa.Column(sa.Integer)
+    recorded = sa.Column(sa.DateTime)
+    recorded_by = sa.Column(sa.Unicode(50))
+    changed = sa.Column(sa.SmallInteger, nullable=False)
+    value_1 = sa.Column(sa.Float)
+    value_2 = sa.Column(sa.Integer)
+    value_3 = sa.Column(sa.Integer)
+
+    __table_args__ = (
+        sa.Index('ix_grade_history_course_recorded', 'course_id',
+                 'recorded'),
+    )
+
+
+class GradeHistoryCheckpoint(Base):
+    """Full state of the grades of a course folded from grade_history.
+
+    Covers all history rows of the course recorded until `recorded`, a
+    trigger removes it if an older row is added later (history).
+    """
+    __tablename__ = 'grade_history_checkpoints'
+
+    pk = sa.Column(sa.Integer, primary_key=True)
+    course_id = sa.Column(sa.Integer, nullable=False)
+    recorded = sa.Column(sa.DateTime, nullable=False)
+    state = sa.Column(sa.UnicodeText, nullable=False)
+
+    __table_args__ = (
+        sa.Index('ix_grade_history_checkpoints_course_recorded',
+                 'course_id', 'recorded'),
+    )
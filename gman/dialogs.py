@@ -2,21 +2,23 @@
 
 import os
 
-from PyQt5 import QtCore, QtWidgets, uic
+from PyQt5 import QtCore, QtWidgets
+
+from . import uicache
 
 
 class StudentDialog(QtWidgets.QDialog):
 
     def __init__(self, parent, ui_path):
         QtWidgets.QDialog.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'dlg_student_count.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'dlg_student_count.ui'), self)
 
 
 class CourseDialog(QtWidgets.QDialog):
 
     def __init__(self, parent, ui_path, courses):
         QtWidgets.QDialog.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'dlg_courses.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'dlg_courses.ui'), self)
         for course in courses:
             self.courselist.addItem(QtWidgets.QListWidgetItem(course.title))
         self.courselist.itemDoubleClicked.connect(self.item_selected)
@@ -32,7 +34,7 @@ class CredentialsDialog(QtWidgets.QDialog):
 
     def __init__(self, parent, ui_path, crypted_db_path):
         QtWidgets.QDialog.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'dlg_credentials.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'dlg_credentials.ui'), self)
         self.crypted_db.setText(crypted_db_path)
         self.opt_keyfile.toggled.connect(self._enable_fields)
         self.btn_keyfile.clicked.connect(self.get_path)
@@ -63,7 +65,7 @@ class HelpDialog(QtWidgets.QDialog):
 
     def __init__(self, parent, ui_path, doc_path):
         QtWidgets.QDialog.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'help_browser.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'help_browser.ui'), self)
         self.browser.setSearchPaths([doc_path])
         self.browser.setSource(QtCore.QUrl('index.html'))
         self.btn_close.clicked.connect(self.close)
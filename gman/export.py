@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""Export all grades of a database as flat table.
+
+Grades are read in batches with Query.yield_per() and handed to a writer
+batch by batch, so exporting a large consolidated database needs only
+memory for one batch. Supported formats: CSV, JSON lines and Parquet
+(requires pyarrow).
+"""
+
+import csv
+import json
+import os
+
+from datetime import date, datetime
+from decimal import Decimal
+
+from . import db, grades, utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+BATCH_SIZE = 1000
+
+COLUMNS = (
+    'group', 'kind', 'course', 'course_start', 'trainer', 'student_id',
+    'last_name', 'first_name', 'company', 'title', 'done_on', 'weight',
+    'method', 'result', 'docs', 'points', 'max_points', 'grade',
+    'recorded', 'recorded_by',
+)
+
+
+def _plain(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def practice_rows(session, group, batch_size=BATCH_SIZE):
+    q = session.query(
+        db.Course.title, db.Course.start, db.Course.trainer,
+        db.Student.pk, db.Student.last_name, db.Student.first_name,
+        db.Company.short_name, db.Experiment.title, db.Experiment.done_on,
+        db.Experiment.weight, db.Experiment.weight_method,
+        db.Experiment.weight_result, db.Experiment.weight_docs,
+        db.PracticeGrade.method, db.PracticeGrade.result,
+        db.PracticeGrade.docs, db.PracticeGrade.recorded,
+        db.PracticeGrade.recorded_by,
+    ).select_from(db.PracticeGrade).join(
+        db.PracticeGrade.experiment
+    ).join(db.Experiment.course).join(
+        db.PracticeGrade.student
+    ).outerjoin(db.Student.company).order_by(db.PracticeGrade.pk)
+    for (course, start, trainer, student_id, last, first, company, title,
+         done_on, weight, w_method, w_result, w_docs, method, result, docs,
+         recorded, recorded_by) in q.yield_per(batch_size):
+        grade = grades.weighted_average(
+            [(method, w_method), (result, w_result), (docs, w_docs)]
+        )
+        yield (group, 'practice', course, start, trainer, student_id, last,
+               first, company, title, done_on, weight, method, result, docs,
+               None, None, grade, recorded, recorded_by)
+
+
+def theory_rows(session, group, batch_size=BATCH_SIZE):
+    q = session.query(
+        db.Course.title, db.Course.start, db.Course.trainer,
+        db.Student.pk, db.Student.last_name, db.Student.first_name,
+        db.Company.short_name, db.Test.subject, db.Test.done_on,
+        db.Test.weight, db.Test.max_points, db.TheoryGrade.points,
+        db.TheoryGrade.recorded, db.TheoryGrade.recorded_by,
+    ).select_from(db.TheoryGrade).join(
+        db.TheoryGrade.test
+    ).join(db.Test.course).join(
+        db.TheoryGrade.student
+    ).outerjoin(db.Student.company).order_by(db.TheoryGrade.pk)
+    for (course, start, trainer, student_id, last, first, company, title,
+         done_on, weight, max_points, points, recorded,
+         recorded_by) in q.yield_per(batch_size):
+        if points is not None and max_points:
+            grade = float(points) / max_points * 100
+        else:
+            grade = None
+        yield (group, 'theory', course, start, trainer, student_id, last,
+               first, company, title, done_on, weight, None, None, None,
+               points, max_points, grade, recorded, recorded_by)
+
+
+def grade_rows(session, batch_size=BATCH_SIZE):
+    """Yield one tuple (see COLUMNS) per practice and theory grade."""
+    base = session.query(db.BaseData).first()
+    group = base.group_name if base else ''
+    yield from practice_rows(session, group, batch_size)
+    yield from theory_rows(session, group, batch_size)
+
+
+class CsvWriter:
+
+    def __init__(self, path):
+        self.fp = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.fp, delimiter=';')
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows([_plain(v) for v in row] for row in rows)
+
+    def close(self):
+        self.fp.close()
+
+
+class JsonLinesWriter:
+
+    def __init__(self, path):
+        self.fp = open(path, 'w', encoding='utf-8')
+
+    def write(self, rows):
+        for row in rows:
+            self.fp.write(json.dumps(
+                {k: _plain(v) for k, v in zip(COLUMNS, row)},
+                ensure_ascii=False
+            ))
+            self.fp.write('\n')
+
+    def close(self):
+        self.fp.close()
+
+
+class ParquetWriter:
+    """Writes every batch as row group of a Parquet file."""
+
+    def __init__(self, path):
+        if pyarrow is None:
+            raise RuntimeError('Für Parquet Dateien wird pyarrow benötigt.')
+        self.schema = pyarrow.schema([
+            ('group', pyarrow.string()),
+            ('kind', pyarrow.string()),
+            ('course', pyarrow.string()),
+            ('course_start', pyarrow.date32()),
+            ('trainer', pyarrow.string()),
+            ('student_id', pyarrow.int64()),
+            ('last_name', pyarrow.string()),
+            ('first_name', pyarrow.string()),
+            ('company', pyarrow.string()),
+            ('title', pyarrow.string()),
+            ('done_on', pyarrow.date32()),
+            ('weight', pyarrow.int64()),
+            ('method', pyarrow.int64()),
+            ('result', pyarrow.int64()),
+            ('docs', pyarrow.int64()),
+            ('points', pyarrow.float64()),
+            ('max_points', pyarrow.int64()),
+            ('grade', pyarrow.float64()),
+            ('recorded', pyarrow.timestamp('us')),
+            ('recorded_by', pyarrow.string()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = [list(c) for c in zip(*rows)]
+        points = COLUMNS.index('points')
+        columns[points] = [None if p is None else float(p)
+                           for p in columns[points]]
+        self.writer.write_table(
+            pyarrow.Table.from_arrays(columns, schema=self.schema)
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {
+    '.csv': CsvWriter,
+    '.json': JsonLinesWriter,
+    '.jsonl': JsonLinesWriter,
+    '.parquet': ParquetWriter,
+}
+
+
+def get_writer(path):
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        return WRITERS[ext](path)
+    except KeyError:
+        raise ValueError('Unbekanntes Exportformat: {}'.format(ext))
+
+
+def export(session, writer, batch_size=BATCH_SIZE):
+    """Write all grades of `session` to `writer`, returns the row count."""
+    count = 0
+    for batch in utils.batches(grade_rows(session, batch_size), batch_size):
+        writer.write(batch)
+        count += len(batch)
+    return count
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict, namedtuple
+
+from . import db
+
+
+Standing = namedtuple('Standing', ['practice', 'theory', 'total'])
+
+
+def weighted_average(values):
+    """Return the weighted average of (value, weight) pairs or None."""
+    total = 0.0
+    weights = 0
+    for value, weight in values:
+        if value is None or not weight:
+            continue
+        total += float(value) * weight
+        weights += weight
+    if weights:
+        return total / weights
+
+
+def theory_points(grade, test):
+    if grade.points is None or not test.max_points:
+        return None
+    return float(grade.points) / test.max_points * 100
+
+
+def combine(practice, theory):
+    if practice is None:
+        return theory
+    if theory is None:
+        return practice
+    return (practice + theory) / 2
+
+
+def course_standings(session, course, until=None):
+    """Compute the standing of every graded student in `course`.
+
+    Only experiments and tests done on or before `until` are taken into
+    account if it is given. Returns a dict student pk -> Standing.
+    """
+    practice = defaultdict(list)
+    q = session.query(db.PracticeGrade, db.Experiment).join(
+        db.PracticeGrade.experiment
+    ).filter(db.Experiment.course_id == course.pk)
+    if until is not None:
+        q = q.filter(db.Experiment.done_on <= until)
+    for grade, exp in q:
+        practice[grade.student_id].append((grade.grade, exp.weight))
+    theory = defaultdict(list)
+    q = session.query(db.TheoryGrade, db.Test).join(
+        db.TheoryGrade.test
+    ).filter(db.Test.course_id == course.pk)
+    if until is not None:
+        q = q.filter(db.Test.done_on <= until)
+    for grade, test in q:
+        theory[grade.student_id].append((theory_points(grade, test),
+                                         test.weight))
+    standings = {}
+    for student_id in set(practice) | set(theory):
+        p = weighted_average(practice.get(student_id, ()))
+        t = weighted_average(theory.get(student_id, ()))
+        standings[student_id] = Standing(p, t, combine(p, t))
+    return standings
+
+
+def rating_table(session, key='IHK'):
+    q = session.query(db.Ratings).filter(db.Ratings.key == key)
+    return {r.points: r for r in q}
+
+
+def rate(points, table):
+    """Look up the Ratings row for `points` (0 - 100) or return None."""
+    if points is None:
+        return None
+    return table.get(int(points + 0.5))
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""History of practice and theory grades.
+
+Triggers on the grade tables append a row to grade_history (see
+db.GradeHistory) for every insert, changing update and delete, so bulk
+imports and raw SQL are recorded as well. A row holds only the changed
+components and a bit mask of them. Rows carry the course, the state of
+all grades of a course at a point in time is the latest checkpoint
+before it (db.GradeHistoryCheckpoint) plus the rows recorded since,
+folded in memory. checkpoint() stores a new one for every course with
+more than CHECKPOINT_EVERY rows after its last checkpoint.
+"""
+
+import json
+
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+import sqlalchemy as sa
+
+
+PRACTICE = 1
+THEORY = 2
+DELETED = 8
+
+CHECKPOINT_EVERY = 500
+
+GradeState = namedtuple('GradeState', 'kind grade_id student_id item_id '
+                                      'values recorded recorded_by')
+
+# kind: (table, item column, item table, components)
+SOURCES = {
+    PRACTICE: ('practice_grades', 'experiment_id', 'experiments',
+               ('method', 'result', 'docs')),
+    THEORY: ('theory_grades', 'test_id', 'tests', ('points',)),
+}
+
+# same format as SQLAlchemy's DateTime on SQLite, with microseconds
+_NOW = ("strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime') || "
+        "substr(strftime('%f', 'now'), 3) || '000'")
+_COLUMNS = (
+    'INSERT INTO grade_history(kind, grade_id, student_id, item_id, '
+    'course_id, recorded, recorded_by, changed, value_1, value_2, value_3) '
+)
+_VALUES = (
+    '{kind}, {row}.pk, {row}.student_id, {row}.{item}, '
+    '(SELECT course_id FROM {items} WHERE pk = {row}.{item}), {recorded}, '
+    '{row}.recorded_by, {changed}, {values}'
+)
+_TRIGGER = ('CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} '
+            '{when}BEGIN {body} END')
+# a row recorded before a checkpoint (imports with their own date) makes
+# it incomplete
+_INVALIDATE = _TRIGGER.format(
+    name='history_checkpoints_invalidate', event='INSERT',
+    table='grade_history', when='',
+    body='DELETE FROM grade_history_checkpoints WHERE course_id = '
+         'new.course_id AND recorded >= new.recorded;'
+)
+_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _insert(kind, row, recorded, changed, values):
+    """INSERT for a trigger or, if `row` is the table, for all its rows."""
+    table, item, items, components = SOURCES[kind]
+    values = list(values) + ['NULL'] * (3 - len(values))
+    values = _VALUES.format(kind=kind, row=row, item=item, items=items,
+                            recorded=recorded, changed=changed,
+                            values=', '.join(values))
+    if row == table:
+        return '{}SELECT {} FROM {}'.format(_COLUMNS, values, table)
+    return '{}VALUES ({});'.format(_COLUMNS, values)
+
+
+def _triggers(kind):
+    table, item, items, components = SOURCES[kind]
+    diffs = ['old.{0} IS NOT new.{0}'.format(c) for c in components]
+    yield 'history_{}_insert'.format(table), 'INSERT', '', _insert(
+        kind, 'new', 'COALESCE(new.recorded, {})'.format(_NOW),
+        2 ** len(components) - 1,
+        ['new.{}'.format(c) for c in components]
+    )
+    yield 'history_{}_update'.format(table), 'UPDATE OF {}'.format(
+        ', '.join(components)
+    ), 'WHEN {} '.format(' OR '.join(diffs)), _insert(
+        kind, 'new',
+        'CASE WHEN new.recorded IS NOT old.recorded THEN new.recorded '
+        'ELSE {} END'.format(_NOW),
+        ' + '.join('({}) * {}'.format(d, 2 ** i)
+                   for i, d in enumerate(diffs)),
+        ['CASE WHEN {} THEN new.{} END'.format(d, c)
+         for d, c in zip(diffs, components)]
+    )
+    yield 'history_{}_delete'.format(table), 'DELETE', '', _insert(
+        kind, 'old', _NOW, DELETED, []
+    )
+
+
+def install(connection):
+    """Create the triggers if missing, returns True if created.
+
+    The current grades are recorded once, so the history of databases
+    created before it existed starts with their state at that time.
+    """
+    connection.execute(_INVALIDATE)
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+        ('history_practice_grades_insert',)
+    ).scalar()
+    if exists:
+        return False
+    for kind, (table, *_) in SOURCES.items():
+        for name, event, when, body in _triggers(kind):
+            connection.execute(_TRIGGER.format(
+                name=name, event=event, table=table, when=when, body=body
+            ))
+        components = SOURCES[kind][3]
+        connection.execute(_insert(
+            kind, table, 'COALESCE({}.recorded, {})'.format(table, _NOW),
+            2 ** len(components) - 1,
+            ['{}.{}'.format(table, c) for c in components]
+        ))
+    return True
+
+
+def _value(kind, value):
+    if value is None:
+        return None
+    if kind == THEORY:
+        return Decimal(str(value))
+    return int(value)
+
+
+def _checkpoint(bind, course_id, when=None):
+    """(recorded, state) of the newest checkpoint until `when`."""
+    query = sa.text(
+        'SELECT recorded, state FROM grade_history_checkpoints '
+        'WHERE course_id = :course AND recorded <= :when '
+        'ORDER BY recorded DESC LIMIT 1'
+    ).columns(recorded=sa.DateTime)
+    row = bind.execute(query, dict(
+        course=course_id, when=_format(when or datetime.max)
+    )).first()
+    if row is None:
+        return None, {}
+    state = {}
+    for (kind, grade_id, student_id, item_id, values, recorded,
+         recorded_by) in json.loads(row.state):
+        values = {k: _value(kind, v) for k, v in values.items()}
+        state[kind, grade_id] = GradeState(
+            kind, grade_id, student_id, item_id, values,
+            recorded and datetime.strptime(recorded, _FORMAT), recorded_by
+        )
+    return row.recorded, state
+
+
+def _fold(state, rows):
+    """Apply history rows to `state`, returns the last recorded time."""
+    recorded = None
+    for (kind, grade_id, student_id, item_id, recorded, recorded_by,
+         changed, *values) in rows:
+        key = (kind, grade_id)
+        if changed & DELETED:
+            state.pop(key, None)
+            continue
+        current = state.get(key)
+        merged = dict(current.values) if current is not None else {}
+        for i, name in enumerate(SOURCES[kind][3]):
+            if changed & 2 ** i:
+                merged[name] = _value(kind, values[i])
+        state[key] = GradeState(kind, grade_id, student_id, item_id, merged,
+                                recorded, recorded_by)
+    return recorded
+
+
+def _rows(bind, course_id, since, until):
+    query = sa.text(
+        'SELECT kind, grade_id, student_id, item_id, recorded, recorded_by, '
+        'changed, value_1, value_2, value_3 FROM grade_history '
+        'WHERE course_id = :course AND recorded > :since '
+        'AND recorded <= :until ORDER BY recorded, pk'
+    ).columns(recorded=sa.DateTime)
+    return bind.execute(query, dict(
+        course=course_id, since=_format(since) if since else '',
+        until=_format(until or datetime.max)
+    ))
+
+
+def _format(when):
+    return when.strftime(_FORMAT)
+
+
+def grades_at(session, course_id, when):
+    """State of all grades of a course at datetime `when`.
+
+    Returns {(kind, grade_id): GradeState}, `values` maps the component
+    names (method, result, docs or points) to their values.
+    """
+    since, state = _checkpoint(session, course_id, when)
+    _fold(state, _rows(session, course_id, since, when))
+    return state
+
+
+def checkpoint(bind, every=CHECKPOINT_EVERY):
+    """Store checkpoints where the history grew, returns their number.
+
+    A course gets a new checkpoint when more than `every` rows were
+    recorded after its latest one.
+    """
+    courses = bind.execute(sa.text(
+        'SELECT course_id FROM grade_history h WHERE course_id IS NOT NULL '
+        "AND recorded > COALESCE((SELECT max(recorded) FROM "
+        "grade_history_checkpoints c WHERE c.course_id = h.course_id), '') "
+        'GROUP BY course_id HAVING count(*) > :every'
+    ), dict(every=every)).fetchall()
+    for course_id, in courses:
+        since, state = _checkpoint(bind, course_id)
+        recorded = _fold(state, _rows(bind, course_id, since, None))
+        data = [
+            [g.kind, g.grade_id, g.student_id, g.item_id,
+             {k: None if v is None else str(v) for k, v in g.values.items()},
+             g.recorded and _format(g.recorded), g.recorded_by]
+            for g in state.values()
+        ]
+        bind.execute(sa.text(
+            'INSERT INTO grade_history_checkpoints (course_id, recorded, '
+            'state) VALUES (:course, :recorded, :state)'
+        ), dict(course=course_id, recorded=_format(recorded),
+                state=json.dumps(data)))
+    return len(courses)
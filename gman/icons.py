@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Shared icons and pixmaps from the compiled resources.
+
+QIcon is implicitly shared, all copies use the same icon engine and so
+the same cache of rendered pixmaps. Handing out one instance per icon
+means every .svgz is decoded and rendered once per size, no matter how
+many tree items show it.
+"""
+
+from PyQt5 import QtGui
+
+from . import resources
+
+
+_icons = {}
+_pixmaps = {}
+
+
+def _path(name):
+    return name if name.startswith(':') else ':/icons/' + name
+
+
+def icon(name):
+    """The shared QIcon for `name` (e.g. 'student' or ':/icons/student')."""
+    try:
+        return _icons[name]
+    except KeyError:
+        result = _icons[name] = QtGui.QIcon(_path(name))
+        return result
+
+
+def pixmap(name, size=None):
+    """A shared pixmap, in its own size or rendered to `size` x `size`."""
+    key = (name, size)
+    try:
+        return _pixmaps[key]
+    except KeyError:
+        if size is None:
+            result = QtGui.QPixmap(_path(name))
+        else:
+            result = icon(name).pixmap(size, size)
+        _pixmaps[key] = result
+        return result
+
+
+def clear():
+    _icons.clear()
+    _pixmaps.clear()
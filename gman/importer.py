@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""Import students and grades from CSV or XLSX files.
+
+Rows are streamed through a chain of generators and written in batches,
+so even large files are imported with constant memory. Invalid rows do
+not abort the import, they are collected in an ImportReport instead.
+
+Student files need the columns Nachname, Vorname and Firma (the short
+name of the company). Grade files additionally need Kurs, Art (Praxis
+or Theorie), Titel and Datum plus Methode/Ergebnis/Doku for practice
+or Punkte/Maximalpunkte for theory grades.
+"""
+
+import codecs
+import csv
+import os
+
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from . import db, utils
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+BATCH_SIZE = 500
+
+PRACTICE_COMPONENTS = ('method', 'result', 'docs')
+
+ALIASES = {
+    'nachname': 'last_name',
+    'name': 'last_name',
+    'vorname': 'first_name',
+    'firma': 'company',
+    'betrieb': 'company',
+    'kurs': 'course',
+    'art': 'kind',
+    'titel': 'title',
+    'thema': 'title',
+    'versuch': 'title',
+    'test': 'title',
+    'datum': 'done_on',
+    'methode': 'method',
+    'ergebnis': 'result',
+    'doku': 'docs',
+    'dokumentation': 'docs',
+    'punkte': 'points',
+    'maximalpunkte': 'max_points',
+    'max. punkte': 'max_points',
+}
+
+KINDS = {
+    'praxis': 'practice',
+    'practice': 'practice',
+    'p': 'practice',
+    'theorie': 'theory',
+    'theory': 'theory',
+    't': 'theory',
+}
+
+
+class RowError(Exception):
+    pass
+
+
+class ImportReport:
+
+    def __init__(self):
+        self.errors = []
+        self.inserted = 0
+        self.updated = 0
+
+    def __str__(self):
+        return '{} neu, {} aktualisiert, {} Fehler'.format(
+            self.inserted, self.updated, len(self.errors)
+        )
+
+    def error(self, line, message):
+        self.errors.append((line, message))
+
+    def write(self, path):
+        with open(path, 'w', newline='', encoding='utf-8') as fp:
+            writer = csv.writer(fp, delimiter=';')
+            writer.writerow(['Zeile', 'Fehler'])
+            writer.writerows(self.errors)
+
+
+# reading
+def detect_encoding(path):
+    """UTF-8 (with or without BOM) if the whole file decodes, else cp1252.
+
+    Excel saves CSV in the ANSI code page, decoding errors would only show
+    up after earlier batches were committed.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    with open(path, 'rb') as fp:
+        try:
+            for chunk in iter(lambda: fp.read(65536), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return 'cp1252'
+    return 'utf-8-sig'
+
+
+def read_csv(path):
+    with open(path, newline='', encoding=detect_encoding(path)) as fp:
+        sample = fp.read(4096)
+        fp.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=';,\t')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(fp, dialect)
+        header = next(reader, [])
+        for row in reader:
+            if any(row):
+                yield reader.line_num, dict(zip(header, row))
+
+
+def read_xlsx(path):
+    if openpyxl is None:
+        raise RuntimeError('Für XLSX Dateien wird openpyxl benötigt.')
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = book.active.iter_rows(values_only=True)
+        header = [str(h or '') for h in next(rows, [])]
+        for line, row in enumerate(rows, 2):
+            if any(v not in (None, '') for v in row):
+                yield line, dict(zip(header, row))
+    finally:
+        book.close()
+
+
+def read_rows(path):
+    if os.path.splitext(path)[1].lower() in ('.xlsx', '.xlsm'):
+        return read_xlsx(path)
+    return read_csv(path)
+
+
+def normalize(rows):
+    for line, row in rows:
+        clean = {}
+        for key, value in row.items():
+            if key is None:
+                continue
+            key = key.strip().lower()
+            if isinstance(value, str):
+                value = value.strip()
+            clean[ALIASES.get(key, key)] = value
+        yield line, clean
+
+
+# value parsing
+def required(row, key):
+    value = row.get(key)
+    if value in (None, ''):
+        raise RowError('Spalte "{}" fehlt oder ist leer.'.format(key))
+    return value
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for fmt in ('%d.%m.%Y', '%Y-%m-%d', '%d.%m.%y'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except (TypeError, ValueError):
+            pass
+    raise RowError('Ungültiges Datum: {}'.format(value))
+
+
+def parse_number(value, type_=int):
+    if value in (None, ''):
+        return None
+    try:
+        number = Decimal(str(value).replace(',', '.'))
+        if type_ is int and number != number.to_integral_value():
+            raise RowError('Keine ganze Zahl: {}'.format(value))
+        return type_(number)
+    except (InvalidOperation, ValueError, OverflowError):
+        raise RowError('Ungültige Zahl: {}'.format(value))
+
+
+def check_range(name, value, maximum=100):
+    if value is not None and not 0 <= value <= maximum:
+        raise RowError('{} muss zwischen 0 und {} liegen: {}'.format(
+            name, maximum, value
+        ))
+    return value
+
+
+# importers
+class StudentImporter:
+    """Creates students, companies are resolved by their short name."""
+
+    def __init__(self, session):
+        self.session = session
+        self.companies = {
+            short.lower(): pk for pk, short in session.query(
+                db.Company.pk, db.Company.short_name
+            ) if short
+        }
+        self.known = {
+            (last.lower(), first.lower()) for last, first in session.query(
+                db.Student.last_name, db.Student.first_name
+            ) if last and first
+        }
+
+    def convert(self, rows, report):
+        for line, row in rows:
+            try:
+                last_name = str(required(row, 'last_name'))
+                first_name = str(required(row, 'first_name'))
+                short = str(required(row, 'company'))
+                company_id = self.companies.get(short.lower())
+                if company_id is None:
+                    raise RowError('Unbekannte Firma: {}'.format(short))
+                key = (last_name.lower(), first_name.lower())
+                if key in self.known:
+                    raise RowError('{}, {} existiert bereits.'.format(
+                        last_name, first_name
+                    ))
+            except RowError as error:
+                report.error(line, str(error))
+                continue
+            self.known.add(key)
+            yield dict(last_name=last_name, first_name=first_name,
+                       company_id=company_id, show=True)
+
+    def run(self, rows, report=None):
+        report = report or ImportReport()
+        for batch in utils.batches(self.convert(rows, report), BATCH_SIZE):
+            self.session.bulk_insert_mappings(db.Student, batch)
+            self.session.commit()
+            report.inserted += len(batch)
+        return report
+
+
+class GradeImporter:
+    """Creates or updates practice and theory grades.
+
+    Students are matched by name, courses by title. Missing experiments
+    and tests are created on the fly. Updates only touch the components
+    with a value in the file, empty cells keep the stored value.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.students = {
+            (last.lower(), first.lower()): pk
+            for pk, last, first in session.query(
+                db.Student.pk, db.Student.last_name, db.Student.first_name
+            ) if last and first
+        }
+        self.courses = {
+            title.lower(): pk for pk, title in session.query(
+                db.Course.pk, db.Course.title
+            ) if title
+        }
+        self.items = {
+            ('practice', course_id, title.lower()): pk
+            for pk, course_id, title in session.query(
+                db.Experiment.pk, db.Experiment.course_id,
+                db.Experiment.title
+            ) if title
+        }
+        self.max_points = {}
+        for pk, course_id, title, max_points in session.query(
+                db.Test.pk, db.Test.course_id, db.Test.subject,
+                db.Test.max_points):
+            self.max_points[pk] = max_points
+            if title:
+                self.items[('theory', course_id, title.lower())] = pk
+        self.grades = {
+            ('practice', item, student): pk for pk, item, student in
+            session.query(db.PracticeGrade.pk,
+                          db.PracticeGrade.experiment_id,
+                          db.PracticeGrade.student_id)
+        }
+        self.grades.update({
+            ('theory', item, student): pk for pk, item, student in
+            session.query(db.TheoryGrade.pk, db.TheoryGrade.test_id,
+                          db.TheoryGrade.student_id)
+        })
+
+    def _item(self, kind, course_id, row):
+        title = str(required(row, 'title'))
+        key = (kind, course_id, title.lower())
+        if key not in self.items:
+            done_on = parse_date(required(row, 'done_on'))
+            if kind == 'practice':
+                item = db.Experiment(title=title, done_on=done_on,
+                                     course_id=course_id)
+            else:
+                item = db.Test(subject=title, done_on=done_on,
+                               course_id=course_id,
+                               max_points=parse_number(
+                                   required(row, 'max_points')
+                               ))
+            self.session.add(item)
+            self.session.flush()
+            self.items[key] = item.pk
+            if kind == 'theory':
+                self.max_points[item.pk] = item.max_points
+        return self.items[key]
+
+    def convert(self, rows, report):
+        for line, row in rows:
+            try:
+                kind = KINDS.get(str(required(row, 'kind')).lower())
+                if kind is None:
+                    raise RowError('Unbekannte Art: {}'.format(row['kind']))
+                name = (str(required(row, 'last_name')).lower(),
+                        str(required(row, 'first_name')).lower())
+                student_id = self.students.get(name)
+                if student_id is None:
+                    raise RowError('Unbekannter Teilnehmer: {}, {}'.format(
+                        row['last_name'], row['first_name']
+                    ))
+                course = str(required(row, 'course'))
+                course_id = self.courses.get(course.lower())
+                if course_id is None:
+                    raise RowError('Unbekannter Kurs: {}'.format(course))
+                if kind == 'practice':
+                    values = {}
+                    for name in PRACTICE_COMPONENTS:
+                        value = parse_number(row.get(name))
+                        if value is not None:
+                            values[name] = check_range(name, value)
+                    if not values:
+                        raise RowError('Keine Note (Methode, Ergebnis oder '
+                                       'Doku) angegeben.')
+                else:
+                    points = parse_number(required(row, 'points'), Decimal)
+                item_id = self._item(kind, course_id, row)
+                if kind == 'theory':
+                    maximum = self.max_points.get(item_id)
+                    values = dict(points=check_range(
+                        'points', points, 100 if maximum is None else maximum
+                    ))
+                key = (kind, item_id, student_id)
+                if key in self.grades and self.grades[key] is None:
+                    raise RowError('Note ist doppelt in der Datei.')
+            except RowError as error:
+                report.error(line, str(error))
+                continue
+            if kind == 'practice':
+                values.update(experiment_id=item_id, student_id=student_id)
+            else:
+                values.update(test_id=item_id, student_id=student_id)
+            if key in self.grades:
+                values['pk'] = self.grades[key]
+            else:
+                self.grades[key] = None
+            yield kind, values
+
+    def run(self, rows, report=None):
+        report = report or ImportReport()
+        models = dict(practice=db.PracticeGrade, theory=db.TheoryGrade)
+        for batch in utils.batches(self.convert(rows, report), BATCH_SIZE):
+            for kind, model in models.items():
+                new = [v for k, v in batch if k == kind and 'pk' not in v]
+                old = [v for k, v in batch if k == kind and 'pk' in v]
+                if new:
+                    self.session.bulk_insert_mappings(model, new)
+                if old:
+                    self.session.bulk_update_mappings(model, old)
+                report.inserted += len(new)
+                report.updated += len(old)
+            self.session.commit()
+        return report
+
+
+def import_students(session, path, report=None):
+    return StudentImporter(session).run(normalize(read_rows(path)), report)
+
+
+def import_grades(session, path, report=None):
+    return GradeImporter(session).run(normalize(read_rows(path)), report)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from PyQt5.QtWidgets import QTreeWidgetItem
-from PyQt5.QtGui import QIcon
+
+from . import icons
 
 
 def date_to_str(dt):
@@ -35,7 +36,7 @@ class OverviewItem(QTreeWidgetItem):
     def __init__(self, parent):
         QTreeWidgetItem.__init__(self, parent, ['Übersicht'])
         self.course = parent.course
-        self.setIcon(0, QIcon(':/icons/overview'))
+        self.setIcon(0, icons.icon('overview'))
 
 
 class GroupItem(QTreeWidgetItem):
@@ -43,7 +44,7 @@ class GroupItem(QTreeWidgetItem):
 
     def __init__(self, parent):
         QTreeWidgetItem.__init__(self, parent)
-        self.setIcon(0, QIcon(':/icons/group'))
+        self.setIcon(0, icons.icon('group'))
 
 
 class StudentItem(QTreeWidgetItem):
@@ -52,7 +53,7 @@ class StudentItem(QTreeWidgetItem):
     def __init__(self, parent, student):
         QTreeWidgetItem.__init__(self, parent, [student.fullname])
         self.student = student
-        self.setIcon(0, QIcon(':/icons/student'))
+        self.setIcon(0, icons.icon('student'))
         # self.setToolTip(0, str(student.company))
 
 
@@ -62,7 +63,7 @@ class CourseItem(QTreeWidgetItem):
     def __init__(self, parent, course):
         QTreeWidgetItem.__init__(self, parent, [course.title])
         self.course = course
-        self.setIcon(0, QIcon(':/icons/course'))
+        self.setIcon(0, icons.icon('course'))
         tip = '{}, {:%d.%m.%Y} - {:%d.%m.%Y}'.format(
             course.title, course.start, course.end
         )
@@ -78,7 +79,7 @@ class ExperimentItem(QTreeWidgetItem):
             ['{} ({})'.format(exp.title, date_to_str(exp.done_on))]
         )
         self.exp = exp
-        self.setIcon(0, QIcon(':/icons/practice'))
+        self.setIcon(0, icons.icon('practice'))
 
 
 class TestItem(QTreeWidgetItem):
@@ -90,7 +91,7 @@ class TestItem(QTreeWidgetItem):
             ['{} ({})'.format(test.subject, date_to_str(test.done_on))]
         )
         self.test = test
-        self.setIcon(0, QIcon(':/icons/theory'))
+        self.setIcon(0, icons.icon('theory'))
 
 
 class CompanyItem(QTreeWidgetItem):
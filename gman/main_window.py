@@ -6,22 +6,41 @@ import sys
 
 from functools import partial
 from getpass import getuser
-from PyQt5 import QtCore, QtGui, QtWidgets, uic
-from . import crypto, db, dialogs, items, resources, widgets
+from PyQt5 import QtCore, QtWidgets
+# database, crypto and report modules pull in SQLAlchemy, cryptography,
+# Jinja2 and Pillow, they are imported on first use to show the window fast
+from . import (autosave, dialogs, icons, items, resources, sqlprofile,
+               tracing, uicache)
 
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 UI_PATH = os.path.join(PATH, 'ui')
 DOC_PATH = os.path.join(PATH, 'docs')
+# milliseconds without typing before the search runs
+SEARCH_DELAY = 250
+SEARCH_KINDS = {
+    'student': 'Teilnehmer',
+    'course': 'Kurs',
+    'experiment': 'Versuch',
+    'test': 'Test',
+    'note': 'Notiz',
+}
 
 
 class GradeManagerMain(QtWidgets.QMainWindow):
 
+    # emitted from the heartbeat thread of the crypto handler
+    lock_error = QtCore.pyqtSignal(str)
+
     def __init__(self, crypted_db=''):
         QtWidgets.QMainWindow.__init__(self)
-        uic.loadUi(os.path.join(UI_PATH, 'main.ui'), self)
+        uicache.load_ui(os.path.join(UI_PATH, 'main.ui'), self)
         self.setWindowTitle('bbz Notenmanager - {}'.format(getuser()))
+        self._engine = None
         self._Session = None
+        self._loaded = None
+        self._sessions = []
+        self._nodes = {}
         self.session = None
         self.db_connected = False
         self.subwindows = {}
@@ -29,50 +48,152 @@ class GradeManagerMain(QtWidgets.QMainWindow):
         self.crypted_db = crypted_db
         self.db_path = None
         self.handler = None
+        self.read_only = False
+        self.exporter = None
+        self.sql_profile = None
+        self.autosave = autosave.Autosave(self)
+        self.autosave.saved.connect(self._autosaved)
+        self.autosave.failed.connect(
+            lambda error: self.status.showMessage(
+                'Automatisches Speichern fehlgeschlagen: {}'.format(error)
+            )
+        )
+        self.lock_error.connect(self._lock_failed)
         if crypted_db:
             self.handler = self.get_crypto_handler()
             if self.handler:
                 self.load_db(self.handler)
         self._connect_actions()
-        self.nav.customContextMenuRequested.connect(self.item_right_clicked)
-        self.nav.itemClicked.connect(self.item_clicked)
-        self.nav.itemDoubleClicked.connect(self.item_doubleclicked)
+        self.nav.customContextMenuRequested.connect(
+            self._action('Kontextmenü', self.item_right_clicked, 1)
+        )
+        self.nav.itemClicked.connect(
+            self._action('Auswahl', self.item_clicked, 2)
+        )
+        self.nav.itemDoubleClicked.connect(
+            self._action('Doppelklick', self.item_doubleclicked, 2)
+        )
+        self.search_results.hide()
+        self._search_timer = QtCore.QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(SEARCH_DELAY)
+        self._search_timer.timeout.connect(
+            self._action('Suche', self.run_search)
+        )
+        self.search_box.textChanged.connect(
+            lambda text: self._search_timer.start()
+        )
+        self.search_results.itemActivated.connect(self.show_search_result)
+        self.search_results.itemClicked.connect(self.show_search_result)
         self._check_available_actions()
 
+    def _action(self, name, slot, nargs=0):
+        """Wrap `slot` to run as one traced and SQL profiled action.
+
+        Only the first `nargs` signal arguments are passed on.
+        """
+        def run(*args):
+            with tracing.action(name) as action, sqlprofile.action(name):
+                slot(*args[:nargs])
+            if action.profile_path is not None:
+                self.status.showMessage(
+                    'Profil gespeichert: {}'.format(action.profile_path)
+                )
+        return run
+
     def _connect_actions(self):
-        self.action_new_db.triggered.connect(self.create_new_db)
-        self.action_open_db.triggered.connect(self.open_db)
-        self.action_add_students.triggered.connect(self.add_students)
-        self.action_companies.triggered.connect(self.edit_companies)
-        self.action_new_course.triggered.connect(self.new_course)
-        self.action_edit_course.triggered.connect(self.edit_course)
-        self.action_new_practice.triggered.connect(self.edit_practice)
-        self.action_save_all.triggered.connect(self.save_all)
-        self.action_help.triggered.connect(self.show_help)
+        for action, slot in (
+                (self.action_new_db, self.create_new_db),
+                (self.action_open_db, self.open_db),
+                (self.action_add_students, self.add_students),
+                (self.action_companies, self.edit_companies),
+                (self.action_conference, self.edit_conference),
+                (self.action_new_course, self.new_course),
+                (self.action_edit_course, self.edit_course),
+                (self.action_new_practice, self.edit_practice),
+                (self.action_save_all, self.save_all),
+                (self.action_print, self.print_reports),
+                (self.action_export_pdf, self.export_pdf),
+                (self.action_import, self.import_data),
+                (self.action_help, self.show_help)):
+            action.triggered.connect(self._action(action.text(), slot))
+        if sqlprofile.get_profiler() is not None:
+            self.menuHilfe.addSeparator()
+            self.action_sql_profile = self.menuHilfe.addAction('SQL-Profil')
+            self.action_sql_profile.triggered.connect(self.show_sql_profile)
+        if tracing.is_enabled():
+            self.menuHilfe.addSeparator()
+            self.menuHilfe.addAction('Ablauf speichern...').triggered.connect(
+                self.save_trace
+            )
+            self.menuHilfe.addAction(
+                'Nächste Aktion profilieren'
+            ).triggered.connect(self.profile_next_action)
 
     def _check_available_actions(self, *args, **kw):
-        self.action_add_students.setEnabled(self.db_connected)
-        self.action_new_course.setEnabled(self.db_connected)
-        self.action_companies.setEnabled(self.db_connected)
-        self.action_new_theory.setEnabled(self.has_course)
-        self.action_new_practice.setEnabled(self.has_course)
-        self.action_save_all.setEnabled(bool(self.subwindows))
-        self.action_edit_course.setEnabled(self.item_selected('course'))
+        writable = self.db_connected and not self.read_only
+        self.search_box.setEnabled(self.db_connected)
+        self.action_add_students.setEnabled(writable)
+        self.action_new_course.setEnabled(writable)
+        self.action_companies.setEnabled(writable)
+        self.action_conference.setEnabled(self.has_students)
+        self.action_print.setEnabled(self.db_connected)
+        self.action_import.setEnabled(writable)
+        self.action_export_pdf.setEnabled(
+            self.db_connected and self.exporter is None
+        )
+        self.action_new_theory.setEnabled(writable and self.has_course)
+        self.action_new_practice.setEnabled(writable and self.has_course)
+        self.action_save_all.setEnabled(
+            not self.read_only and bool(self.subwindows)
+        )
+        self.action_edit_course.setEnabled(
+            writable and self.item_selected('course')
+        )
 
     def get_crypto_handler(self):
+        from . import crypto
         dlg = dialogs.CredentialsDialog(self, UI_PATH, self.crypted_db)
         if dlg.exec_() == QtWidgets.QDialog.Accepted:
             result = dict(auth=dlg.active, keyfile=dlg.keyfile_path.text(),
                           password=dlg.password.text())
         else:
-            print('cancel')
             return
         if result['auth'] == 'keyfile':
             kw = dict(keyfile=result['keyfile'])
         else:
             kw = dict(password=result['password'])
+        kw['generations'] = autosave.generations()
         try:
             return crypto.CryptedDBHandler(self.crypted_db, **kw)
+        except crypto.SetupError as err:
+            if not err.user:
+                QtWidgets.QMessageBox.critical(
+                    self, 'Datenbankfehler', str(err)
+                )
+                return
+            if err.stale:
+                answer = QtWidgets.QMessageBox.question(
+                    self, 'Verwaiste Sperre',
+                    '{}\n\nDas Programm wurde vermutlich nicht korrekt '
+                    'beendet. Sperre übernehmen?'.format(err)
+                )
+                if answer == QtWidgets.QMessageBox.Yes:
+                    try:
+                        return crypto.CryptedDBHandler(
+                            self.crypted_db, takeover=True, **kw
+                        )
+                    except crypto.SetupError as error:
+                        err = error
+            answer = QtWidgets.QMessageBox.question(
+                self, 'Datenbank gesperrt',
+                '{}\n\nSchreibgeschützt öffnen?'.format(err)
+            )
+            if answer != QtWidgets.QMessageBox.Yes:
+                return
+        try:
+            return crypto.CryptedDBHandler(self.crypted_db, read_only=True,
+                                           **kw)
         except crypto.SetupError as err:
             QtWidgets.QMessageBox.critical(
                 self, 'Datenbankfehler', str(err)
@@ -82,6 +203,7 @@ class GradeManagerMain(QtWidgets.QMainWindow):
     def has_course(self):
         if not self.db_connected:
             return False
+        from . import db
         q = self.session.query(db.Course)
         return bool(q.count())
 
@@ -89,6 +211,7 @@ class GradeManagerMain(QtWidgets.QMainWindow):
     def has_students(self):
         if not self.db_connected:
             return False
+        from . import db
         q = self.session.query(db.Student)
         return bool(q.count())
 
@@ -102,20 +225,17 @@ class GradeManagerMain(QtWidgets.QMainWindow):
         if item is None:
             return
         self._check_available_actions()
-        print('Item clicked:', item.type_)
 
     def item_doubleclicked(self, item, col):
         if item is None:
             return
-        print('Item doubleclicked:', item.type_)
-        if item.type_ == 'experiment':
+        if item.type_ == 'experiment' and not self.read_only:
             self.edit_practice(practice=item.exp)
 
     def item_right_clicked(self, pos):
         item = self.nav.itemAt(pos)
         if item is None or item.type_ not in ('group', 'course'):
             return
-        print('Right Clicked:', item.type_)
         menu = QtWidgets.QMenu(self)
         if item.type_ == 'group':
             menu.addAction(self.action_add_students)
@@ -126,23 +246,24 @@ class GradeManagerMain(QtWidgets.QMainWindow):
         menu.exec_(self.nav.mapToGlobal(pos))
 
     def add_students(self):
+        from . import widgets
         dlg = dialogs.StudentDialog(self, UI_PATH)
         if dlg.exec_() == QtWidgets.QDialog.Accepted:
             count = dlg.count.value()
         else:
-            print('cancel')
             return
         win = QtWidgets.QMdiSubWindow(self)
-        widget = widgets.StudentsWidget(UI_PATH, self.status, self.session,
-                                        count)
+        with tracing.span('window', widget='students'):
+            widget = widgets.StudentsWidget(UI_PATH, self.status,
+                                            self.new_session(), count)
         widget.saved.connect(partial(self.load_db, handler=self.handler))
         widget.saved.connect(
             partial(self._subwindow_closed, window=win, name='students')
         )
         win.setWidget(widget)
-        win.setWindowIcon(QtGui.QIcon(':/icons/group-new'))
+        win.setWindowIcon(icons.icon('group-new'))
         self.main.addSubWindow(win)
-        self.subwindows['students'] = win
+        self._add_subwindow('students', win)
         win.show()
         self._check_available_actions()
 
@@ -157,8 +278,11 @@ class GradeManagerMain(QtWidgets.QMainWindow):
             if self.handler:
                 self.load_db(self.handler)
 
-    def load_db(self, handler):
-        self.handler = handler
+    @tracing.traced('open')
+    def _open_handler(self, handler):
+        """Create the one engine used for the whole lifetime of `handler`."""
+        from sqlalchemy.orm import sessionmaker
+        from . import crypto, db
         if handler.useable:
             self.db_path = handler.db_path
         else:
@@ -168,52 +292,162 @@ class GradeManagerMain(QtWidgets.QMainWindow):
                 QtWidgets.QMessageBox.critical(
                     self, 'Fehler beim Entschlüsseln', str(error)
                 )
-                return
+                return False
+        self._close_sessions()
+        self.read_only = handler.read_only
+        title = 'bbz Notenmanager - {}'.format(getuser())
+        if self.read_only:
+            title += ' (schreibgeschützt)'
+        self.setWindowTitle(title)
+        if self.read_only:
+            # only the plaintext copy is changed, it is never written back
+            db.upgrade_file(handler.db_path)
+        # objects stay usable after commits, every window has its own
+        # session, so one window saving does not expire the others
+        self._engine = db.get_engine(handler.connection_string,
+                                     profile=handler.profile)
+        self._Session = sessionmaker(bind=self._engine,
+                                     expire_on_commit=False)
+        if not self.read_only:
+            s = self._Session()
+            db.upgrade_schema(s)
+            s.close()
+        self._loaded = handler
+        handler.on_lock_error = self.lock_error.emit
+        self.autosave.start(handler)
+        return True
+
+    def new_session(self):
+        """A session for a new subwindow, closed with the window."""
+        session = self._Session()
+        self._sessions.append(session)
+        return session
+
+    def _release_session(self, window):
+        """Close the session of a subwindow that is gone."""
+        session = getattr(window.widget(), 'session', None)
+        if session in self._sessions:
+            self._sessions.remove(session)
+            session.close()
+
+    def _add_subwindow(self, name, window):
+        old = self.subwindows.get(name)
+        if old is not None and old is not window and old.isHidden():
+            # closed by the user and replaced, it is never saved
+            self._release_session(old)
+            old.deleteLater()
+        self.subwindows[name] = window
+
+    def _close_sessions(self):
+        for session in self._sessions:
+            session.close()
+        self._sessions = []
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+            self._Session = None
+
+    def load_db(self, handler):
+        self.handler = handler
+        if handler is not self._loaded and not self._open_handler(handler):
+            return
+        with tracing.span('load_db') as span, \
+                sqlprofile.action('Datenbank laden'):
+            self._load_tree()
+            span.set(items=self.top.childCount())
+        self.db_connected = True
+        self.top.setExpanded(True)
+        self._check_available_actions()
+
+    def _load_tree(self):
+        from . import db
         self.nav.clear()
+        self._nodes = {}
+        self.search_results.clear()
+        self.search_results.hide()
         self.status.showMessage('Lade {}'.format(self.db_path), 5000)
-        self._Session = db.get_session('sqlite:///{}'.format(self.db_path))
+        if self.session is not None:
+            self.session.close()
         self.session = s = self._Session()
         base = s.query(db.BaseData).first()
         self.top = items.BaseItem(self.nav, [base.group_name],
-                                  QtGui.QIcon(':/icons/top'))
+                                  icons.icon('top'))
         self.nav.addTopLevelItem(self.top)
         group = items.GroupItem(self.top)
         for student in s.query(db.Student).order_by(
                 db.Student.last_name).all():
             stud = items.StudentItem(group, student)
             group.addChild(stud)
+            self._nodes['student', student.pk] = stud
         group.setText(0, 'Teilnehmer ({})'.format(group.childCount()))
         self.top.addChild(group)
         for course in s.query(db.Course).order_by(db.Course.start).all():
             co = items.CourseItem(self.top, course)
+            self._nodes['course', course.pk] = co
             ov = items.OverviewItem(co)
             co.addChild(ov)
             theory = items.TheoryItem(
-                co, ['Theorie'], QtGui.QIcon(':/icons/theory')
+                co, ['Theorie'], icons.icon('theory')
             )
             co.addChild(theory)
             for t in course.tests:
-                print('TEST:', t)
                 test = items.TestItem(theory, t)
                 theory.addChild(test)
+                self._nodes['test', t.pk] = test
             practice = items.PracticeItem(
-                co, ['Praxis'], QtGui.QIcon(':/icons/practice')
+                co, ['Praxis'], icons.icon('practice')
             )
             co.addChild(practice)
             for e in course.experiments:
-                print('EXP:', e)
                 exp = items.ExperimentItem(practice, e)
                 practice.addChild(exp)
+                self._nodes['experiment', e.pk] = exp
             self.top.addChild(co)
-        self.db_connected = True
-        self.top.setExpanded(True)
+
+    def run_search(self):
+        from . import search
+        text = self.search_box.text().strip()
+        self.search_results.clear()
+        if not text or not self.db_connected:
+            self.search_results.hide()
+            return
+        with self._engine.connect() as connection:
+            hits = search.search(connection, text)
+        for hit in hits:
+            # conference notes lead to the student
+            kind = 'student' if hit.kind == 'note' else hit.kind
+            node = self._nodes.get((kind, hit.ref))
+            if node is None:
+                continue
+            item = QtWidgets.QListWidgetItem('{}: {}'.format(
+                SEARCH_KINDS[hit.kind], hit.title or node.text(0)
+            ), self.search_results)
+            item.setData(QtCore.Qt.UserRole, node)
+            if hit.snippet:
+                item.setToolTip(hit.snippet)
+        count = self.search_results.count()
+        self.search_results.setVisible(bool(count))
+        if count:
+            self.show_search_result(self.search_results.item(0))
+        else:
+            self.status.showMessage('Keine Treffer für "{}"'.format(text),
+                                    5000)
+
+    def show_search_result(self, item):
+        node = item.data(QtCore.Qt.UserRole)
+        self.nav.setCurrentItem(node)
+        self.nav.scrollToItem(node)
         self._check_available_actions()
 
     def create_new_db(self):
-        print('new db')
+        from . import widgets
         new_db_window = QtWidgets.QMdiSubWindow(self)
         new_db_window.resize(580, 450)
-        widget = widgets.CreateDBWizard(UI_PATH, self.status)
+        with tracing.span('window', widget='new_db'):
+            widget = widgets.CreateDBWizard(UI_PATH, self.status)
         widget.db_created.connect(self.load_db)
         widget.finished.connect(new_db_window.close)
         new_db_window.setWidget(widget)
@@ -222,12 +456,29 @@ class GradeManagerMain(QtWidgets.QMainWindow):
         new_db_window.show()
 
     def edit_companies(self):
+        from . import widgets
+        win = QtWidgets.QMdiSubWindow(self)
+        with tracing.span('window', widget='companies'):
+            widget = widgets.CompaniesWidget(UI_PATH, self.status,
+                                             self.new_session())
+        win.setWidget(widget)
+        win.setWindowIcon(icons.icon('add'))
+        self.main.addSubWindow(win)
+        self._add_subwindow('companies', win)
+        win.show()
+        self._check_available_actions()
+
+    def edit_conference(self):
+        from . import widgets
         win = QtWidgets.QMdiSubWindow(self)
-        widget = widgets.CompaniesWidget(UI_PATH, self.status, self.session)
+        with tracing.span('window', widget='conference'):
+            widget = widgets.ConferenceWidget(UI_PATH, self.status,
+                                              self.new_session(),
+                                              read_only=self.read_only)
         win.setWidget(widget)
-        win.setWindowIcon(QtGui.QIcon(':/icons/add'))
+        win.setWindowIcon(icons.icon('group'))
         self.main.addSubWindow(win)
-        self.subwindows['companies'] = win
+        self._add_subwindow('conference', win)
         win.show()
         self._check_available_actions()
 
@@ -238,54 +489,211 @@ class GradeManagerMain(QtWidgets.QMainWindow):
         self.new_course(course=item.course)
 
     def new_course(self, checked=False, course=None):
-        print('new/edit course')
+        from . import widgets
         win = QtWidgets.QMdiSubWindow(self)
-        widget = widgets.CourseWidget(UI_PATH, self.status, self.session)
+        with tracing.span('window', widget='courses'):
+            widget = widgets.CourseWidget(UI_PATH, self.status,
+                                          self.new_session())
         win.setWidget(widget)
-        win.setWindowIcon(QtGui.QIcon(':/icons/course-new'))
+        win.setWindowIcon(icons.icon('course-new'))
         widget.saved.connect(partial(self.load_db, handler=self.handler))
         widget.saved.connect(
             partial(self._subwindow_closed, window=win, name='courses')
         )
         self.main.addSubWindow(win)
-        self.subwindows['courses'] = win
+        self._add_subwindow('courses', win)
         if course is not None:
-            widget.update(course)
+            with tracing.span('update', widget='courses'):
+                widget.update(course)
         win.show()
         self._check_available_actions()
 
     def edit_practice(self, checked=False, practice=None):
-        print('Add/edit practice')
+        from . import widgets
         if self.item_selected('course'):
             item = self.nav.currentItem()
             course = item.course
         else:
             course = None
         win = QtWidgets.QMdiSubWindow(self)
-        widget = widgets.ExperimentWidget(UI_PATH, self.session, course)
+        with tracing.span('window', widget='experiment'):
+            widget = widgets.ExperimentWidget(UI_PATH, self.new_session(),
+                                              course)
         win.setWidget(widget)
         widget.saved.connect(partial(self.load_db, handler=self.handler))
         widget.saved.connect(
             partial(self._subwindow_closed, window=win, name='experiment')
         )
         self.main.addSubWindow(win)
-        self.subwindows['experiment'] = win
+        self._add_subwindow('experiment', win)
         if practice is not None:
-            widget.update(practice)
+            with tracing.span('update', widget='experiment'):
+                widget.update(practice)
         win.show()
         self._check_available_actions()
 
+    def print_reports(self):
+        from . import printing, reports
+        self.status.showMessage('Erstelle Notenübersicht', 5000)
+        data = reports.ReportData(self.session)
+        logo = printing.logo_src(data)
+        if self.item_selected('course'):
+            course = self.nav.currentItem().course
+            html = reports.render_course_sheet(data, course, logo)
+        else:
+            html = reports.render_group(data, logo)
+        printing.preview(self, data, html)
+
+    def export_pdf(self):
+        from . import printing, widgets
+        target = QtWidgets.QFileDialog.getExistingDirectory(
+            self, 'Zielverzeichnis wählen', widgets.STARTDIR
+        )
+        if not target:
+            return
+        self.exporter = printing.BatchExporter(
+            self._Session, target, self,
+            mark_printed=not self.read_only
+        )
+        progress = QtWidgets.QProgressDialog(
+            'Exportiere Notenübersichten', 'Abbrechen', 0, 0, self
+        )
+        progress.setWindowTitle('PDF-Export')
+        progress.setMinimumDuration(0)
+        progress.canceled.connect(self.exporter.cancel)
+        self.exporter.progress.connect(
+            lambda done, total: (progress.setMaximum(total),
+                                 progress.setValue(done))
+        )
+        self.exporter.finished.connect(
+            partial(self._export_finished, progress=progress)
+        )
+        self.exporter.start()
+        self._check_available_actions()
+
+    def _export_finished(self, failures, progress):
+        progress.reset()
+        if self.exporter.cancelled:
+            self.status.showMessage('PDF-Export abgebrochen', 5000)
+        elif failures:
+            QtWidgets.QMessageBox.warning(
+                self, 'Fehler beim PDF-Export',
+                '\n'.join('{}: {}'.format(*f) for f in failures)
+            )
+        else:
+            self.status.showMessage(
+                '{} Dateien nach {} exportiert'.format(
+                    self.exporter.total, self.exporter.target_dir
+                ), 5000
+            )
+        self.exporter = None
+        self._check_available_actions()
+
+    def import_data(self):
+        from . import importer, widgets
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(
+            self, 'Tabelle importieren', widgets.STARTDIR,
+            'Tabellen (*.csv *.xlsx)'
+        )
+        if not filename:
+            return
+        kind, ok = QtWidgets.QInputDialog.getItem(
+            self, 'Importieren', 'Inhalt der Tabelle:',
+            ['Teilnehmer', 'Noten'], 0, False
+        )
+        if not ok:
+            return
+        self.status.showMessage('Importiere {}'.format(filename))
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            if kind == 'Teilnehmer':
+                report = importer.import_students(self.session, filename)
+            else:
+                report = importer.import_grades(self.session, filename)
+        except Exception as error:
+            self.session.rollback()
+            QtWidgets.QApplication.restoreOverrideCursor()
+            QtWidgets.QMessageBox.critical(
+                self, 'Fehler beim Importieren', str(error)
+            )
+            return
+        QtWidgets.QApplication.restoreOverrideCursor()
+        if report.errors:
+            path = '{}_fehler.csv'.format(os.path.splitext(filename)[0])
+            report.write(path)
+            QtWidgets.QMessageBox.warning(
+                self, 'Import mit Fehlern',
+                '{}\n\nFehlerbericht: {}'.format(report, path)
+            )
+        else:
+            self.status.showMessage('Import: {}'.format(report), 5000)
+        self.load_db(self.handler)
+
+    def _lock_failed(self, message):
+        from . import crypto
+        if isinstance(self.handler.lock_error, crypto.LockLostError):
+            self.autosave.stop()
+            QtWidgets.QMessageBox.critical(
+                self, 'Sperre verloren',
+                '{}\n\nÄnderungen werden nicht mehr in die Datei '
+                'geschrieben.'.format(message)
+            )
+        else:
+            self.status.showMessage(message, 10000)
+
+    def _autosaved(self, written):
+        if written:
+            name = self.handler.crypted.name
+            self.status.showMessage(
+                'Automatisch gespeichert: {}'.format(name), 5000
+            )
+
     def show_help(self):
-        print('Help requested')
         dlg = dialogs.HelpDialog(self, UI_PATH, DOC_PATH)
         dlg.show()
 
+    def show_sql_profile(self):
+        from . import widgets
+        if self.sql_profile is not None:
+            self.sql_profile.widget().refresh()
+            self.main.setActiveSubWindow(self.sql_profile)
+            return
+        win = QtWidgets.QMdiSubWindow(self)
+        win.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        win.setWidget(widgets.SqlProfileWidget(UI_PATH,
+                                               sqlprofile.get_profiler()))
+        win.destroyed.connect(lambda: setattr(self, 'sql_profile', None))
+        self.main.addSubWindow(win)
+        self.sql_profile = win
+        win.show()
+
+    def save_trace(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Ablauf speichern', 'gman-trace.json',
+            'Chrome Trace (*.json)'
+        )
+        if filename:
+            count = tracing.save(filename)
+            self.status.showMessage(
+                '{} Abschnitte nach {} geschrieben'.format(count, filename),
+                5000
+            )
+
+    def profile_next_action(self):
+        import tempfile
+        from . import utils
+        tracing.profile_next(utils.cache_dir('profile') or
+                             tempfile.gettempdir())
+        self.status.showMessage(
+            'Die nächste Aktion wird mit cProfile aufgezeichnet', 5000
+        )
+
     def _subwindow_closed(self, window, name):
         window.close()
-        try:
+        self._release_session(window)
+        window.deleteLater()
+        if self.subwindows.get(name) is window:
             del self.subwindows[name]
-        except KeyError:
-            pass
 
     def save_all(self, on_close=False):
         for name, subwindow in list(self.subwindows.items()):
@@ -298,30 +706,108 @@ class GradeManagerMain(QtWidgets.QMainWindow):
         self._check_available_actions()
 
     def _save(self, name, window, on_close):
-        print('Saving:', name, window)
         self.status.showMessage('Speichere: {}'.format(name))
         widget = window.widget()
         try:
-            widget.save(on_close=on_close)
+            with tracing.span('save', widget=name):
+                widget.save(on_close=on_close)
         except Exception as error:
             print('Fehler beim Speichern:', error)
 
     def closeEvent(self, event):
-        if self.handler and self.handler.useable:
+        if self.exporter is not None:
+            self.exporter.wait()
+        self.autosave.stop()
+        if self.handler and self.handler.useable and not self.read_only:
             self.save_all(True)
-            print('Encrypting DB')
-            self.handler.encrypt()
+        self._close_sessions()
+        if self.handler and self.handler.useable:
+            from . import crypto
+            try:
+                with tracing.span('close') as span:
+                    span.set(written=self.handler.close())
+            except crypto.SetupError as error:
+                # lock taken over: the edits must not be lost silently
+                if not self._save_copy(error):
+                    self._reopen()
+                    event.ignore()
+                    return
+            except OSError as error:
+                # the working copy and the lock are kept, closing again
+                # retries the write
+                QtWidgets.QMessageBox.critical(
+                    self, 'Fehler beim Speichern',
+                    'Die Datenbank konnte nicht geschrieben werden:\n{}\n\n'
+                    'Das Programm bleibt geöffnet, beim nächsten Beenden '
+                    'wird erneut gespeichert.'.format(error)
+                )
+                self._reopen()
+                event.ignore()
+                return
         event.accept()
 
+    def _save_copy(self, error):
+        """Offer to save the open database to another file.
+
+        Returns True if the database was saved or discarded, False to
+        keep the window open.
+        """
+        from . import crypto
+        box = QtWidgets.QMessageBox
+        answer = box.warning(
+            self, 'Datenbank kann nicht gespeichert werden',
+            '{}\n\nÄnderungen als Kopie in einer anderen Datei speichern? '
+            'Sie lässt sich mit demselben Passwort bzw. Keyfile '
+            'öffnen.'.format(error),
+            box.Save | box.Discard | box.Cancel, box.Save
+        )
+        if answer == box.Discard:
+            self.handler.release()
+            return True
+        if answer != box.Save:
+            return False
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Kopie speichern', str(self.handler.crypted.parent),
+            'Noten Dateien (*.gmandb)'
+        )
+        if not filename:
+            return False
+        try:
+            self.handler.save_copy(filename)
+        except (OSError, crypto.SetupError) as copy_error:
+            box.critical(self, 'Fehler beim Speichern', str(copy_error))
+            return False
+        self.handler.release()
+        self.status.showMessage('Kopie gespeichert: {}'.format(filename))
+        return True
+
+    def _reopen(self):
+        """Open the still decrypted database again after closing failed."""
+        self._loaded = None
+        self.load_db(self.handler)
+
+
+def _startup_done(profile):
+    profile.phase('erstes Ereignis')
+    profile.uninstall()
+    profile.report()
+
 
-def main():
+def main(profile=None):
     if len(sys.argv) > 1:
         crypted_db = sys.argv.pop(1)
     else:
         crypted_db = ''
     app = QtWidgets.QApplication(sys.argv)
+    if profile is not None:
+        profile.phase('QApplication')
     gmm = GradeManagerMain(crypted_db)
+    if profile is not None:
+        profile.phase('Hauptfenster')
     gmm.show()
+    if profile is not None:
+        profile.phase('Anzeigen')
+        QtCore.QTimer.singleShot(0, partial(_startup_done, profile))
     return app.exec_()
 
 
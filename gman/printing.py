@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from PyQt5 import QtCore, QtGui, QtPrintSupport
+
+from . import db, reports
+
+
+def logo_src(data):
+    return reports.LOGO_RESOURCE if data.base.logo else ''
+
+
+def make_document(html, logo=None):
+    """Build a QTextDocument, the logo is added once as shared resource.
+
+    Only QImage is used, so this is safe to call outside the GUI thread.
+    """
+    doc = QtGui.QTextDocument()
+    if logo:
+        doc.addResource(
+            QtGui.QTextDocument.ImageResource,
+            QtCore.QUrl(reports.LOGO_RESOURCE),
+            QtGui.QImage.fromData(logo)
+        )
+    doc.setHtml(html)
+    return doc
+
+
+def write_pdf(html, path, logo=None):
+    doc = make_document(html, logo)
+    writer = QtGui.QPdfWriter(path)
+    writer.setPageSize(QtGui.QPagedPaintDevice.A4)
+    writer.setResolution(300)
+    writer.setCreator('bbz Notenmanager')
+    doc.print_(writer)
+
+
+def preview(parent, data, html):
+    doc = make_document(html, data.base.logo)
+    printer = QtPrintSupport.QPrinter(QtPrintSupport.QPrinter.HighResolution)
+    dlg = QtPrintSupport.QPrintPreviewDialog(printer, parent)
+    dlg.setWindowTitle('Druckvorschau')
+    dlg.paintRequested.connect(doc.print_)
+    dlg.exec_()
+
+
+class _JobSignals(QtCore.QObject):
+
+    prepared = QtCore.pyqtSignal(object)
+    done = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str, str)
+
+
+class RenderJob(QtCore.QRunnable):
+    """Queries the report data and renders all pages in a pool thread.
+
+    The job uses its own session from `Session`, the GUI thread is not
+    blocked by the queries or the templates. Emits prepared with a list
+    of (html, path), the logo and the pks of the exported courses.
+    """
+
+    def __init__(self, Session, target_dir, signals, cancelled):
+        QtCore.QRunnable.__init__(self)
+        self.Session = Session
+        self.target_dir = target_dir
+        self.signals = signals
+        self.cancelled = cancelled
+
+    def pages(self, data, src):
+        used = set()
+
+        def path(name, suffix):
+            filename = reports.safe_filename(name, 'pdf')
+            if filename in used:
+                # two students with the same name or a student named
+                # like the group
+                filename = reports.safe_filename(
+                    '{} {}'.format(name, suffix), 'pdf'
+                )
+            used.add(filename)
+            return os.path.join(self.target_dir, filename)
+
+        for student, html in reports.render_student_sheets(data, src):
+            if self.cancelled.is_set():
+                return
+            yield html, path(student.fullname, student.pk)
+        yield (reports.render_summary(data, src),
+               path(data.base.group_name, 'Gruppe'))
+
+    def run(self):
+        session = self.Session()
+        try:
+            data = reports.ReportData(session)
+            courses = [c.pk for c in data.courses if data.standings[c.pk]]
+            pages = list(self.pages(data, logo_src(data)))
+            logo = data.base.logo
+        except Exception as error:
+            self.signals.failed.emit(self.target_dir, str(error))
+            return
+        finally:
+            session.close()
+        self.signals.prepared.emit((pages, logo, courses))
+
+
+class PdfJob(QtCore.QRunnable):
+    """Lays out one HTML page and writes it as PDF in a pool thread."""
+
+    def __init__(self, html, path, logo, signals, cancelled):
+        QtCore.QRunnable.__init__(self)
+        self.html = html
+        self.path = path
+        self.logo = logo
+        self.signals = signals
+        self.cancelled = cancelled
+
+    def run(self):
+        if self.cancelled.is_set():
+            self.signals.done.emit(self.path)
+            return
+        try:
+            write_pdf(self.html, self.path, self.logo)
+        except Exception as error:
+            self.signals.failed.emit(self.path, str(error))
+        else:
+            self.signals.done.emit(self.path)
+
+
+class BatchExporter(QtCore.QObject):
+    """Exports one PDF per student plus a summary of the whole group.
+
+    Queries and rendering (RenderJob) as well as layout and PDF generation
+    (PdfJob) run in a thread pool, every job with its own session from
+    `Session`. When all files are written the exported courses are marked
+    as printed in a single transaction. cancel() returns at once, pending
+    jobs are skipped and finished is emitted when the running ones end.
+    """
+
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(list)
+
+    def __init__(self, Session, target_dir, parent=None, mark_printed=True):
+        QtCore.QObject.__init__(self, parent)
+        self.Session = Session
+        self.target_dir = target_dir
+        self.mark_printed = mark_printed
+        self.pool = QtCore.QThreadPool(self)
+        self.failures = []
+        self.paths = []
+        self.total = 0
+        self.count = 0
+        self.cancelled = False
+        self._cancel = threading.Event()
+        self._courses = []
+        self._signals = _JobSignals(self)
+        self._signals.prepared.connect(self._prepared)
+        self._signals.done.connect(self._job_done)
+        self._signals.failed.connect(self._job_failed)
+
+    def start(self):
+        os.makedirs(self.target_dir, exist_ok=True)
+        self.progress.emit(0, 0)
+        self.pool.start(RenderJob(self.Session, self.target_dir,
+                                  self._signals, self._cancel))
+
+    def _prepared(self, result):
+        pages, logo, self._courses = result
+        if self.cancelled:
+            self.finished.emit(self.failures)
+            return
+        self.total = len(pages)
+        self.progress.emit(0, self.total)
+        for html, path in pages:
+            self.pool.start(PdfJob(html, path, logo, self._signals,
+                                   self._cancel))
+
+    def cancel(self):
+        self.cancelled = True
+        self._cancel.set()
+
+    def wait(self):
+        self.pool.waitForDone()
+
+    def _job_failed(self, path, error):
+        self.failures.append((path, error))
+        if not self.total:
+            # rendering failed, there are no PDF jobs
+            self.finished.emit(self.failures)
+            return
+        self._count()
+
+    def _job_done(self, path):
+        if not self.cancelled:
+            self.paths.append(path)
+        self._count()
+
+    def _count(self):
+        self.count += 1
+        if not self.cancelled:
+            self.progress.emit(self.count, self.total)
+        if self.count < self.total:
+            return
+        if not self.failures and not self.cancelled and self.mark_printed:
+            self._mark_printed()
+        self.finished.emit(self.failures)
+
+    def _mark_printed(self):
+        if not self._courses:
+            return
+        session = self.Session()
+        try:
+            session.query(db.Course).filter(
+                db.Course.pk.in_(self._courses)
+            ).update({db.Course.printed: True}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
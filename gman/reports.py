@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import os
+import re
+
+from datetime import date
+
+import jinja2
+
+from sqlalchemy.orm import joinedload
+
+from . import db, grades, utils
+
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(PATH, 'templates')
+LOGO_RESOURCE = 'gman-logo'
+
+_environment = None
+
+
+def format_points(value):
+    if value is None:
+        return '-'
+    return '{:.1f}'.format(value).replace('.', ',')
+
+
+def format_date(value):
+    try:
+        return value.strftime('%d.%m.%Y')
+    except AttributeError:
+        return '-'
+
+
+def format_rating(rating):
+    if rating is None:
+        return '-'
+    grade = '{:.1f}'.format(rating.school_grade).replace('.', ',')
+    if rating.text_rating:
+        return '{} ({})'.format(grade, rating.text_rating)
+    return grade
+
+
+def get_environment():
+    """Return the process wide Jinja2 environment.
+
+    Compiled templates stay in the environment's cache and the bytecode is
+    additionally stored on disk, so only the first report after a fresh
+    start or an update has to compile anything.
+    """
+    global _environment
+    if _environment is None:
+        cache = utils.cache_dir('templates')
+        if cache is not None:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache)
+        else:
+            bytecode_cache = None
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATE_PATH),
+            autoescape=jinja2.select_autoescape(['html']),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False,
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        env.filters['points'] = format_points
+        env.filters['date'] = format_date
+        env.filters['rating'] = format_rating
+        _environment = env
+    return _environment
+
+
+def safe_name(text):
+    return re.sub(r'[^\w.-]+', '_', text).strip('_')
+
+
+def safe_filename(text, ext):
+    return '{}.{}'.format(safe_name(text), ext)
+
+
+def logo_data_uri(data):
+    if not data:
+        return ''
+    if data.startswith(b'\xff\xd8'):
+        mime = 'image/jpeg'
+    else:
+        mime = 'image/png'
+    return 'data:{};base64,{}'.format(
+        mime, base64.b64encode(data).decode('ascii')
+    )
+
+
+class ReportData:
+    """Collects everything needed to render the sheets of one group.
+
+    All grades are loaded with one query per course and kind, so rendering
+    the whole group does not hit the database per student.
+    """
+
+    def __init__(self, session, students=None, until=None):
+        self.base = session.query(db.BaseData).first()
+        self.courses = session.query(db.Course).order_by(
+            db.Course.start
+        ).all()
+        if students is None:
+            students = session.query(db.Student).options(
+                joinedload(db.Student.company)
+            ).filter(db.Student.show.is_(True)).order_by(
+                db.Student.last_name, db.Student.first_name
+            ).all()
+        self.students = students
+        self.standings = {
+            c.pk: grades.course_standings(session, c, until)
+            for c in self.courses
+        }
+        self._ratings = {}
+        for course in self.courses:
+            if course.rating not in self._ratings:
+                self._ratings[course.rating] = grades.rating_table(
+                    session, course.rating
+                )
+        self.today = date.today()
+        self._logo_src = None
+
+    @property
+    def logo_src(self):
+        """The logo as data URI, encoded once per batch."""
+        if self._logo_src is None:
+            self._logo_src = logo_data_uri(self.base.logo)
+        return self._logo_src
+
+    def _row(self, course, standing, **kw):
+        rating = grades.rate(standing.total, self._ratings[course.rating])
+        return dict(course=course, standing=standing, rating=rating, **kw)
+
+    def student_rows(self, student):
+        rows = []
+        for course in self.courses:
+            standing = self.standings[course.pk].get(student.pk)
+            if standing is not None:
+                rows.append(self._row(course, standing))
+        return rows
+
+    def course_rows(self, course):
+        standings = self.standings[course.pk]
+        empty = grades.Standing(None, None, None)
+        return [
+            self._row(course, standings.get(s.pk, empty), student=s)
+            for s in self.students
+        ]
+
+    def summary_rows(self):
+        """One row per student with a cell for every course."""
+        empty = grades.Standing(None, None, None)
+        rows = []
+        for student in self.students:
+            cells = [
+                self._row(c, self.standings[c.pk].get(student.pk, empty))
+                for c in self.courses
+            ]
+            rows.append((student, cells))
+        return rows
+
+
+def _context(data, logo_src, **kw):
+    if logo_src is None:
+        logo_src = data.logo_src
+    return dict(base=data.base, logo_src=logo_src, today=data.today, **kw)
+
+
+def render_student_sheets(data, logo_src=None):
+    """Render one page per student, returns a list of (student, html)."""
+    template = get_environment().get_template('student.html')
+    ctx = _context(data, logo_src)
+    return [
+        (s, template.render(student=s, rows=data.student_rows(s), **ctx))
+        for s in data.students
+    ]
+
+
+def render_course_sheet(data, course, logo_src=None):
+    template = get_environment().get_template('course.html')
+    return template.render(
+        **_context(data, logo_src, course=course,
+                   rows=data.course_rows(course))
+    )
+
+
+def render_group(data, logo_src=None):
+    """Render the sheets of all students into a single document."""
+    template = get_environment().get_template('group.html')
+    sheets = [(s, data.student_rows(s)) for s in data.students]
+    return template.render(**_context(data, logo_src, sheets=sheets))
+
+
+def render_summary(data, logo_src=None):
+    template = get_environment().get_template('summary.html')
+    return template.render(
+        **_context(data, logo_src, courses=data.courses,
+                   rows=data.summary_rows())
+    )
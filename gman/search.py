@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Full text search over students, courses, experiments, tests and notes.
+
+The SQLite FTS5 table search_index is kept up to date by triggers on the
+source tables, so every write path (ORM, bulk inserts, raw SQL) is
+covered. The rowid of an index row is the key of its source row times 8
+plus the kind code, deleting or replacing a row is a rowid lookup. Keys
+are primary keys, not SQLite rowids, which VACUUM may renumber.
+"""
+
+import re
+
+from collections import namedtuple
+
+
+TABLE = 'search_index'
+
+Hit = namedtuple('Hit', 'kind ref parent title snippet')
+
+# kind: (code, table, key, ref, parent, title, body, indexed columns)
+SOURCES = {
+    'student': (1, 'students', '{0}.pk', '{0}.pk', 'NULL',
+                "{0}.last_name || COALESCE(', ' || {0}.first_name, '')",
+                'NULL', 'last_name, first_name'),
+    'course': (2, 'courses', '{0}.pk', '{0}.pk', 'NULL', '{0}.title',
+               '{0}.trainer', 'title, trainer'),
+    'experiment': (3, 'experiments', '{0}.pk', '{0}.pk', '{0}.course_id',
+                   '{0}.title', '{0}.notes', 'title, notes, course_id'),
+    'test': (4, 'tests', '{0}.pk', '{0}.pk', '{0}.course_id',
+             '{0}.subject', '{0}.notes', 'subject, notes, course_id'),
+    'note': (5, 'conference_student',
+             '({0}.conference_id * 1048576 + {0}.student_id)',
+             '{0}.student_id', '{0}.conference_id', 'NULL', '{0}.note',
+             'note, conference_id, student_id'),
+}
+
+_CREATE = (
+    'CREATE VIRTUAL TABLE {} USING fts5(kind UNINDEXED, ref UNINDEXED, '
+    "parent UNINDEXED, title, body, tokenize='unicode61 remove_diacritics 2',"
+    " prefix='2 3')".format(TABLE)
+)
+_COLUMNS = 'INSERT INTO {}(rowid, kind, ref, parent, title, body) '.format(
+    TABLE
+)
+_VALUES = "{key} * 8 + {code}, '{kind}', {ref}, {parent}, {title}, {body}"
+_DELETE = 'DELETE FROM {table} WHERE rowid = {key} * 8 + {code};'
+_TRIGGER = ('CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {source} '
+            'BEGIN {body} END')
+
+
+def _statement(template, kind, row):
+    code, _, key, ref, parent, title, body, _ = SOURCES[kind]
+    return template.format(table=TABLE, code=code, kind=kind,
+                           key=key.format(row), ref=ref.format(row),
+                           parent=parent.format(row),
+                           title=title.format(row), body=body.format(row))
+
+
+def _triggers(kind):
+    source, columns = SOURCES[kind][1], SOURCES[kind][-1]
+    insert = '{}VALUES ({});'.format(_COLUMNS,
+                                     _statement(_VALUES, kind, 'new'))
+    delete = _statement(_DELETE, kind, 'old')
+    yield 'search_{}_insert'.format(source), 'INSERT', insert
+    yield 'search_{}_delete'.format(source), 'DELETE', delete
+    yield ('search_{}_update'.format(source),
+           'UPDATE OF {}'.format(columns), delete + ' ' + insert)
+
+
+def available(connection):
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (TABLE,)
+    ).scalar() is not None
+
+
+def _install_triggers(connection):
+    """Create missing triggers and replace outdated ones, returns True if
+    any trigger was created."""
+    changed = False
+    for kind, (_, source, *_) in SOURCES.items():
+        for name, event, body in _triggers(kind):
+            sql = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'trigger' "
+                'AND name = ?', (name,)
+            ).scalar()
+            if sql is not None and body in sql:
+                continue
+            if sql is not None:
+                connection.execute('DROP TRIGGER {}'.format(name))
+            connection.execute(_TRIGGER.format(
+                name=name, event=event, source=source, body=body
+            ))
+            changed = True
+    return changed
+
+
+def install(connection):
+    """Create index and triggers if missing, returns True if created.
+
+    Triggers of an older version are replaced and the index is rebuilt.
+    Without FTS5 support in SQLite nothing is created.
+    """
+    if available(connection):
+        if _install_triggers(connection):
+            rebuild(connection)
+        return False
+    try:
+        connection.execute(_CREATE)
+    except Exception as error:
+        if 'fts5' not in str(error):
+            raise
+        return False
+    _install_triggers(connection)
+    rebuild(connection)
+    return True
+
+
+def rebuild(connection):
+    """Fill the index from scratch."""
+    connection.execute('DELETE FROM {}'.format(TABLE))
+    for kind, (_, source, *_) in SOURCES.items():
+        connection.execute('{}SELECT {} FROM {}'.format(
+            _COLUMNS, _statement(_VALUES, kind, source), source
+        ))
+
+
+def match_query(text):
+    """FTS5 query matching all words of `text` as prefixes."""
+    return ' '.join('"{}"*'.format(word) for word in re.findall(r'\w+', text))
+
+
+def search(connection, text, limit=50):
+    """Best matches for `text` as list of Hit."""
+    query = match_query(text)
+    if not query or not available(connection):
+        return []
+    rows = connection.execute(
+        "SELECT kind, ref, parent, title, snippet({0}, 4, '', '', '...', 8) "
+        'FROM {0} WHERE {0} MATCH ? ORDER BY rank LIMIT ?'.format(TABLE),
+        (query, limit)
+    )
+    return [Hit(*row) for row in rows]
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Opt-in profiler for the SQL statements sent by SQLAlchemy.
+
+Statements are normalized (literals replaced by ?) and aggregated to
+count, total and 95th percentile time. Statements can be grouped into
+actions (e.g. one menu command); a statement repeated many times with
+different parameters inside one action is reported as N+1 suspect.
+
+    profiler = sqlprofile.enable()
+    with profiler.action('Datenbank laden'):
+        ...
+    print(profiler.format_report())
+"""
+
+import re
+import threading
+
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from time import perf_counter
+
+
+N_PLUS_ONE = 10
+MAX_SAMPLES = 10000
+
+_WHITESPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'IN \((?:\?, )*\?\)', re.IGNORECASE)
+
+_profiler = None
+
+
+def normalize(statement):
+    statement = _WHITESPACE.sub(' ', statement.strip())
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    return _IN_LIST.sub('IN (?)', statement)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class StatementStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    @property
+    def p95(self):
+        return percentile(self.samples, 0.95)
+
+
+class Profiler:
+
+    def __init__(self, n_plus_one=N_PLUS_ONE):
+        self.n_plus_one = n_plus_one
+        self.statements = defaultdict(StatementStats)
+        self.suspects = {}
+        self._local = threading.local()
+        self._target = None
+
+    # engine events
+    def attach(self, target=None):
+        """Listen on `target`, an engine or by default all engines."""
+        import sqlalchemy as sa
+        self._target = sa.engine.Engine if target is None else target
+        sa.event.listen(self._target, 'before_cursor_execute', self._before)
+        sa.event.listen(self._target, 'after_cursor_execute', self._after)
+
+    def detach(self):
+        import sqlalchemy as sa
+        if self._target is None:
+            return
+        sa.event.remove(self._target, 'before_cursor_execute', self._before)
+        sa.event.remove(self._target, 'after_cursor_execute', self._after)
+        self._target = None
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('gman_query_start', []).append(perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        seconds = perf_counter() - conn.info['gman_query_start'].pop()
+        key = normalize(statement)
+        self.statements[key].add(seconds)
+        action = getattr(self._local, 'action', None)
+        if action is not None:
+            # count and up to two distinct parameter sets
+            entry = action[1].setdefault(key, [0, set()])
+            entry[0] += 1
+            if len(entry[1]) < 2:
+                entry[1].add(repr(parameters))
+
+    # actions
+    @contextmanager
+    def action(self, name):
+        """Group the statements of one UI or CLI action."""
+        outer = getattr(self._local, 'action', None)
+        self._local.action = (name, {})
+        try:
+            yield
+        finally:
+            name, seen = self._local.action
+            self._local.action = outer
+            for statement, (count, params) in seen.items():
+                if count >= self.n_plus_one and len(params) > 1:
+                    self.suspects[(name, statement)] = count
+
+    def reset(self):
+        self.statements.clear()
+        self.suspects.clear()
+
+    # results
+    def report(self):
+        """Rows (statement, count, total, p95) sorted by total time."""
+        rows = [(s, st.count, st.total, st.p95)
+                for s, st in self.statements.items()]
+        return sorted(rows, key=lambda r: -r[2])
+
+    def format_report(self, limit=20):
+        lines = ['{:>6} {:>10} {:>9}  Anweisung'.format(
+            'Anzahl', 'gesamt', 'p95'
+        )]
+        for statement, count, total, p95 in self.report()[:limit]:
+            lines.append('{:6} {:7.1f} ms {:6.2f} ms  {}'.format(
+                count, total * 1000, p95 * 1000, statement[:120]
+            ))
+        for (action, statement), count in sorted(self.suspects.items()):
+            lines.append('N+1? {} x in "{}": {}'.format(
+                count, action, statement[:120]
+            ))
+        return '\n'.join(lines)
+
+
+def enable(n_plus_one=N_PLUS_ONE):
+    """Create and attach the global profiler (once)."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(n_plus_one)
+        _profiler.attach()
+    return _profiler
+
+
+def get_profiler():
+    """The global profiler or None if profiling is not enabled."""
+    return _profiler
+
+
+@contextmanager
+def action(name):
+    """Profiler.action() of the global profiler, no-op when disabled."""
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.action(name):
+            yield
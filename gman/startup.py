@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Start the GUI, optionally with a startup time breakdown.
+
+With --startup-profile the time spent importing each module (without
+its own imports) and the time of every startup phase is printed once the
+event loop runs. Only the standard library is imported here, so the
+measurement covers all of PyQt5, SQLAlchemy etc. With --sql-profile the
+SQL statements are measured and shown in the menu Hilfe > SQL-Profil,
+--trace records timing spans (Hilfe > Ablauf speichern...).
+"""
+
+import importlib.abc
+import sys
+
+from collections import defaultdict
+from time import perf_counter
+
+
+FLAG = '--startup-profile'
+SQL_FLAG = '--sql-profile'
+TRACE_FLAG = '--trace'
+
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Wraps the loaders of all modules imported while installed."""
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.stack = []
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        loader = spec.loader
+        if (loader is None or isinstance(loader, type) or
+                not hasattr(loader, 'exec_module')):
+            return spec
+        # extension modules do their work in create_module
+        for method in ('create_module', 'exec_module'):
+            if hasattr(loader, method):
+                setattr(loader, method,
+                        self._timed(name, getattr(loader, method)))
+        return spec
+
+    def _timed(self, name, func):
+        def timed(*args):
+            start = perf_counter()
+            self.stack.append(0.0)
+            try:
+                return func(*args)
+            finally:
+                elapsed = perf_counter() - start
+                children = self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += elapsed
+                self.profile.add_import(name, elapsed - children)
+        return timed
+
+
+class StartupProfile:
+
+    def __init__(self):
+        self.start = self.last = perf_counter()
+        self.phases = []
+        self.imports = defaultdict(float)
+        self._timer = None
+
+    def install(self):
+        self._timer = _ImportTimer(self)
+        sys.meta_path.insert(0, self._timer)
+
+    def uninstall(self):
+        if self._timer in sys.meta_path:
+            sys.meta_path.remove(self._timer)
+
+    def add_import(self, name, seconds):
+        # own modules are listed one by one, others per package
+        key = name if name.startswith('gman') else name.split('.')[0]
+        self.imports[key] += seconds
+
+    def phase(self, name):
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self, fp=None, top=15):
+        fp = fp or sys.stderr
+        total = sum(self.imports.values())
+        print('Imports ({:.0f} ms):'.format(total * 1000), file=fp)
+        ranked = sorted(self.imports.items(), key=lambda i: -i[1])
+        for name, seconds in ranked[:top]:
+            print('  {:8.1f} ms  {}'.format(seconds * 1000, name), file=fp)
+        print('Phasen:', file=fp)
+        for name, seconds in self.phases:
+            print('  {:8.1f} ms  {}'.format(seconds * 1000, name), file=fp)
+        print('  {:8.1f} ms  gesamt'.format(
+            (self.last - self.start) * 1000), file=fp)
+
+
+def main(argv=None):
+    argv = sys.argv if argv is None else argv
+    profile = None
+    if FLAG in argv:
+        argv.remove(FLAG)
+        profile = StartupProfile()
+        profile.install()
+    if SQL_FLAG in argv:
+        argv.remove(SQL_FLAG)
+        from . import sqlprofile
+        sqlprofile.enable()
+    if TRACE_FLAG in argv:
+        argv.remove(TRACE_FLAG)
+        from . import tracing
+        tracing.enable()
+    from .main_window import main as gui_main
+    if profile is not None:
+        profile.phase('Import Hauptfenster')
+    return gui_main(profile)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Lightweight timing spans for the GUI and the command line.
+
+Spans nest per thread and the most recent ones are kept in a ring buffer,
+which can be written as Chrome trace JSON (chrome://tracing, Perfetto).
+As long as tracing is not enabled span() returns a shared no-op object,
+so spans can stay on hot paths.
+
+    with tracing.span('load_db', path=path):
+        ...
+    tracing.enable()
+    tracing.save('trace.json')
+
+Independent of the spans one action can be run under cProfile, see
+profile_next() and action().
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+
+BUFFER = 5000
+
+_enabled = False
+_spans = deque(maxlen=BUFFER)
+_local = threading.local()
+_origin = perf_counter()
+_profile_next = False
+_profile_dir = None
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+
+    __slots__ = ('name', 'args', 'thread', 'depth', 'start', 'duration')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.thread = threading.get_ident()
+        self.start = self.duration = None
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = perf_counter() - self.start
+        _local.stack.pop()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        _spans.append(self)
+        return False
+
+    def set(self, **args):
+        """Add arguments known only inside the span (e.g. counts)."""
+        self.args.update(args)
+
+
+def span(name, **args):
+    """Context manager timing the enclosed block."""
+    if not _enabled:
+        return NULL_SPAN
+    return Span(name, args)
+
+
+def traced(name):
+    """Decorator, runs the function inside span(name)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kw):
+            if not _enabled:
+                return func(*args, **kw)
+            with Span(name, {}):
+                return func(*args, **kw)
+        return wrapper
+    return decorator
+
+
+def enable(buffer=BUFFER):
+    global _enabled, _spans
+    if buffer != _spans.maxlen:
+        _spans = deque(_spans, maxlen=buffer)
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    _spans.clear()
+
+
+def spans():
+    """Finished spans, oldest first."""
+    return list(_spans)
+
+
+def chrome_trace():
+    """The buffered spans in the Chrome trace event format."""
+    pid = os.getpid()
+    events = [dict(name=s.name, cat='gman', ph='X', pid=pid, tid=s.thread,
+                   ts=round((s.start - _origin) * 1e6, 1),
+                   dur=round(s.duration * 1e6, 1),
+                   args={k: str(v) for k, v in s.args.items()})
+              for s in list(_spans)]
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+
+def save(path):
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(chrome_trace(), fp)
+    return len(_spans)
+
+
+def profile_next(directory):
+    """Run the next action() under cProfile, stats go to `directory`."""
+    global _profile_next, _profile_dir
+    _profile_dir = directory
+    _profile_next = True
+
+
+class Action:
+
+    def __init__(self, name):
+        self.name = name
+        self.profile_path = None
+
+
+@contextmanager
+def action(name, **args):
+    """A span for one user action, profiled if profile_next() was called.
+
+    Yields an Action, its `profile_path` is set after the block if a
+    profile was written (.prof for pstats/snakeviz, .txt summary).
+    """
+    global _profile_next
+    result = Action(name)
+    profiler = None
+    if _profile_next:
+        _profile_next = False
+        profiler = cProfile.Profile()
+    with span(name, **args):
+        if profiler is None:
+            yield result
+        else:
+            profiler.enable()
+            try:
+                yield result
+            finally:
+                profiler.disable()
+                result.profile_path = _dump(profiler, name)
+
+
+def _dump(profiler, name):
+    os.makedirs(_profile_dir, exist_ok=True)
+    base = os.path.join(_profile_dir, '{}-{}'.format(
+        re.sub(r'\W+', '_', name).strip('_') or 'action',
+        len(os.listdir(_profile_dir))
+    ))
+    profiler.dump_stats(base + '.prof')
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(
+        30
+    )
+    with open(base + '.txt', 'w', encoding='utf-8') as fp:
+        fp.write(text.getvalue())
+    return base + '.prof'
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Load Qt Designer files through precompiled Python modules.
+
+Every .ui file is compiled once with pyuic into the user cache directory.
+The module name contains hashes of the path and the content of the .ui
+file, so a changed file is compiled again. Opening a window then only
+imports a module instead of parsing XML and generating code. If the
+cache is not writeable, uic.loadUi is used as before.
+"""
+
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+
+from PyQt5 import QtCore, uic
+
+from . import utils
+
+
+log = logging.getLogger(__name__)
+_modules = {}
+
+
+def _cache_dir():
+    return utils.cache_dir('ui', QtCore.PYQT_VERSION_STR)
+
+
+def compile_ui(ui_file, target):
+    """Compile `ui_file` to the Python module `target` (atomically)."""
+    code = io.StringIO()
+    with open(ui_file, encoding='utf-8') as fp:
+        uic.compileUi(fp, code, from_imports=True, import_from='gman',
+                      resource_suffix='')
+    tmp = '{}.{}.tmp'.format(target, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as fp:
+        fp.write(code.getvalue())
+    os.replace(tmp, target)
+
+
+def _digest(data, length):
+    return hashlib.sha256(data).hexdigest()[:length]
+
+
+def get_form_class(ui_file):
+    """Return the generated Ui_* class for `ui_file` or None."""
+    directory = _cache_dir()
+    if directory is None:
+        return None
+    with open(ui_file, 'rb') as fp:
+        source = fp.read()
+    # checkouts, installs and files of the same name never share a module
+    prefix = 'ui_{}_{}_'.format(
+        os.path.splitext(os.path.basename(ui_file))[0],
+        _digest(os.fsencode(os.path.abspath(ui_file)), 8)
+    )
+    name = prefix + _digest(source, 16)
+    cached = _modules.get(name)
+    if cached is not None:
+        return cached
+    target = os.path.join(directory, name + '.py')
+    if not os.path.isfile(target):
+        compile_ui(ui_file, target)
+        for old in os.listdir(directory):
+            if old.startswith(prefix) and old != name + '.py':
+                try:
+                    os.remove(os.path.join(directory, old))
+                except OSError:
+                    pass
+    spec = importlib.util.spec_from_file_location(
+        'gman._ui.{}'.format(name), target
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    form = next(getattr(module, n) for n in dir(module)
+                if n.startswith('Ui_'))
+    _modules[name] = form
+    return form
+
+
+def load_ui(ui_file, widget):
+    """Drop-in replacement for uic.loadUi(ui_file, widget)."""
+    try:
+        form = get_form_class(ui_file)
+    except Exception as error:
+        log.warning('Precompiling %s failed: %s', ui_file, error)
+        form = None
+    if form is None:
+        return uic.loadUi(ui_file, widget)
+    ui = form()
+    ui.setupUi(widget)
+    # like uic.loadUi: child widgets become attributes of `widget`
+    for name, value in vars(ui).items():
+        setattr(widget, name, value)
+    return widget
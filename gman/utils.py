@@ -1,15 +1,41 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 from io import BytesIO
-from PIL import Image
+from itertools import islice
 
 
 MAX_SIZE = (200, 200)
 
 
 def make_image(path):
+    from PIL import Image
     im = Image.open(path)
     im.thumbnail(MAX_SIZE)
     buffered = BytesIO()
     im.save(buffered, format='PNG')
     return buffered.getvalue()
+
+
+def cache_dir(*parts):
+    """Return a per user cache directory (created on demand) or None."""
+    base = (os.environ.get('LOCALAPPDATA') or
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    path = os.path.join(base, 'gman', *parts)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    return path
+
+
+def batches(iterable, size):
+    """Split `iterable` into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -5,9 +5,11 @@ import os
 from datetime import date, timedelta
 from collections import OrderedDict
 from functools import partial
-from PyQt5 import Qt, QtCore, QtGui, QtWidgets, uic
+from PyQt5 import Qt, QtCore, QtGui, QtWidgets
+from sqlalchemy.orm import joinedload
 
-from . import crypto, db, dialogs, items, resources, utils
+from . import (conference, crypto, db, dialogs, icons, items, reports,
+               resources, tracing, uicache, utils)
 from .data import IHK, COURSES
 
 
@@ -23,7 +25,7 @@ class CreateDBWizard(QtWidgets.QWizard):
         self.status = status
         self.values = OrderedDict()
         self.setWindowTitle('Neue Datenbank erstellen')
-        self.setWindowIcon(QtGui.QIcon(':/icons/db-new'))
+        self.setWindowIcon(icons.icon('db-new'))
         self.addPage(CreateDBWizardPage1(ui_path, self))
         self.addPage(CreateDBWizardPage2(ui_path, self))
         self.addPage(CreateDBWizardPage3(ui_path, self))
@@ -89,7 +91,7 @@ class CreateDBWizardPage1(QtWidgets.QWizardPage):
 
     def __init__(self, ui_path, parent):
         QtWidgets.QWizardPage.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'create_db_wiz_1.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'create_db_wiz_1.ui'), self)
         self.btn_logo.clicked.connect(self.get_logo)
 
     def validatePage(self):
@@ -112,7 +114,7 @@ class CreateDBWizardPage2(QtWidgets.QWizardPage):
 
     def __init__(self, ui_path, parent):
         QtWidgets.QWizardPage.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'create_db_wiz_2.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'create_db_wiz_2.ui'), self)
         self.btn_path.clicked.connect(self.get_path)
 
     def validatePage(self):
@@ -140,9 +142,9 @@ class CreateDBWizardPage3(QtWidgets.QWizardPage):
 
     def __init__(self, ui_path, parent):
         QtWidgets.QWizardPage.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'create_db_wiz_3.ui'), self)
-        self.yes = QtGui.QPixmap(':/icons/yes')
-        self.no = QtGui.QPixmap(':/icons/no')
+        uicache.load_ui(os.path.join(ui_path, 'create_db_wiz_3.ui'), self)
+        self.yes = icons.pixmap('yes')
+        self.no = icons.pixmap('no')
         self.opt_keyfile.toggled.connect(self._enable_fields)
         self.password_1.textChanged.connect(self._validate_passwords)
         self.password_2.textChanged.connect(self._validate_pw_2)
@@ -210,7 +212,7 @@ class CreateDBWizardPage4(QtWidgets.QWizardPage):
 
     def __init__(self, ui_path, parent):
         QtWidgets.QWizardPage.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'create_db_wiz_4.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'create_db_wiz_4.ui'), self)
         self.btn_password.pressed.connect(self._show_password)
         self.btn_password.released.connect(self._hide_password)
         self.btn_create_db.clicked.connect(self._create_db)
@@ -238,17 +240,17 @@ class CreateDBWizardPage4(QtWidgets.QWizardPage):
         self.password.setText('***')
 
     def _create_db(self, checked):
-        print('Create DB')
         self.btn_create_db.setDisabled(True)
-        self.wizard().create_new_db()
-        self.btn_create_db.setIcon(QtGui.QIcon(':/icons/yes'))
+        with tracing.span('create_db'):
+            self.wizard().create_new_db()
+        self.btn_create_db.setIcon(icons.icon('yes'))
 
 
 class CompaniesWidget(QtWidgets.QWidget):
 
     def __init__(self, ui_path, status, session, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'companies.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'companies.ui'), self)
         self.status = status
         self.session = session
         self.to_remove = []
@@ -316,7 +318,7 @@ class StudentsWidget(QtWidgets.QWidget):
 
     def __init__(self, ui_path, status, session, new_count=0, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'students.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'students.ui'), self)
         self.status = status
         self.session = session
         self.new_count = new_count
@@ -363,7 +365,9 @@ class StudentsWidget(QtWidgets.QWidget):
         return wid
 
     def load_data(self):
-        q = self.session.query(db.Student).order_by(db.Student.last_name)
+        q = self.session.query(db.Student).options(
+            joinedload(db.Student.photo_blob)
+        ).order_by(db.Student.last_name)
         count = q.count()
         for i, s in enumerate(q.all()):
             self.students[i] = s
@@ -431,11 +435,11 @@ class CourseWidget(QtWidgets.QWidget):
 
     def __init__(self, ui_path, status, session, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'new_course.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'new_course.ui'), self)
         self.ui_path = ui_path
         self.status = status
         self.session = session
-        self.group = self._get_group()
+        self.base = self.session.query(db.BaseData).first()
         self.init_boxes()
         self.trainer.lineEdit().setMaxLength(150)
         self.title.textEdited.connect(self._enable_save)
@@ -449,10 +453,6 @@ class CourseWidget(QtWidgets.QWidget):
         else:
             self.btn_save.setDisabled(True)
 
-    def _get_group(self):
-        data = self.session.query(db.BaseData).first()
-        return data.group_name
-
     def init_boxes(self):
         trainers = set()
         for course in self.session.query(db.Course).all():
@@ -470,18 +470,15 @@ class CourseWidget(QtWidgets.QWidget):
         self.end.setDate(end)
 
     def find_course(self):
-        if self.group.upper().startswith('BW'):
-            job = self.group[2:4]
-        else:
-            job = self.group[:2]
         courses = self.session.query(db.CourseData).filter(
-            db.CourseData.job.like(job.upper())
+            db.CourseData.job.like(self.base.job)
         ).all()
         dlg = dialogs.CourseDialog(self, self.ui_path, courses)
         dlg.show()
 
     def update(self, course):
-        self.course = course
+        self.course = self.session.query(db.Course).get(course.pk)
+        course = self.course
         self.title.setText(course.title)
         self.trainer.setCurrentText(course.trainer)
         d = course.start
@@ -519,7 +516,7 @@ class ExperimentWidget(QtWidgets.QWidget):
 
     def __init__(self, ui_path, session, course=None, parent=None):
         QtWidgets.QWidget.__init__(self, parent)
-        uic.loadUi(os.path.join(ui_path, 'experiment.ui'), self)
+        uicache.load_ui(os.path.join(ui_path, 'experiment.ui'), self)
         self.session = session
         self.practice = None
         self.done_on.setDate(QtCore.QDate.currentDate())
@@ -550,14 +547,15 @@ class ExperimentWidget(QtWidgets.QWidget):
         w = m + r + d
         self.weights.setText('{}%'.format(w))
         if w == 100:
-            self.check_weights.setPixmap(QtGui.QPixmap(':/icons/yes'))
+            self.check_weights.setPixmap(icons.pixmap('yes'))
             self.btn_save.setEnabled(True)
         else:
-            self.check_weights.setPixmap(QtGui.QPixmap(':/icons/no'))
+            self.check_weights.setPixmap(icons.pixmap('no'))
             self.btn_save.setDisabled(True)
 
     def update(self, practice):
-        self.practice = practice
+        self.practice = self.session.query(db.Experiment).get(practice.pk)
+        practice = self.practice
         self.title.setText(practice.title)
         d = practice.done_on
         self.done_on.setDate(QtCore.QDate(d.year, d.month, d.day))
@@ -572,7 +570,6 @@ class ExperimentWidget(QtWidgets.QWidget):
 
     def _set_course_pk(self, index):
         self.current_course_id = self.course.currentData()
-        print('New course id:', self.current_course_id)
         self.btn_save.setEnabled(True)
 
     def _edited(self, *args, **kw):
@@ -581,7 +578,6 @@ class ExperimentWidget(QtWidgets.QWidget):
 
     def save(self, on_close=False):
         title = self.title.text().strip()
-        print('Saving experiment:', title)
         if self.practice is None:
             self.practice = db.Experiment(title=title)
             self.session.add(self.practice)
@@ -597,3 +593,189 @@ class ExperimentWidget(QtWidgets.QWidget):
         self.session.commit()
         if not on_close:
             self.saved.emit()
+
+
+class ConferenceWidget(QtWidgets.QWidget):
+
+    def __init__(self, ui_path, status, session, parent=None,
+                 read_only=False):
+        QtWidgets.QWidget.__init__(self, parent)
+        uicache.load_ui(os.path.join(ui_path, 'conference.ui'), self)
+        self.status = status
+        self.session = session
+        self.read_only = read_only
+        self.current = None
+        self.notes = {}
+        self.date.setDate(QtCore.QDate.currentDate())
+        self.grades_til.setDate(QtCore.QDate.currentDate())
+        self.load_conferences()
+        self.conferences.currentIndexChanged[int].connect(self._select)
+        self.btn_new.clicked.connect(self.new_conference)
+        self.btn_refresh.clicked.connect(self.refresh)
+        self.btn_save.clicked.connect(self.save)
+        if self.conferences.count():
+            self._select(0)
+        self._enable_buttons()
+
+    def _enable_buttons(self):
+        self.btn_new.setEnabled(not self.read_only)
+        self.btn_refresh.setEnabled(self.current is not None)
+        self.btn_save.setEnabled(
+            self.current is not None and not self.read_only
+        )
+
+    def load_conferences(self, current_pk=None):
+        self.conferences.blockSignals(True)
+        self.conferences.clear()
+        q = self.session.query(db.Conference).order_by(
+            db.Conference.date.desc()
+        )
+        for conf in q.all():
+            self.conferences.addItem(str(conf), conf.pk)
+        if current_pk is not None:
+            self.conferences.setCurrentIndex(
+                self.conferences.findData(current_pk)
+            )
+        self.conferences.blockSignals(False)
+
+    def _select(self, index):
+        pk = self.conferences.itemData(index)
+        if pk is not None:
+            self.show_conference(self.session.query(db.Conference).get(pk))
+
+    def show_conference(self, conf, force=False):
+        self.current = conf
+        self.title.setText(conf.title)
+        d = conf.date
+        self.date.setDate(QtCore.QDate(d.year, d.month, d.day))
+        d = conf.grades_til
+        self.grades_til.setDate(QtCore.QDate(d.year, d.month, d.day))
+        self.status.showMessage('Lade Noten bis {:%d.%m.%Y}'.format(d), 5000)
+        grades = conference.snapshot(self.session, conf, force,
+                                     persist=not self.read_only)
+        courses = self.session.query(db.Course).filter(
+            db.Course.start <= conf.grades_til
+        ).order_by(db.Course.start).all()
+        students = conference.students(self.session, conf,
+                                       persist=not self.read_only)
+        self.table.clear()
+        self.table.setRowCount(len(students))
+        self.table.setColumnCount(len(courses) + 2)
+        self.table.setHorizontalHeaderLabels(
+            ['Teilnehmer'] + [c.title for c in courses] + ['Notiz']
+        )
+        self.notes = {}
+        readonly = QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled
+        for row, (student, cs) in enumerate(students):
+            item = QtWidgets.QTableWidgetItem(student.fullname)
+            item.setFlags(readonly)
+            self.table.setItem(row, 0, item)
+            for col, course in enumerate(courses, 1):
+                grade = grades.get((student.pk, course.pk))
+                if grade is None:
+                    item = QtWidgets.QTableWidgetItem('-')
+                else:
+                    item = QtWidgets.QTableWidgetItem(
+                        reports.format_points(grade.total)
+                    )
+                    item.setToolTip('Praxis: {}, Theorie: {}'.format(
+                        reports.format_points(grade.practice),
+                        reports.format_points(grade.theory)
+                    ))
+                item.setFlags(readonly)
+                item.setTextAlignment(
+                    QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter
+                )
+                self.table.setItem(row, col, item)
+            note = QtWidgets.QTableWidgetItem(cs.note)
+            if self.read_only:
+                note.setFlags(readonly)
+            self.table.setItem(row, len(courses) + 1, note)
+            self.notes[row] = cs
+        self.table.resizeColumnsToContents()
+        self._enable_buttons()
+
+    def new_conference(self):
+        today = date.today()
+        conf = db.Conference(title='Konferenz', date=today, grades_til=today)
+        self.session.add(conf)
+        self.session.commit()
+        self.load_conferences(conf.pk)
+        self.show_conference(conf)
+
+    def refresh(self):
+        if self.current is not None:
+            self.show_conference(self.current, force=True)
+
+    def save(self, on_close=False):
+        conf = self.current
+        if conf is None or self.read_only:
+            return
+        grades_til = self.grades_til.date().toPyDate()
+        force = grades_til != conf.grades_til
+        conf.title = self.title.text().strip()
+        conf.date = self.date.date().toPyDate()
+        conf.grades_til = grades_til
+        col = self.table.columnCount() - 1
+        for row, cs in self.notes.items():
+            cs.note = self.table.item(row, col).text()
+        self.session.commit()
+        self.status.showMessage(
+            'Konferenz ({}) wurde gespeichert.'.format(conf.title), 5000
+        )
+        if not on_close:
+            self.load_conferences(conf.pk)
+            self.show_conference(conf, force=force)
+
+
+class SqlProfileWidget(QtWidgets.QWidget):
+
+    def __init__(self, ui_path, profiler, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        uicache.load_ui(os.path.join(ui_path, 'sql_profile.ui'), self)
+        self.profiler = profiler
+        self.btn_refresh.clicked.connect(self.refresh)
+        self.btn_reset.clicked.connect(self.reset)
+        self.refresh()
+
+    def _fill(self, table, headers, rows):
+        table.setSortingEnabled(False)
+        table.clear()
+        table.setColumnCount(len(headers))
+        table.setHorizontalHeaderLabels(headers)
+        table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for col, value in enumerate(values):
+                item = QtWidgets.QTableWidgetItem()
+                # numbers as EditRole, so sorting is numeric
+                item.setData(QtCore.Qt.EditRole, value)
+                if isinstance(value, str):
+                    item.setToolTip(value)
+                else:
+                    item.setTextAlignment(
+                        QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter
+                    )
+                table.setItem(row, col, item)
+        table.resizeColumnsToContents()
+
+    def refresh(self):
+        rows = self.profiler.report()
+        self._fill(self.statements, ['Anzahl', 'gesamt ms', 'p95 ms',
+                                     'Anweisung'],
+                   [(count, round(total * 1000, 2), round(p95 * 1000, 2),
+                     statement)
+                    for statement, count, total, p95 in rows])
+        self.statements.setSortingEnabled(True)
+        self._fill(self.suspects, ['Aktion', 'Anzahl', 'Anweisung'],
+                   [(action, count, statement) for (action, statement), count
+                    in sorted(self.profiler.suspects.items())])
+        self.summary.setText(
+            '{} Anweisungen, {} Ausführungen, {:.1f} ms gesamt'.format(
+                len(rows), sum(r[1] for r in rows),
+                sum(r[2] for r in rows) * 1000
+            )
+        )
+
+    def reset(self):
+        self.profiler.reset()
+        self.refresh()
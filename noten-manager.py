@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
 
-from gman.main_window import main
+from gman.startup import main
 
 main()
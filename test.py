@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import json
 import os
+import tempfile
+import time
 import unittest
 
-from datetime import date
+import sqlalchemy as sa
+
+from cryptography.fernet import Fernet
+from datetime import date, datetime
 from decimal import Decimal as D
-from gman import db, utils
-from gman.crypto import CryptedDBHandler
+from gman import (aggregate, bench, blobs, cli, conference, container,
+                  crypto, db, export, grades, history, icons, importer,
+                  reports, search, sqlprofile, tracing, uicache, utils)
+from gman.crypto import (CryptedDBHandler, SetupError, decrypt_file,
+                         derive_key)
 from gman.data import IHK, COURSES
+from unittest import mock
 
 
 PATH = os.path.dirname(os.path.abspath(__file__))
@@ -122,25 +132,35 @@ def add_theory_grades(session, students, tests):
     return grades
 
 
-def setup_db():
-    handler = CryptedDBHandler(TEST_DB, password=PASSWORD)
+def fill_db(session):
+    db.create_tables(session)
+    create_base_data(session)
+    add_ratings_and_courses(session)
+    course = create_course(session)
+    company = create_company(session)
+    students = create_students(session, company)
+    exps = create_experiments(session, course)
+    tests = create_tests(session, course)
+    add_practice_grades(session, students, exps)
+    add_theory_grades(session, students, tests)
+    return course, students
+
+
+def create_crypted_db(path, password=PASSWORD):
+    handler = CryptedDBHandler(path, password=password)
     db_path = handler.decrypt()
-    connection_string = CONNECTION_STRING.format(db_path)
-    Session = db.get_session(connection_string)
+    Session = db.get_session(CONNECTION_STRING.format(db_path))
     s = Session()
-    db.create_tables(s)
-    create_base_data(s)
-    add_ratings_and_courses(s)
-    course = create_course(s)
-    company = create_company(s)
-    students = create_students(s, company)
-    exps = create_experiments(s, course)
-    tests = create_tests(s, course)
-    add_practice_grades(s, students, exps)
-    add_theory_grades(s, students, tests)
+    fill_db(s)
+    s.close()
+    Session.kw['bind'].dispose()
     handler.encrypt()
 
 
+def setup_db():
+    create_crypted_db(TEST_DB)
+
+
 class TestDB(unittest.TestCase):
 
     def setUp(self):
@@ -157,6 +177,934 @@ class TestDB(unittest.TestCase):
         self.handler = None
 
 
+class TestEngine(unittest.TestCase):
+
+    def test_profiles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = CONNECTION_STRING.format(os.path.join(tmp, 'x.sqlite'))
+            engine = db.get_engine(url)
+            with engine.connect() as c:
+                self.assertEqual(c.execute('PRAGMA journal_mode').scalar(),
+                                 'memory')
+                self.assertEqual(c.execute('PRAGMA synchronous').scalar(), 0)
+                self.assertEqual(c.execute('PRAGMA foreign_keys').scalar(),
+                                 1)
+            engine.dispose()
+            engine = db.get_engine(url, profile='durable')
+            with engine.connect() as c:
+                self.assertEqual(c.execute('PRAGMA synchronous').scalar(), 2)
+            engine.dispose()
+
+    def test_sql_profile(self):
+        self.assertEqual(
+            sqlprofile.normalize("SELECT * FROM t WHERE a = 12 AND b = 'x'"),
+            'SELECT * FROM t WHERE a = ? AND b = ?'
+        )
+        engine = db.get_engine('sqlite://')
+        profiler = sqlprofile.Profiler(n_plus_one=3)
+        profiler.attach(engine)
+        try:
+            with engine.connect() as c:
+                with profiler.action('einzeln'):
+                    for i in range(3):
+                        c.execute(sa.text('SELECT :i'), i=i)
+                with profiler.action('gleich'):
+                    for i in range(3):
+                        c.execute(sa.text('SELECT 1'))
+        finally:
+            profiler.detach()
+        counts = {statement: count
+                  for statement, count, _, _ in profiler.report()}
+        self.assertEqual(counts['SELECT ?'], 6)
+        self.assertEqual(list(profiler.suspects), [('einzeln', 'SELECT ?')])
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        self.course, self.students = fill_db(self.s)
+
+    def tearDown(self):
+        self.s.close()
+
+    def find(self, text):
+        return {(hit.kind, hit.title)
+                for hit in search.search(self.s.connection(), text)}
+
+    def test_triggers(self):
+        self.assertEqual(self.find('glas'), {('experiment', 'Glasbearbeitung'),
+                                             ('test', 'Glas')})
+        exp = self.course.experiments[1]
+        exp.notes = 'Bürette undicht'
+        self.s.commit()
+        self.assertEqual(self.find('burette'),
+                         {('experiment', 'Volumenmessungen')})
+        mm = self.students[0]
+        mm.last_name = 'Musterknabe'
+        self.s.commit()
+        self.assertEqual(self.find('muster max'),
+                         {('student', 'Musterknabe, Max')})
+        self.s.query(db.PracticeGrade).delete()
+        self.s.query(db.TheoryGrade).delete()
+        self.s.delete(mm)
+        self.s.commit()
+        self.assertEqual(self.find('max'), set())
+        self.assertFalse(search.install(self.s.connection()))
+        search.rebuild(self.s.connection())
+        self.assertEqual(self.find('paula'),
+                         {('student', 'Musterfrau, Paula')})
+
+    def test_missing_first_name(self):
+        self.s.add(db.Student(last_name='Ohnevorname'))
+        self.s.commit()
+        self.assertEqual(self.find('ohnevor'), {('student', 'Ohnevorname')})
+        # triggers of older versions are replaced, the index rebuilt
+        connection = self.s.connection()
+        connection.execute('DROP TRIGGER search_students_update')
+        connection.execute(
+            "CREATE TRIGGER search_students_update AFTER UPDATE ON students "
+            "BEGIN SELECT 1; END"
+        )
+        connection.execute('DELETE FROM search_index')
+        self.assertFalse(search.install(connection))
+        self.assertEqual(self.find('ohnevor'), {('student', 'Ohnevorname')})
+        self.s.query(db.Student).filter_by(
+            last_name='Ohnevorname').update({'first_name': 'Otto'})
+        self.s.commit()
+        self.assertEqual(self.find('otto'),
+                         {('student', 'Ohnevorname, Otto')})
+
+
+class TestBlobs(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        self.course, self.students = fill_db(self.s)
+
+    def tearDown(self):
+        self.s.close()
+
+    def refcounts(self):
+        return dict(self.s.query(db.Blob.hash, db.Blob.refcount))
+
+    def test_dedupe(self):
+        photo = self.students[0].photo
+        self.s.add_all([db.Student(last_name='A', photo=photo),
+                        db.Student(last_name='B', photo=photo)])
+        self.s.commit()
+        logo = self.s.query(db.BaseData).one().logo_hash
+        self.assertEqual(self.refcounts(),
+                         {blobs.digest(photo): 3, logo: 1})
+        self.students[0].photo = b'neu'
+        self.s.commit()
+        self.assertEqual(self.refcounts()[blobs.digest(photo)], 2)
+        self.s.query(db.Student).filter_by(last_name='A').delete()
+        self.s.query(db.Student).filter_by(last_name='B').delete()
+        self.assertEqual(blobs.collect(self.s.connection()), 1)
+        self.assertEqual(self.students[0].photo, b'neu')
+
+    def test_migrate(self):
+        photo = self.students[0].photo
+        c = self.s.connection()
+        c.execute('ALTER TABLE students ADD COLUMN photo BLOB')
+        c.execute('UPDATE students SET photo = ?, photo_hash = NULL',
+                  (photo,))
+        self.s.commit()
+        db.upgrade_schema(self.s)
+        self.s.expire_all()
+        self.assertEqual(self.refcounts()[blobs.digest(photo)], 2)
+        self.assertEqual([s.photo for s in self.students], [photo, photo])
+        self.assertEqual(self.s.connection().execute(
+            'SELECT count(*) FROM students WHERE photo IS NOT NULL'
+        ).scalar(), 0)
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        self.course, self.students = fill_db(self.s)
+
+    def tearDown(self):
+        self.s.close()
+
+    def test_grades_at(self):
+        grade = self.s.query(db.PracticeGrade).filter_by(method=82).one()
+        before = datetime.now()
+        time.sleep(0.01)
+        grade.result = 75
+        self.s.commit()
+        self.s.bulk_update_mappings(db.PracticeGrade,
+                                    [dict(pk=grade.pk, docs=60)])
+        self.s.query(db.TheoryGrade).filter_by(points=9).delete()
+        self.s.commit()
+        rows = self.s.query(db.GradeHistory).filter_by(
+            grade_id=grade.pk, kind=history.PRACTICE
+        ).order_by(db.GradeHistory.pk).all()
+        self.assertEqual([r.changed for r in rows], [7, 2, 4])
+        self.assertEqual((rows[1].value_1, rows[1].value_2), (None, 75))
+        old = history.grades_at(self.s, self.course.pk, before)
+        now = history.grades_at(self.s, self.course.pk, datetime.now())
+        self.assertEqual(len(old), 8)
+        self.assertEqual(len(now), 7)
+        key = (history.PRACTICE, grade.pk)
+        self.assertEqual(old[key].values,
+                         dict(method=82, result=95, docs=95))
+        self.assertEqual(now[key].values,
+                         dict(method=82, result=75, docs=60))
+        points = {v.values['points'] for (kind, _), v in old.items()
+                  if kind == history.THEORY}
+        self.assertEqual(points, {D(17), D('28.5'), D(9), D(14)})
+
+    def test_checkpoint(self):
+        course = self.course.pk
+        self.assertEqual(history.checkpoint(self.s), 0)
+        self.assertEqual(history.checkpoint(self.s, every=0), 1)
+        self.assertEqual(history.checkpoint(self.s, every=0), 0)
+        grade = self.s.query(db.PracticeGrade).filter_by(method=82).one()
+        grade.docs = 70
+        self.s.commit()
+        since, state = history._checkpoint(self.s, course)
+        self.assertEqual(len(state), 8)
+        now = history.grades_at(self.s, course, datetime.now())
+        self.assertEqual(now[history.PRACTICE, grade.pk].values,
+                         dict(method=82, result=95, docs=70))
+        self.assertEqual(now[history.THEORY, 2].values['points'], D('28.5'))
+        # a grade recorded before the checkpoint invalidates it
+        test = self.s.query(db.Test).filter_by(subject='Glas').one()
+        self.s.add(db.TheoryGrade(points=D(3), test=test,
+                                  student=db.Student(last_name='Neu'),
+                                  recorded=datetime(2020, 1, 1)))
+        self.s.commit()
+        self.assertEqual(history._checkpoint(self.s, course), (None, {}))
+        self.assertEqual(
+            len(history.grades_at(self.s, course, datetime.now())), 9
+        )
+
+
+class TestTracing(unittest.TestCase):
+
+    def tearDown(self):
+        tracing.disable()
+        tracing.clear()
+
+    def test_spans(self):
+        self.assertIs(tracing.span('aus'), tracing.NULL_SPAN)
+        tracing.enable()
+        with tracing.span('außen', path='x'):
+            with tracing.span('innen') as span:
+                span.set(count=3)
+        inner, outer = tracing.spans()
+        self.assertEqual((inner.name, inner.depth, inner.args),
+                         ('innen', 1, dict(count=3)))
+        self.assertEqual(outer.depth, 0)
+        self.assertGreaterEqual(outer.duration, inner.duration)
+        events = tracing.chrome_trace()['traceEvents']
+        self.assertEqual([e['ph'] for e in events], ['X', 'X'])
+        self.assertEqual(events[1]['args'], dict(path='x'))
+
+    def test_profile_action(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tracing.profile_next(tmp)
+            with tracing.action('Laden') as action:
+                sum(range(1000))
+            self.assertTrue(os.path.isfile(action.profile_path))
+            with tracing.action('Laden') as action:
+                pass
+            self.assertIsNone(action.profile_path)
+
+
+class TestIcons(unittest.TestCase):
+
+    def setUp(self):
+        from PyQt5 import QtWidgets
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        self.app = (QtWidgets.QApplication.instance() or
+                    QtWidgets.QApplication([]))
+
+    def tearDown(self):
+        icons.clear()
+
+    def test_shared(self):
+        icon = icons.icon('student')
+        self.assertFalse(icon.isNull())
+        self.assertIs(icons.icon('student'), icon)
+        self.assertIs(icons.icon(':/icons/student'),
+                      icons.icon(':/icons/student'))
+        pixmap = icons.pixmap('student', 32)
+        self.assertEqual((pixmap.width(), pixmap.height()), (32, 32))
+        self.assertIs(icons.pixmap('student', 32), pixmap)
+        self.assertIsNot(icons.pixmap('student', 16), pixmap)
+        icons.clear()
+        self.assertIsNot(icons.icon('student'), icon)
+
+
+class TestUiCache(unittest.TestCase):
+
+    def test_compile(self):
+        ui_file = os.path.join(PATH, 'gman', 'ui', 'conference.ui')
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, 'ui_conference.py')
+            uicache.compile_ui(ui_file, target)
+            with open(target, encoding='utf-8') as fp:
+                code = fp.read()
+        self.assertIn('class Ui_', code)
+        self.assertIn('def setupUi(self', code)
+
+    def test_cache_key(self):
+        ui_file = os.path.join(PATH, 'gman', 'ui', 'conference.ui')
+        with open(ui_file, encoding='utf-8') as fp:
+            source = fp.read()
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name in ('a', 'b'):
+                os.mkdir(os.path.join(tmp, name))
+                paths.append(os.path.join(tmp, name, 'form.ui'))
+                with open(paths[-1], 'w', encoding='utf-8') as fp:
+                    fp.write(source.replace('Konferenz', name))
+            cache = os.path.join(tmp, 'cache')
+            with mock.patch.dict(os.environ, {'LOCALAPPDATA': cache}):
+                first, second = map(uicache.get_form_class, paths)
+                self.assertIsNot(first, second)
+                self.assertIs(uicache.get_form_class(paths[0]), first)
+                # same size and mtime, other content
+                stat = os.stat(paths[0])
+                with open(paths[0], 'w', encoding='utf-8') as fp:
+                    fp.write(source.replace('Konferenz', 'c'))
+                os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                self.assertIsNot(uicache.get_form_class(paths[0]), first)
+                self.assertEqual(len(os.listdir(uicache._cache_dir())), 2)
+
+    def test_fallback(self):
+        with mock.patch.object(uicache, 'get_form_class',
+                               side_effect=OSError('read-only')), \
+                mock.patch.object(uicache.uic, 'loadUi') as load_ui, \
+                self.assertLogs('gman.uicache', 'WARNING'):
+            uicache.load_ui('form.ui', None)
+        load_ui.assert_called_once_with('form.ui', None)
+
+
+class TestReports(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        self.course, self.students = fill_db(self.s)
+
+    def tearDown(self):
+        self.s.close()
+
+    def test_standings(self):
+        mm, pm = self.students
+        standings = grades.course_standings(self.s, self.course)
+        self.assertAlmostEqual(standings[mm.pk].practice, 89.4)
+        self.assertAlmostEqual(standings[mm.pk].theory, 95.0)
+        self.assertAlmostEqual(standings[mm.pk].total, 92.2)
+        until = grades.course_standings(self.s, self.course,
+                                        date(2020, 1, 3))
+        self.assertAlmostEqual(until[pm.pk].practice, 95.0)
+        self.assertIsNone(until[pm.pk].theory)
+
+    def test_render_group(self):
+        data = reports.ReportData(self.s)
+        html = reports.render_group(data)
+        self.assertIn(data.logo_src, html)
+        self.assertIn('Mustermann, Max', html)
+        self.assertIn('92,2', html)
+        sheets = reports.render_student_sheets(data, logo_src='')
+        self.assertEqual(len(sheets), 2)
+        summary = reports.render_summary(data, logo_src='')
+        self.assertIn('Grundbildung', summary)
+        self.assertIn('Musterfrau, Paula', summary)
+
+
+class TestConference(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        self.course, self.students = fill_db(self.s)
+        self.conf = db.Conference(title='Zwischenstand',
+                                  date=date(2020, 1, 20),
+                                  grades_til=date(2020, 1, 5))
+        self.s.add(self.conf)
+        self.s.commit()
+
+    def tearDown(self):
+        self.s.close()
+
+    def test_snapshot(self):
+        mm, pm = self.students
+        grades = conference.snapshot(self.s, self.conf)
+        row = grades[(mm.pk, self.course.pk)]
+        self.assertAlmostEqual(row.practice, 89.4)
+        self.assertIsNone(row.theory)
+        self.assertFalse(conference.is_stale(self.s, self.conf))
+        # grades after grades_til do not invalidate the snapshot
+        test = self.s.query(db.Test).filter_by(subject='Glas').one()
+        test.grades[0].points = D(20)
+        self.s.commit()
+        self.assertFalse(conference.is_stale(self.s, self.conf))
+        exp = self.s.query(db.Experiment).filter_by(
+            title='Glasbearbeitung'
+        ).one()
+        exp.grades[0].result = 50
+        self.s.commit()
+        self.assertTrue(conference.is_stale(self.s, self.conf))
+        grades = conference.snapshot(self.s, self.conf)
+        self.assertAlmostEqual(grades[(mm.pk, self.course.pk)].practice,
+                               69.9)
+        self.s.query(db.PracticeGrade).filter_by(
+            pk=exp.grades[1].pk
+        ).delete()
+        self.s.commit()
+        self.assertTrue(conference.is_stale(self.s, self.conf))
+
+    def test_students(self):
+        mm, pm = self.students
+        # read-only: listed, but nothing is stored
+        rows = conference.students(self.s, self.conf, persist=False)
+        self.assertEqual([st.pk for st, _ in rows], [pm.pk, mm.pk])
+        self.assertEqual(self.s.query(db.ConferenceStudent).count(), 0)
+        conference.students(self.s, self.conf)[0][1].note = 'gut'
+        self.s.commit()
+        # a student added after the snapshot shows up as well
+        conference.snapshot(self.s, self.conf)
+        self.s.add(db.Student(last_name='Neumann', first_name='Nina',
+                              company=mm.company))
+        self.s.commit()
+        rows = conference.students(self.s, self.conf)
+        self.assertEqual([st.last_name for st, _ in rows],
+                         ['Musterfrau', 'Mustermann', 'Neumann'])
+        self.assertEqual(rows[0][1].note, 'gut')
+        self.assertEqual(self.s.query(db.ConferenceStudent).count(), 3)
+
+    def test_stale_inputs(self):
+        conference.snapshot(self.s, self.conf)
+        exp = self.s.query(db.Experiment).filter_by(
+            title='Glasbearbeitung'
+        ).one()
+        exp.weight_result = 10
+        self.s.commit()
+        self.assertTrue(conference.is_stale(self.s, self.conf))
+        conference.snapshot(self.s, self.conf)
+        self.assertFalse(conference.is_stale(self.s, self.conf))
+        test = self.s.query(db.Test).filter_by(subject='Basistest').one()
+        test.max_points = 50
+        self.s.commit()
+        self.assertTrue(conference.is_stale(self.s, self.conf))
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        self.course, self.students = fill_db(self.s)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.s.close()
+        self.tmp.cleanup()
+
+    def write_csv(self, text):
+        path = os.path.join(self.tmp.name, 'import.csv')
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        return path
+
+    def test_students(self):
+        path = self.write_csv(
+            'Nachname;Vorname;Firma\n'
+            'Meier;Anna;MZF\n'
+            'Schulz;Tom;XYZ\n'
+            'Mustermann;Max;MKF\n'
+            'Lehmann;Lea;mkf\n'
+        )
+        report = importer.import_students(self.s, path)
+        self.assertEqual(report.inserted, 2)
+        self.assertEqual([line for line, _ in report.errors], [3, 4])
+        anna = self.s.query(db.Student).filter_by(first_name='Anna').one()
+        self.assertEqual(anna.company.short_name, 'MZF')
+
+    def test_grades(self):
+        path = self.write_csv(
+            'Nachname,Vorname,Kurs,Art,Titel,Datum,Punkte,Maximalpunkte,'
+            'Methode,Ergebnis,Doku\n'
+            'Mustermann,Max,Grundbildung,Theorie,Glas,,"25,5",,,,\n'
+            'Musterfrau,Paula,Grundbildung,Theorie,Abschluss,31.03.2020,'
+            '40,50,,,\n'
+            'Musterfrau,Paula,Grundbildung,Praxis,Titration,15.03.2020,'
+            ',,80,90,70\n'
+            'Niemand,Nobody,Grundbildung,Praxis,Titration,,,,1,1,1\n'
+        )
+        report = importer.import_grades(self.s, path)
+        self.assertEqual((report.inserted, report.updated), (2, 1))
+        self.assertEqual(len(report.errors), 1)
+        mm, pm = self.students
+        self.s.expire_all()
+        glas = self.s.query(db.TheoryGrade).join(db.Test).filter(
+            db.Test.subject == 'Glas', db.TheoryGrade.student_id == mm.pk
+        ).one()
+        self.assertEqual(glas.points, D('25.5'))
+        exp = self.s.query(db.Experiment).filter_by(title='Titration').one()
+        self.assertEqual(exp.grades[0].grade, 82)
+
+    def test_partial_update(self):
+        path = self.write_csv(
+            'Nachname;Vorname;Kurs;Art;Titel;Datum;Methode;Ergebnis;Doku;'
+            'Punkte\n'
+            'Mustermann;Max;Grundbildung;Praxis;Volumenmessungen;;;97;;\n'
+            'Mustermann;Max;Grundbildung;Praxis;Volumenmessungen;;101;;;\n'
+            'Mustermann;Max;Grundbildung;Theorie;Glas;;;;;31\n'
+        )
+        report = importer.import_grades(self.s, path)
+        self.assertEqual(report.updated, 1)
+        self.assertEqual([line for line, _ in report.errors], [3, 4])
+        self.assertIn('zwischen 0 und 100', report.errors[0][1])
+        self.assertIn('zwischen 0 und 30', report.errors[1][1])
+        self.s.expire_all()
+        grade = self.s.query(db.PracticeGrade).join(db.Experiment).filter(
+            db.Experiment.title == 'Volumenmessungen',
+            db.PracticeGrade.student_id == self.students[0].pk
+        ).one()
+        self.assertEqual((grade.method, grade.result, grade.docs),
+                         (82, 97, 95))
+
+    def test_cp1252_and_invalid_values(self):
+        path = os.path.join(self.tmp.name, 'excel.csv')
+        with open(path, 'w', encoding='cp1252') as fp:
+            fp.write(
+                'Nachname;Vorname;Kurs;Art;Titel;Datum;Methode;Ergebnis;Doku\n'
+                'Mustermann;Max;Grundbildung;Praxis;Löten;01.02.2020;;;\n'
+                'Mustermann;Max;Grundbildung;Praxis;Löten;;82,5;;\n'
+                'Mustermann;Max;Grundbildung;Praxis;Löten;01.02.2020;80;;\n'
+            )
+        report = importer.import_grades(self.s, path)
+        self.assertEqual(report.inserted, 1)
+        self.assertEqual([line for line, _ in report.errors], [2, 3])
+        self.assertIn('ganze Zahl', report.errors[1][1])
+        exp = self.s.query(db.Experiment).filter_by(title='Löten').one()
+        self.assertEqual([g.method for g in exp.grades], [80])
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.s = db.get_session()()
+        fill_db(self.s)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.s.close()
+        self.tmp.cleanup()
+
+    def test_json_lines(self):
+        path = os.path.join(self.tmp.name, 'grades.json')
+        writer = export.get_writer(path)
+        self.assertEqual(export.export(self.s, writer, batch_size=3), 8)
+        writer.close()
+        with open(path, encoding='utf-8') as fp:
+            rows = [json.loads(line) for line in fp]
+        self.assertEqual([r['kind'] for r in rows].count('theory'), 4)
+        self.assertAlmostEqual(rows[1]['grade'], 89.8)
+        self.assertEqual(rows[4]['points'], 17)
+        self.assertEqual(rows[0]['group'], 'BWCL 125')
+
+
+class TestBatchExporter(unittest.TestCase):
+
+    def setUp(self):
+        from PyQt5 import QtWidgets
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        self.app = (QtWidgets.QApplication.instance() or
+                    QtWidgets.QApplication([]))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.Session = db.get_session(CONNECTION_STRING.format(
+            os.path.join(self.tmp.name, 'export.sqlite')
+        ))
+        s = self.Session()
+        course, (mm, pm) = fill_db(s)
+        s.add(db.Student(last_name='Mustermann', first_name='Max',
+                         company=mm.company))
+        s.commit()
+        s.close()
+        self.target = os.path.join(self.tmp.name, 'pdf')
+
+    def tearDown(self):
+        self.Session.kw['bind'].dispose()
+        self.tmp.cleanup()
+
+    def run_export(self, cancel=False):
+        from gman import printing
+        exporter = printing.BatchExporter(self.Session, self.target)
+        progress, result = [], []
+        exporter.progress.connect(lambda *args: progress.append(args))
+        exporter.finished.connect(result.append)
+        exporter.start()
+        if cancel:
+            exporter.cancel()
+        deadline = time.time() + 30
+        while not result and time.time() < deadline:
+            self.app.processEvents()
+            time.sleep(0.01)
+        exporter.wait()
+        self.assertEqual(result, [[]])
+        return exporter, progress
+
+    def printed(self):
+        s = self.Session()
+        try:
+            return [c.printed for c in s.query(db.Course)]
+        finally:
+            s.close()
+
+    def test_export(self):
+        exporter, progress = self.run_export()
+        self.assertEqual(progress[-1], (4, 4))
+        names = sorted(os.listdir(self.target))
+        self.assertEqual(len(names), 4)
+        self.assertEqual(sorted(os.path.basename(p) for p in exporter.paths),
+                         names)
+        self.assertTrue(all(self.printed()))
+
+    def test_cancel(self):
+        exporter, progress = self.run_export(cancel=True)
+        self.assertTrue(exporter.cancelled)
+        self.assertFalse(any(self.printed()))
+
+
+class TestMainWindow(unittest.TestCase):
+
+    def setUp(self):
+        from PyQt5 import QtWidgets
+        from gman import main_window
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        self.app = (QtWidgets.QApplication.instance() or
+                    QtWidgets.QApplication([]))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'window.gmandb')
+        create_crypted_db(self.path)
+        self.window = main_window.GradeManagerMain()
+        self.window.load_db(CryptedDBHandler(self.path, password=PASSWORD))
+
+    def tearDown(self):
+        self.window.close()
+        self.window.deleteLater()
+        self.app.processEvents()
+        self.tmp.cleanup()
+
+    def test_window_sessions(self):
+        window = self.window
+        window.edit_companies()
+        first = window.subwindows['companies']
+        session = first.widget().session
+        self.assertIn(session, window._sessions)
+        first.close()
+        window.edit_companies()
+        # the closed window was replaced, its session is gone
+        self.assertNotIn(session, window._sessions)
+        self.assertEqual(len(window._sessions), 1)
+        second = window.subwindows['companies']
+        window._subwindow_closed(second, 'companies')
+        self.assertEqual(window._sessions, [])
+        self.assertNotIn('companies', window.subwindows)
+
+    def change(self):
+        s = self.window._Session()
+        s.add(db.Company(name='Neu'))
+        s.commit()
+        s.close()
+
+    def test_close_write_error(self):
+        from PyQt5 import QtWidgets
+        handler = self.window.handler
+        handler.generations = 1
+        self.change()
+        with mock.patch('gman.crypto.rotate', side_effect=OSError('voll')), \
+                mock.patch.object(QtWidgets.QMessageBox, 'critical') as msg:
+            self.assertFalse(self.window.close())
+        self.assertEqual(msg.call_count, 1)
+        self.assertTrue(handler.useable and handler.owns_lock())
+        # the window works on, closing again writes the file
+        self.change()
+        self.assertTrue(self.window.close())
+        self.assertFalse(handler.useable)
+        self.assertIn(b'Neu', decrypt_file(self.path, password=PASSWORD))
+
+    def test_close_lock_lost(self):
+        from PyQt5 import QtWidgets
+        box = QtWidgets.QMessageBox
+        handler = self.window.handler
+        self.change()
+        handler.lockfile.write_text(json.dumps(dict(
+            user='other', host='elsewhere', pid=1, heartbeat=time.time()
+        )))
+        with open(self.path, 'rb') as fp:
+            before = fp.read()
+        with mock.patch.object(box, 'warning', return_value=box.Cancel):
+            self.assertFalse(self.window.close())
+        self.assertTrue(handler.db_path.exists())
+        copy = os.path.join(self.tmp.name, 'copy.gmandb')
+        with mock.patch.object(box, 'warning', return_value=box.Save), \
+                mock.patch.object(QtWidgets.QFileDialog, 'getSaveFileName',
+                                  return_value=(copy, '')):
+            self.assertTrue(self.window.close())
+        self.assertFalse(handler.db_path.exists())
+        self.assertIn(b'Neu', decrypt_file(copy, password=PASSWORD))
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), before)
+        self.assertTrue(handler.lockfile.exists())
+
+
+class TestGuiBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        from gman import bench_gui
+        results = bench_gui.run(scales=(1,), repeat=1)
+        self.assertEqual(set(results['1']), set(bench_gui.BUDGETS))
+        for stats in results['1'].values():
+            self.assertEqual(set(stats),
+                             {'seconds', 'queries', 'allocated', 'retained'})
+        self.assertTrue(results['1']['load_db']['queries'])
+        self.assertEqual(bench_gui.over_budget(results, {'load_db': 1e9}), [])
+        slow = bench_gui.over_budget(results, {'load_db': 0})
+        self.assertEqual([s[:2] for s in slow], [('1', 'load_db')])
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'cli.gmandb')
+        create_crypted_db(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_aggregate(self):
+        other = os.path.join(self.tmp.name, 'other.gmandb')
+        create_crypted_db(other)
+        cache = aggregate.Cache(os.path.join(self.tmp.name, 'cache.json'))
+        paths = [self.path, other]
+        results, errors = aggregate.aggregate(paths, password=PASSWORD,
+                                              workers=2, cache=cache)
+        self.assertEqual(errors, [])
+        self.assertFalse(os.path.exists(self.path[:-6] + 'lock'))
+        rows = aggregate.merge(results, 'cl')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['students'], 4)
+        self.assertAlmostEqual(rows[0]['practice'], 88.95)
+        cache = aggregate.Cache(cache.path)
+        self.assertIsNotNone(cache.get(cache.key(other)))
+        self.assertEqual(aggregate.merge(results, 'PK'), [])
+        # a file written while it is processed is stored with the old key
+        key = cache.key(other)
+        with open(other, 'ab') as fp:
+            fp.write(b'x')
+        cache.set(key, results[1])
+        self.assertIsNone(cache.get(cache.key(other)))
+        # a missing file is reported, the others are still aggregated
+        missing = os.path.join(self.tmp.name, 'missing.gmandb')
+        results, errors = aggregate.aggregate([missing, self.path],
+                                              password=PASSWORD, cache=cache)
+        self.assertEqual([path for path, error in errors], [missing])
+        self.assertEqual(len(results), 1)
+
+    def test_check_and_render(self):
+        self.assertEqual(cli.main(['-p', PASSWORD, 'check', self.tmp.name]),
+                         0)
+        self.assertFalse(os.path.exists(self.path[:-6] + 'lock'))
+        self.assertEqual(cli.main(['-p', 'wrong', 'check', self.path]), 1)
+        out = os.path.join(self.tmp.name, 'out')
+        cli.main(['-p', PASSWORD, 'render', '-o', out, self.path])
+        self.assertEqual(len(os.listdir(os.path.join(out, 'BWCL_125'))), 4)
+
+    def test_benchmark(self):
+        out = os.path.join(self.tmp.name, 'bench.json')
+        self.assertEqual(cli.main(['benchmark', '--scales', '1',
+                                   '--repeat', '1', '-o', out]), 0)
+        results = bench.load(out)
+        self.assertIn('decrypt', results['results']['1'])
+        rows = bench.compare(results, results)
+        self.assertTrue(rows)
+        self.assertEqual(bench.regressions(rows), [])
+
+
+class TestCryptedDBHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'crypted.gmandb')
+        create_crypted_db(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_only(self):
+        writer = CryptedDBHandler(self.path, password=PASSWORD)
+        with open(self.path, 'rb') as fp:
+            before = fp.read()
+        reader = CryptedDBHandler(self.path, password=PASSWORD,
+                                  read_only=True)
+        reader.decrypt()
+        Session = db.get_session(reader.connection_string,
+                                 profile=reader.profile)
+        s = Session()
+        self.assertEqual(s.query(db.Student).count(), 2)
+        s.add(db.Company(name='Neu'))
+        with self.assertRaises(sa.exc.OperationalError):
+            s.commit()
+        s.rollback()
+        s.close()
+        Session.kw['bind'].dispose()
+        reader.close()
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), before)
+        with self.assertRaises(SetupError):
+            reader.encrypt()
+        self.assertEqual(cli.main(['-p', PASSWORD, 'check', self.path]), 0)
+        writer.release()
+
+    def test_encrypt_unchanged(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        handler = CryptedDBHandler(self.path, password=PASSWORD)
+        handler.decrypt()
+        self.assertFalse(handler.encrypt())
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+        self.assertFalse(os.path.exists(self.path[:-6] + 'lock'))
+        handler = CryptedDBHandler(self.path, password=PASSWORD)
+        Session = db.get_session(handler.connection_string)
+        handler.decrypt()
+        s = Session()
+        s.add(db.Company(name='Neu'))
+        s.commit()
+        s.close()
+        Session.kw['bind'].dispose()
+        self.assertTrue(handler.encrypt())
+        self.assertNotEqual(os.stat(self.path).st_mtime_ns, mtime)
+
+    def test_failed_write_keeps_working_copy(self):
+        handler = CryptedDBHandler(self.path, password=PASSWORD,
+                                   generations=1)
+        handler.decrypt()
+        with mock.patch('gman.crypto.rotate', side_effect=OSError('voll')):
+            with self.assertRaises(OSError):
+                handler.encrypt(force=True)
+        self.assertTrue(handler.db_path.exists())
+        self.assertTrue(handler.encrypt(force=True))
+        self.assertFalse(handler.db_path.exists())
+
+    def test_generations(self):
+        for n in range(3):
+            handler = CryptedDBHandler(self.path, password=PASSWORD,
+                                       generations=2)
+            handler.decrypt()
+            handler.encrypt(force=True)
+        names = sorted(os.listdir(self.tmp.name))
+        self.assertEqual(names, ['crypted.gmandb', 'crypted.gmandb.1',
+                                 'crypted.gmandb.2'])
+        plaintext = decrypt_file(self.path + '.2', password=PASSWORD)
+        self.assertTrue(plaintext.startswith(b'SQLite format 3'))
+
+    def test_container(self):
+        with open(self.path, 'rb') as fp:
+            salt = fp.read(25)
+            self.assertTrue(container.is_container(fp.read()))
+        plaintext = decrypt_file(self.path, password=PASSWORD)
+        key = derive_key(PASSWORD, salt)
+        # older files are one Fernet token, they are read and converted
+        with open(self.path, 'wb') as fp:
+            fp.write(salt + Fernet(key).encrypt(plaintext))
+        self.assertEqual(decrypt_file(self.path, password=PASSWORD),
+                         plaintext)
+        handler = CryptedDBHandler(self.path, password=PASSWORD,
+                                   compression='none')
+        handler.decrypt()
+        handler.encrypt(force=True)
+        self.assertEqual(decrypt_file(self.path, password=PASSWORD),
+                         plaintext)
+        size = container.CHUNK_SIZE
+        container.CHUNK_SIZE = 4096
+        self.addCleanup(setattr, container, 'CHUNK_SIZE', size)
+        data = plaintext * 3
+        pieces = list(container.encode(data, key))
+        encoded = b''.join(pieces)
+        self.assertLess(len(encoded), len(plaintext))
+        self.assertEqual(b''.join(container.decode(encoded, key)), data)
+        for damaged in (encoded[:-1], encoded + pieces[-1],
+                        encoded[:20] + b'x' + encoded[21:]):
+            with self.assertRaises(container.ContainerError):
+                b''.join(container.decode(damaged, key))
+
+    def test_stale_lock(self):
+        lockfile = self.path[:-6] + 'lock'
+        with open(lockfile, 'w') as fp:
+            fp.write('someone')
+        with self.assertRaises(SetupError) as cm:
+            CryptedDBHandler(self.path, password=PASSWORD, takeover=True)
+        self.assertEqual(cm.exception.user, 'someone')
+        self.assertFalse(cm.exception.stale)
+        with open(lockfile, 'w') as fp:
+            json.dump(dict(user='someone', host='elsewhere', pid=1,
+                           heartbeat=0), fp)
+        with self.assertRaises(SetupError) as cm:
+            CryptedDBHandler(self.path, password=PASSWORD)
+        self.assertTrue(cm.exception.stale)
+        handler = CryptedDBHandler(self.path, password=PASSWORD,
+                                   takeover=True)
+        self.assertTrue(handler.owns_lock())
+        with self.assertRaises(SetupError) as cm:
+            CryptedDBHandler(self.path, password=PASSWORD, takeover=True)
+        self.assertFalse(cm.exception.stale)
+        handler.release()
+        self.assertEqual(os.listdir(self.tmp.name), ['crypted.gmandb'])
+
+    def test_lock_lost(self):
+        handler = CryptedDBHandler(self.path, password=PASSWORD)
+        handler.decrypt()
+        with open(self.path, 'rb') as fp:
+            before = fp.read()
+        lockfile = handler.lockfile
+        stale = dict(user='someone', host='elsewhere', pid=1, heartbeat=0)
+        fresh = dict(stale, user='other', heartbeat=time.time())
+        lockfile.write_text(json.dumps(stale))
+        info = crypto.read_lock(lockfile)
+        # a faster contender replaced the stale lock in the meantime
+        lockfile.write_text(json.dumps(fresh))
+        self.assertFalse(handler._break_lock(lockfile, info))
+        self.assertEqual(crypto.read_lock(lockfile), fresh)
+        messages = []
+        handler.on_lock_error = messages.append
+        beat = crypto.Heartbeat(handler, interval=0.01)
+        beat.start()
+        beat.join(5)
+        self.assertIsInstance(handler.lock_error, crypto.LockLostError)
+        self.assertEqual(len(messages), 1)
+        with self.assertRaises(crypto.LockLostError):
+            handler.checkpoint()
+        with self.assertRaises(crypto.LockLostError):
+            handler.encrypt(force=True)
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), before)
+        handler.release()
+        self.assertTrue(lockfile.exists())
+
+    def test_checkpoint(self):
+        handler = CryptedDBHandler(self.path, password=PASSWORD)
+        Session = db.get_session(handler.connection_string)
+        handler.decrypt()
+        s = Session()
+        self.assertFalse(handler.checkpoint())
+        s.add(db.Company(name='Neu'))
+        s.commit()
+        self.assertTrue(handler.checkpoint())
+        self.assertTrue(os.path.exists(self.path[:-6] + 'lock'))
+        plaintext = decrypt_file(self.path, password=PASSWORD)
+        self.assertIn(b'Neu', plaintext)
+        s.close()
+        Session.kw['bind'].dispose()
+        self.assertFalse(handler.encrypt())
+
+
 if __name__ == '__main__':
     setup_db()
     unittest.main()